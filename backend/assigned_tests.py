@@ -0,0 +1,337 @@
+"""
+Тесты, назначенные пользователю (замена sp_get_user_assigned_tests).
+
+Процедура на каждый вызов выполняет подзапрос по user_groups, LEFT JOIN
+к test_questions, GROUP BY и DISTINCT. Здесь то же самое собирается из
+двух кэшей в памяти процесса и одного запроса:
+
+- индекс членства: user_id -> ID групп пользователя (LRU-кэш);
+- количество вопросов теста: test_id -> ID вопросов теста (LRU-кэш).
+
+Назначения и поля тестов читаются одним запросом UNION ALL из двух
+веток по индексам test_assignments (idx_user_id и idx_group_id) с JOIN
+к tests по первичному ключу, поэтому изменения test_assignments и tests
+видны сразу. Кэши сбрасываются при изменении user_groups и
+test_questions через сессии SQLAlchemy этого процесса; на промахе
+кэша выполняется еще один запрос к соответствующей таблице.
+
+Изменения, сделанные в обход этого процесса (другие воркеры, сервисы,
+прямые запросы к БД), видны не позже чем через ASSIGNED_CACHE_TTL_SECONDS:
+записи старше этого срока перечитываются.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import event, inspect, select, union_all
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+import models
+import payload_cache
+
+# Максимальное количество пользователей в индексе членства в группах
+GROUP_INDEX_SIZE = int(os.getenv("GROUP_INDEX_SIZE", "10000"))
+
+# Максимальное количество тестов в кэше количества вопросов
+QUESTION_COUNT_CACHE_SIZE = 5000
+
+# Время жизни записей индекса групп и кэша количества вопросов (секунды)
+ASSIGNED_CACHE_TTL_SECONDS = float(os.getenv("ASSIGNED_CACHE_TTL_SECONDS", "60"))
+
+
+class GroupIndex:
+    """
+    Индекс членства пользователей в группах (user_id -> group_ids)
+    """
+
+    def __init__(self, max_users: int = GROUP_INDEX_SIZE, ttl_seconds: float = ASSIGNED_CACHE_TTL_SECONDS):
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # user_id -> (время загрузки, ID групп)
+        self._groups: "OrderedDict[int, Tuple[float, Tuple[int, ...]]]" = OrderedDict()
+        # Растет при каждом сбросе записей
+        self._generation = 0
+
+    def get_groups(self, db: Session, user_id: int) -> Tuple[int, ...]:
+        """
+        Получить ID групп пользователя
+
+        Args:
+            db: Сессия базы данных
+            user_id: ID пользователя
+
+        Returns:
+            ID групп по возрастанию
+        """
+        with self._lock:
+            entry = self._groups.get(user_id)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl_seconds:
+                self._groups.move_to_end(user_id)
+                return entry[1]
+            generation = self._generation
+
+        groups = tuple(
+            group_id for (group_id,) in db.query(models.UserGroup.group_id)
+            .filter(models.UserGroup.user_id == user_id)
+            .order_by(models.UserGroup.group_id)
+        )
+
+        with self._lock:
+            # Группы, прочитанные до сброса, могли устареть: не сохранять
+            if generation == self._generation:
+                self._groups[user_id] = (time.monotonic(), groups)
+                self._groups.move_to_end(user_id)
+                while len(self._groups) > self.max_users:
+                    self._groups.popitem(last=False)
+        return groups
+
+    def invalidate_users(self, user_ids: Iterable[int]):
+        """Сбросить группы пользователей"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        with self._lock:
+            self._generation += 1
+            for user_id in user_ids:
+                self._groups.pop(user_id, None)
+
+    def clear(self):
+        """Сбросить весь индекс"""
+        with self._lock:
+            self._generation += 1
+            self._groups.clear()
+
+
+class QuestionCountCache:
+    """
+    Вопросы тестов (test_id -> question_ids) для подсчета их количества
+
+    Хранит ID вопросов, а не только количество, чтобы сбрасывать
+    записи по вопросам (payload_cache.register_cache).
+    """
+
+    def __init__(self, max_tests: int = QUESTION_COUNT_CACHE_SIZE, ttl_seconds: float = ASSIGNED_CACHE_TTL_SECONDS):
+        self.max_tests = max_tests
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # test_id -> (время загрузки, ID вопросов)
+        self._questions: "OrderedDict[int, Tuple[float, Set[int]]]" = OrderedDict()
+        # Растет при каждом сбросе записей
+        self._generation = 0
+
+    def get_counts(self, db: Session, test_ids: Iterable[int]) -> Dict[int, int]:
+        """
+        Получить количество вопросов тестов
+
+        Тесты, которых нет в кэше, загружаются одним запросом
+        WHERE test_id IN (...).
+
+        Args:
+            db: Сессия базы данных
+            test_ids: ID тестов
+
+        Returns:
+            Словарь test_id -> количество вопросов
+        """
+        counts: Dict[int, int] = {}
+        missing: List[int] = []
+        now = time.monotonic()
+        with self._lock:
+            for test_id in dict.fromkeys(test_ids):
+                entry = self._questions.get(test_id)
+                if entry is None or now - entry[0] >= self.ttl_seconds:
+                    missing.append(test_id)
+                else:
+                    self._questions.move_to_end(test_id)
+                    counts[test_id] = len(entry[1])
+            generation = self._generation
+
+        if missing:
+            loaded: Dict[int, Set[int]] = {test_id: set() for test_id in missing}
+            for test_id, question_id in db.query(
+                models.TestQuestion.test_id,
+                models.TestQuestion.question_id
+            ).filter(models.TestQuestion.test_id.in_(missing)):
+                loaded[test_id].add(question_id)
+
+            loaded_at = time.monotonic()
+            with self._lock:
+                # Вопросы, прочитанные до сброса, могли устареть: не сохранять
+                store = generation == self._generation
+                for test_id, questions in loaded.items():
+                    counts[test_id] = len(questions)
+                    if store:
+                        self._questions[test_id] = (loaded_at, questions)
+                        self._questions.move_to_end(test_id)
+                while len(self._questions) > self.max_tests:
+                    self._questions.popitem(last=False)
+
+        return counts
+
+    def invalidate_tests(self, test_ids: Iterable[int]):
+        """Сбросить записи тестов"""
+        test_ids = list(test_ids)
+        if not test_ids:
+            return
+        with self._lock:
+            self._generation += 1
+            for test_id in test_ids:
+                self._questions.pop(test_id, None)
+
+    def invalidate_questions(self, question_ids: Iterable[int]):
+        """Сбросить записи тестов, содержащих вопросы"""
+        question_ids = set(question_ids)
+        if not question_ids:
+            return
+        with self._lock:
+            # Вопрос мог попасть в тест, который сейчас загружается
+            self._generation += 1
+            for test_id in [
+                test_id for test_id, (_, questions) in self._questions.items()
+                if not questions.isdisjoint(question_ids)
+            ]:
+                del self._questions[test_id]
+
+    def clear(self):
+        """Сбросить весь кэш"""
+        with self._lock:
+            self._generation += 1
+            self._questions.clear()
+
+
+# Общие кэши приложения
+group_index = GroupIndex()
+question_counts = QuestionCountCache()
+payload_cache.register_cache(question_counts)
+
+
+def _assignments_query(user_id: int, group_ids: Tuple[int, ...]):
+    """
+    Назначения пользователя и его групп вместе с полями активных тестов
+
+    Каждая ветка UNION ALL идет по своему индексу test_assignments.
+    """
+    assignment = models.TestAssignment
+    test = models.Test
+    columns = [
+        test.id,
+        test.title,
+        test.description,
+        test.time_limit_minutes,
+        test.passing_score,
+        assignment.deadline,
+        assignment.is_completed,
+    ]
+
+    def branch(condition):
+        return (
+            select(*columns)
+            .select_from(assignment)
+            .join(test, test.id == assignment.test_id)
+            .where(condition, test.is_active == True)
+        )
+
+    branches = [branch(assignment.user_id == user_id)]
+    if group_ids:
+        branches.append(branch(assignment.group_id.in_(group_ids)))
+    return union_all(*branches) if len(branches) > 1 else branches[0]
+
+
+def _deadline_key(item: Dict[str, Any]) -> Tuple:
+    """Сортировка: сначала ближайшие сроки, назначения без срока - в конце"""
+    deadline: Optional[datetime] = item["deadline"]
+    return (deadline is None, deadline or datetime.min, item["id"])
+
+
+def get_assigned_tests(db: Session, user_id: int) -> List[Dict[str, Any]]:
+    """
+    Активные тесты, назначенные пользователю лично или через группы
+
+    Как и sp_get_user_assigned_tests, одинаковые строки (тест, срок,
+    статус назначения) схлопываются. Сортировка - по сроку, назначения
+    без срока идут последними.
+
+    Args:
+        db: Сессия базы данных
+        user_id: ID пользователя
+
+    Returns:
+        Список назначенных тестов
+    """
+    group_ids = group_index.get_groups(db, user_id)
+    rows = db.execute(_assignments_query(user_id, group_ids)).all()
+    counts = question_counts.get_counts(db, [row[0] for row in rows])
+
+    seen = set()
+    result = []
+    for test_id, title, description, time_limit, passing_score, deadline, is_completed in rows:
+        key = (test_id, deadline, bool(is_completed))
+        if key in seen:
+            continue
+        seen.add(key)
+        result.append({
+            "id": test_id,
+            "title": title,
+            "description": description,
+            "time_limit": time_limit,
+            "passing_score": float(passing_score),
+            "questions_count": counts.get(test_id, 0),
+            "deadline": deadline,
+            "is_completed": bool(is_completed)
+        })
+
+    result.sort(key=_deadline_key)
+    return result
+
+
+# =====================================================
+# ИНВАЛИДАЦИЯ ПРИ ИЗМЕНЕНИИ user_groups
+# =====================================================
+
+@event.listens_for(models.UserGroup.user_id, "set", active_history=True)
+def _load_previous_user(target: models.UserGroup, value, oldvalue, initiator):
+    """
+    Загружать прежний user_id при переносе строки на другого пользователя
+
+    Без active_history у строки, истекшей после commit, прежнее значение
+    не попадает в историю атрибута, и его группы не сбрасываются.
+    """
+    return value
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_group_changes(session: Session, flush_context):
+    """Запомнить пользователей, чьи группы изменились в этой транзакции"""
+    changed: Set[int] = session.info.setdefault("group_index_users", set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, models.UserGroup):
+            if obj.user_id is not None:
+                changed.add(obj.user_id)
+            # Строку перенесли на другого пользователя: прежний тоже теряет группу
+            changed.update(
+                user_id for user_id in inspect(obj).attrs.user_id.history.deleted
+                if user_id is not None
+            )
+        elif isinstance(obj, models.Group) and obj in session.deleted:
+            session.info["group_index_reset"] = True
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _apply_group_changes(session: Session):
+    """Сбросить индекс после фиксации транзакции"""
+    if session.info.pop("group_index_reset", False):
+        group_index.clear()
+    group_index.invalidate_users(session.info.pop("group_index_users", set()))
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_group_changes(session: Session):
+    """Забыть изменения отмененной транзакции"""
+    session.info.pop("group_index_users", None)
+    session.info.pop("group_index_reset", None)
@@ -0,0 +1,636 @@
+"""
+Аудит изменений на стороне приложения (AUDIT_MODE=app).
+
+В режиме по умолчанию (AUDIT_MODE=trigger) audit_log пишут триггеры
+init.sql: каждый INSERT/UPDATE/DELETE в users, tests и test_sessions
+синхронно добавляет строку аудита в транзакции пользователя. В режиме
+app триггеры удаляются (database/audit_partitioning.sql), а изменения
+тех же таблиц и колонок собираются здесь:
+
+1. события сессий SQLAlchemy (after_flush) фиксируют изменения через ORM;
+   изменения в обход ORM (пакетные UPDATE) передаются через note_change();
+2. после фиксации транзакции (after_commit) события попадают в кольцевой
+   буфер в памяти процесса (AUDIT_BUFFER_SIZE); отмененные транзакции
+   аудита не оставляют;
+3. фоновый поток записывает буфер пачками по AUDIT_BATCH_SIZE строк
+   одним многострочным INSERT, не реже раза в AUDIT_FLUSH_INTERVAL_SECONDS.
+
+Если буфер переполнен, самые старые события вытесняются (счетчик dropped
+в /api/audit/stats). Таблица audit_log разбита на дневные секции
+по changed_at; секции на будущие дни создает, а старые архивирует
+(NDJSON + gzip) и удаляет команда:
+    python audit.py partitions --days-ahead 7
+    python audit.py retention --days 180 --archive-dir /var/backups/audit
+
+Без секционирования (например, до применения audit_partitioning.sql)
+retention удаляет старые строки пачками DELETE.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import threading
+from collections import deque
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from enum import Enum
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from sqlalchemy import event, insert, inspect, select, text
+from sqlalchemy.orm import Session, attributes
+from sqlalchemy.orm.base import PASSIVE_NO_INITIALIZE
+
+from database import SessionLocal
+import models
+
+# trigger - аудит пишут триггеры БД, app - приложение (этот модуль)
+AUDIT_MODE = os.getenv("AUDIT_MODE", "trigger").lower()
+
+# Емкость кольцевого буфера событий
+AUDIT_BUFFER_SIZE = int(os.getenv("AUDIT_BUFFER_SIZE", "50000"))
+
+# Строк в одном INSERT
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+
+# Максимальная задержка записи события (секунды)
+AUDIT_FLUSH_INTERVAL_SECONDS = float(os.getenv("AUDIT_FLUSH_INTERVAL_SECONDS", "1.0"))
+
+# Срок хранения записей аудита (дни) и каталог архива
+AUDIT_RETENTION_DAYS = int(os.getenv("AUDIT_RETENTION_DAYS", "180"))
+AUDIT_ARCHIVE_DIR = os.getenv("AUDIT_ARCHIVE_DIR", "./audit_archive")
+
+# Строк в одном DELETE при очистке таблицы без секций
+AUDIT_RETENTION_CHUNK = 5000
+
+# Максимальное количество записей в ответе /api/audit/{table}/{id}
+AUDIT_QUERY_LIMIT = 500
+
+# Секция для строк после последней дневной секции
+MAX_PARTITION = "pmax"
+
+
+def app_mode() -> bool:
+    """Пишет ли аудит приложение"""
+    return AUDIT_MODE == "app"
+
+
+@dataclass(frozen=True)
+class AuditedTable:
+    """Таблица под аудитом: колонки и пользователь записи (как в триггерах init.sql)"""
+    name: str
+    insert_columns: Tuple[str, ...]
+    update_columns: Tuple[str, ...]
+    # Атрибут с ID пользователя для user_id записи аудита
+    user_attribute: Optional[str]
+    audit_delete: bool = True
+    # user_id для DELETE (триггер users не заполняет его)
+    user_on_delete: bool = True
+
+
+_USER_COLUMNS = ("email", "full_name", "is_active")
+_TEST_COLUMNS = ("title", "description", "time_limit_minutes", "passing_score", "is_active")
+
+AUDITED_TABLES: Dict[type, AuditedTable] = {
+    models.User: AuditedTable("users", _USER_COLUMNS, _USER_COLUMNS, "id", user_on_delete=False),
+    models.Test: AuditedTable("tests", _TEST_COLUMNS, _TEST_COLUMNS, "creator_id"),
+    models.TestSession: AuditedTable(
+        "test_sessions",
+        ("test_id", "user_id", "status", "started_at"),
+        ("status", "score", "correct_answers", "is_passed"),
+        "user_id",
+        audit_delete=False
+    ),
+}
+
+SESSION_COLUMNS = AUDITED_TABLES[models.TestSession].update_columns
+
+
+def _json_value(value: Any) -> Any:
+    """Значение колонки в JSON (в формате JSON_OBJECT триггеров)"""
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return value
+
+
+def _dump(values: Optional[Dict[str, Any]]) -> Optional[str]:
+    if values is None:
+        return None
+    return json.dumps({key: _json_value(value) for key, value in values.items()}, ensure_ascii=False)
+
+
+def audit_row(
+    table_name: str,
+    operation: models.AuditOperationType,
+    record_id: int,
+    old_values: Optional[Dict[str, Any]],
+    new_values: Optional[Dict[str, Any]],
+    user_id: Optional[int],
+    changed_at: Optional[datetime] = None
+) -> Dict[str, Any]:
+    """Строка audit_log для многострочного INSERT"""
+    return {
+        "table_name": table_name,
+        "operation_type": operation,
+        "record_id": record_id,
+        "old_values": _dump(old_values),
+        "new_values": _dump(new_values),
+        "user_id": user_id,
+        "changed_at": changed_at or datetime.now()
+    }
+
+
+# =====================================================
+# БУФЕР И ФОНОВАЯ ЗАПИСЬ
+# =====================================================
+
+class AuditPipeline:
+    """
+    Кольцевой буфер событий аудита с пакетной записью фоновым потоком
+    """
+
+    def __init__(
+        self,
+        capacity: int = AUDIT_BUFFER_SIZE,
+        batch_size: int = AUDIT_BATCH_SIZE,
+        interval_seconds: float = AUDIT_FLUSH_INTERVAL_SECONDS
+    ):
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self._buffer: Deque[Dict[str, Any]] = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.failures = 0
+
+    def enqueue(self, rows: List[Dict[str, Any]]):
+        """Добавить события зафиксированной транзакции"""
+        if not rows:
+            return
+        with self._lock:
+            overflow = len(self._buffer) + len(rows) - self._buffer.maxlen
+            if overflow > 0:
+                self.dropped += overflow
+            self._buffer.extend(rows)
+            pending = len(self._buffer)
+        if overflow > 0:
+            print(f"⚠️  Audit buffer full: {overflow} oldest events dropped")
+        if pending >= self.batch_size:
+            self._wakeup.set()
+
+    def _take_batch(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            count = min(self.batch_size, len(self._buffer))
+            return [self._buffer.popleft() for _ in range(count)]
+
+    def _requeue(self, rows: List[Dict[str, Any]]):
+        """Вернуть незаписанную пачку в начало буфера (если есть место)"""
+        with self._lock:
+            free = self._buffer.maxlen - len(self._buffer)
+            keep = rows[:free]
+            self.dropped += len(rows) - len(keep)
+            self._buffer.extendleft(reversed(keep))
+
+    def flush(self, session_factory: Callable[[], Session]) -> int:
+        """
+        Записать одну пачку событий
+
+        Args:
+            session_factory: Фабрика сессий (SessionLocal)
+
+        Returns:
+            Количество записанных строк (0, если буфер пуст или запись не удалась)
+        """
+        batch = self._take_batch()
+        if not batch:
+            return 0
+
+        db = session_factory()
+        try:
+            write_rows(db, batch)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            self._requeue(batch)
+            self.failures += 1
+            print(f"Audit flush failed, {len(batch)} events kept in buffer: {e}")
+            return 0
+        finally:
+            db.close()
+
+        self.written += len(batch)
+        self.batches += 1
+        return len(batch)
+
+    def start_worker(self, session_factory: Callable[[], Session]):
+        """
+        Запустить фоновый поток записи буфера
+
+        Args:
+            session_factory: Фабрика сессий (SessionLocal)
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+
+        def worker():
+            while not self._stop.is_set():
+                self._wakeup.wait(timeout=self.interval_seconds)
+                self._wakeup.clear()
+                while self.flush(session_factory) == self.batch_size:
+                    pass
+
+            # Оставшиеся события дописываются при остановке
+            while self.flush(session_factory):
+                pass
+
+        self._thread = threading.Thread(target=worker, name="audit-log", daemon=True)
+        self._thread.start()
+
+    def stop_worker(self):
+        """Остановить фоновый поток, дописав буфер"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+            self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Состояние буфера"""
+        with self._lock:
+            pending = len(self._buffer)
+        return {
+            "mode": AUDIT_MODE,
+            "pending": pending,
+            "capacity": self._buffer.maxlen,
+            "written": self.written,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "failures": self.failures,
+            "batch_size": self.batch_size,
+            "interval_seconds": self.interval_seconds
+        }
+
+
+# Общий буфер аудита приложения
+audit_pipeline = AuditPipeline()
+
+
+def write_rows(db: Session, rows: List[Dict[str, Any]]):
+    """Записать строки audit_log одним INSERT (без commit)"""
+    if rows:
+        db.execute(insert(models.AuditLog), rows)
+
+
+# =====================================================
+# СБОР ИЗМЕНЕНИЙ ИЗ СЕССИЙ SQLAlchemy
+# =====================================================
+
+def note_change(
+    session: Session,
+    table_name: str,
+    operation: models.AuditOperationType,
+    record_id: int,
+    old_values: Optional[Dict[str, Any]],
+    new_values: Optional[Dict[str, Any]],
+    user_id: Optional[int]
+):
+    """
+    Учесть изменение, выполненное в обход ORM (UPDATE через query/Core)
+
+    Событие попадает в буфер при фиксации транзакции, как и изменения,
+    собранные после flush. В режиме trigger ничего не делает.
+    """
+    if not app_mode():
+        return
+    session.info.setdefault("audit_rows", []).append(
+        audit_row(table_name, operation, record_id, old_values, new_values, user_id)
+    )
+
+
+def note_session_completed(session: Session, session_row: models.TestSession, values: Dict[str, Any]):
+    """Учесть завершение сессии тестирования (UPDATE test_sessions в обход ORM)"""
+    note_change(
+        session, "test_sessions", models.AuditOperationType.UPDATE, session_row.id,
+        {column: getattr(session_row, column) for column in SESSION_COLUMNS},
+        {column: values.get(column, getattr(session_row, column)) for column in SESSION_COLUMNS},
+        session_row.user_id
+    )
+
+
+def _values(obj: Any, columns: Tuple[str, ...], old: bool) -> Dict[str, Any]:
+    """
+    Значения колонок объекта до или после flush
+
+    Незагруженные атрибуты (например, серверные значения по умолчанию
+    у только что вставленной строки) пропускаются без запроса к БД.
+    """
+    values = {}
+    for column in columns:
+        history = attributes.get_history(obj, column, passive=PASSIVE_NO_INITIALIZE)
+        source = (history.deleted if old else history.added) or history.unchanged
+        if source:
+            values[column] = source[0]
+    return values
+
+
+def _record_id(obj: Any) -> int:
+    """ID записи (identity объекту назначается только после flush)"""
+    return inspect(obj).dict["id"]
+
+
+def _user_id(obj: Any, table: AuditedTable) -> Optional[int]:
+    if table.user_attribute is None:
+        return None
+    return inspect(obj).dict.get(table.user_attribute)
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_audit_changes(session: Session, flush_context):
+    """Собрать изменения таблиц под аудитом после flush"""
+    if not app_mode():
+        return
+
+    rows = session.info.setdefault("audit_rows", [])
+    changed_at = datetime.now()
+
+    for obj in session.new:
+        table = AUDITED_TABLES.get(type(obj))
+        if table is not None:
+            rows.append(audit_row(
+                table.name, models.AuditOperationType.INSERT, _record_id(obj),
+                None, _values(obj, table.insert_columns, old=False), _user_id(obj, table), changed_at
+            ))
+
+    for obj in session.dirty:
+        table = AUDITED_TABLES.get(type(obj))
+        if table is not None and session.is_modified(obj, include_collections=False):
+            rows.append(audit_row(
+                table.name, models.AuditOperationType.UPDATE, _record_id(obj),
+                _values(obj, table.update_columns, old=True),
+                _values(obj, table.update_columns, old=False),
+                _user_id(obj, table), changed_at
+            ))
+
+    for obj in session.deleted:
+        table = AUDITED_TABLES.get(type(obj))
+        if table is not None and table.audit_delete:
+            rows.append(audit_row(
+                table.name, models.AuditOperationType.DELETE, _record_id(obj),
+                _values(obj, table.update_columns, old=True), None,
+                _user_id(obj, table) if table.user_on_delete else None, changed_at
+            ))
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _enqueue_audit_changes(session: Session):
+    """Передать события зафиксированной транзакции в буфер"""
+    audit_pipeline.enqueue(session.info.pop("audit_rows", []))
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_audit_changes(session: Session):
+    """Забыть события отмененной транзакции"""
+    session.info.pop("audit_rows", None)
+
+
+# =====================================================
+# ЧТЕНИЕ
+# =====================================================
+
+def get_record_history(
+    db: Session,
+    table_name: str,
+    record_id: int,
+    limit: int = 100,
+    before_id: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    История изменений записи, от новых к старым
+
+    Запрос идет по индексу idx_table_record (table_name, record_id);
+    порядок по id берется из того же индекса, без сортировки.
+
+    Args:
+        db: Сессия базы данных
+        table_name: Таблица (users, tests, test_sessions)
+        record_id: ID записи
+        limit: Максимальное количество записей
+        before_id: Курсор - вернуть записи с id меньше указанного
+
+    Returns:
+        Записи аудита и курсор следующей страницы
+    """
+    log = models.AuditLog
+    limit = max(1, min(limit, AUDIT_QUERY_LIMIT))
+    query = select(
+        log.id, log.operation_type, log.old_values, log.new_values, log.user_id, log.changed_at
+    ).where(log.table_name == table_name, log.record_id == record_id)
+    if before_id is not None:
+        query = query.where(log.id < before_id)
+    rows = db.execute(query.order_by(log.id.desc()).limit(limit)).all()
+
+    def parse(value):
+        return json.loads(value) if isinstance(value, str) else value
+
+    return {
+        "table_name": table_name,
+        "record_id": record_id,
+        "changes": [
+            {
+                "id": row.id,
+                "operation": row.operation_type.value,
+                "old_values": parse(row.old_values),
+                "new_values": parse(row.new_values),
+                "user_id": row.user_id,
+                "changed_at": row.changed_at.strftime("%Y-%m-%d %H:%M:%S")
+            }
+            for row in rows
+        ],
+        "next_before_id": rows[-1].id if len(rows) == limit else None
+    }
+
+
+# =====================================================
+# СЕКЦИИ И ХРАНЕНИЕ
+# =====================================================
+
+def _partition_name(day: date) -> str:
+    return f"p{day:%Y%m%d}"
+
+
+def list_partitions(db: Session) -> List[Tuple[str, Optional[str]]]:
+    """
+    Секции audit_log по порядку: (имя, верхняя граница UNIX_TIMESTAMP или MAXVALUE)
+
+    Пустой список - таблица не секционирована (или БД не MySQL/MariaDB).
+    """
+    if db.get_bind().dialect.name not in ("mysql", "mariadb"):
+        return []
+    return [
+        (name, description)
+        for name, description in db.execute(text(
+            "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'audit_log' "
+            "AND PARTITION_NAME IS NOT NULL ORDER BY PARTITION_ORDINAL_POSITION"
+        ))
+    ]
+
+
+def ensure_partitions(db: Session, days_ahead: int = 7) -> List[str]:
+    """
+    Создать дневные секции до сегодняшнего дня + days_ahead
+
+    Новые секции отделяются от pmax одним REORGANIZE PARTITION;
+    pmax при регулярном запуске пуста, поэтому строки не переносятся.
+
+    Returns:
+        Имена созданных секций
+    """
+    partitions = [name for name, _ in list_partitions(db) if name != MAX_PARTITION]
+    if not partitions:
+        return []
+
+    last_day = datetime.strptime(partitions[-1][1:], "%Y%m%d").date()
+    target = date.today() + timedelta(days=days_ahead)
+    days = [last_day + timedelta(days=offset) for offset in range(1, (target - last_day).days + 1)]
+    if not days:
+        return []
+
+    definitions = ", ".join(
+        f"PARTITION `{_partition_name(day)}` VALUES LESS THAN "
+        f"(UNIX_TIMESTAMP('{day + timedelta(days=1):%Y-%m-%d} 00:00:00'))"
+        for day in days
+    )
+    db.execute(text(
+        f"ALTER TABLE audit_log REORGANIZE PARTITION `{MAX_PARTITION}` INTO "
+        f"({definitions}, PARTITION `{MAX_PARTITION}` VALUES LESS THAN MAXVALUE)"
+    ))
+    return [_partition_name(day) for day in days]
+
+
+_ARCHIVE_COLUMNS = "id, table_name, operation_type, record_id, old_values, new_values, user_id, changed_at"
+
+
+def _archive(db: Session, sql: str, params: Dict[str, Any], path: str) -> int:
+    """Выгрузить строки запроса в NDJSON + gzip потоком курсора"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    count = 0
+    result = db.connection().execution_options(stream_results=True, yield_per=AUDIT_RETENTION_CHUNK).execute(
+        text(sql), params
+    )
+    with gzip.open(path, "wt", encoding="utf-8") as archive:
+        for row in result:
+            record = dict(row._mapping)
+            record["changed_at"] = _json_value(record["changed_at"])
+            archive.write(json.dumps(record, ensure_ascii=False, default=_json_value) + "\n")
+            count += 1
+    return count
+
+
+def apply_retention(
+    db: Session,
+    retention_days: int = AUDIT_RETENTION_DAYS,
+    archive_dir: Optional[str] = AUDIT_ARCHIVE_DIR
+) -> Dict[str, Any]:
+    """
+    Удалить записи старше retention_days, предварительно выгрузив их в архив
+
+    Секционированная таблица: каждая устаревшая дневная секция
+    выгружается в свой файл и удаляется DROP PARTITION. Без секций:
+    строки выгружаются одним файлом и удаляются пачками DELETE.
+
+    Args:
+        db: Сессия базы данных
+        retention_days: Срок хранения (дни)
+        archive_dir: Каталог архива (None - без архивации)
+
+    Returns:
+        Удаленные секции, количество строк и файлы архива
+    """
+    cutoff = datetime.combine(date.today() - timedelta(days=retention_days), datetime.min.time())
+    summary: Dict[str, Any] = {"cutoff": cutoff.strftime("%Y-%m-%d"), "partitions": [], "rows": 0, "archives": []}
+
+    partitions = list_partitions(db)
+    if partitions:
+        cutoff_ts = db.execute(text("SELECT UNIX_TIMESTAMP(:cutoff)"), {"cutoff": cutoff}).scalar()
+        expired = [
+            name for name, description in partitions
+            if name != MAX_PARTITION and description != "MAXVALUE" and int(description) <= cutoff_ts
+        ]
+        # Последняя дневная секция не удаляется: pmax не может стать первой
+        if len(expired) == len(partitions) - 1:
+            expired = expired[:-1]
+        for name in expired:
+            if archive_dir is not None:
+                path = os.path.join(archive_dir, f"audit_log_{name}.ndjson.gz")
+                summary["rows"] += _archive(
+                    db, f"SELECT {_ARCHIVE_COLUMNS} FROM audit_log PARTITION (`{name}`) ORDER BY id", {}, path
+                )
+                summary["archives"].append(path)
+            db.execute(text(f"ALTER TABLE audit_log DROP PARTITION `{name}`"))
+            summary["partitions"].append(name)
+        return summary
+
+    log = models.AuditLog
+    if archive_dir is not None:
+        path = os.path.join(archive_dir, f"audit_log_before_{cutoff:%Y%m%d}.ndjson.gz")
+        archived = _archive(
+            db, f"SELECT {_ARCHIVE_COLUMNS} FROM audit_log WHERE changed_at < :cutoff ORDER BY id",
+            {"cutoff": cutoff}, path
+        )
+        if archived:
+            summary["archives"].append(path)
+
+    while True:
+        ids = db.execute(
+            select(log.id).where(log.changed_at < cutoff).order_by(log.id).limit(AUDIT_RETENTION_CHUNK)
+        ).scalars().all()
+        if not ids:
+            break
+        db.execute(log.__table__.delete().where(log.id.in_(ids)))
+        db.commit()
+        summary["rows"] += len(ids)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обслуживание журнала аудита")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    partitions = commands.add_parser("partitions", help="Создать дневные секции на будущие дни")
+    partitions.add_argument("--days-ahead", type=int, default=7, help="На сколько дней вперед")
+
+    retention = commands.add_parser("retention", help="Архивировать и удалить старые записи")
+    retention.add_argument("--days", type=int, default=AUDIT_RETENTION_DAYS, help="Срок хранения (дни)")
+    retention.add_argument("--archive-dir", default=AUDIT_ARCHIVE_DIR, help="Каталог архива")
+    retention.add_argument("--no-archive", action="store_true", help="Удалить без архивации")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.command == "partitions":
+            result = {"created": ensure_partitions(db, args.days_ahead)}
+        else:
+            result = apply_retention(db, args.days, None if args.no_archive else args.archive_dir)
+        db.commit()
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 """
 Модуль авторизации для TestGen MVP.
 Упрощенная авторизация без проверки пароля - только по email.
+Токены доступа подписаны HMAC (см. tokens.py) и проверяются без запроса к БД.
 """
 
 from fastapi import Depends, HTTPException, status
@@ -11,14 +12,15 @@ from typing import Optional
 from datetime import datetime, timedelta
 import os
 
-from database import get_db
+from database import get_db, run_db, DbSession
 import models
+from role_cache import role_resolver
+import tokens
 
 # OAuth2 схема для токенов
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login")
 
-# Простой "токен" - для MVP используем просто email
-# В production версии здесь должен быть JWT
+# Токен - подписанный HS256 JWT с id, email, именем и ролями пользователя
 
 
 class Token(BaseModel):
@@ -59,37 +61,62 @@ def get_user_by_email(db: Session, email: str) -> Optional[models.User]:
     return db.query(models.User).filter(models.User.email == email).first()
 
 
-def get_user_roles(db: Session, user_id: int) -> list[str]:
+def get_user_roles(db: Session, user_id: int, fresh: bool = False) -> list[str]:
     """
     Получить роли пользователя
 
+    Роли берутся из кэша в памяти; при промахе выполняется один запрос
+    к user_roles, названия ролей - из загруженного справочника.
+
     Args:
         db: Сессия базы данных
         user_id: ID пользователя
+        fresh: Прочитать роли из БД, минуя кэш
 
     Returns:
         Список названий ролей
     """
-    user_roles = db.query(models.UserRole).filter(
-        models.UserRole.user_id == user_id
-    ).all()
+    return role_resolver.get_roles(db, user_id, fresh=fresh)
 
-    roles = []
-    for ur in user_roles:
-        role = db.query(models.Role).filter(models.Role.id == ur.role_id).first()
-        if role:
-            roles.append(role.name)
 
-    return roles
+def get_users_roles(db: Session, user_ids: list[int]) -> dict[int, list[str]]:
+    """
+    Получить роли для списка пользователей одним пакетом
 
+    Args:
+        db: Сессия базы данных
+        user_ids: ID пользователей
 
-async def login_user(email: str, db: Session) -> Token:
+    Returns:
+        Словарь user_id -> список названий ролей
+    """
+    return role_resolver.get_roles_bulk(db, user_ids)
+
+
+async def login_user(email: str, db: DbSession) -> Token:
     """
     Авторизация пользователя только по email (без пароля для MVP)
 
     Args:
         email: Email пользователя
+        db: Сессия базы данных (синхронная или асинхронная)
+
+    Returns:
+        Token с информацией о пользователе
+
+    Raises:
+        HTTPException: Если пользователь не найден или неактивен
+    """
+    return await run_db(db, issue_token, email)
+
+
+def issue_token(db: Session, email: str) -> Token:
+    """
+    Найти пользователя по email и выпустить для него токен
+
+    Args:
         db: Сессия базы данных
+        email: Email пользователя
 
     Returns:
         Token с информацией о пользователе
@@ -113,12 +140,12 @@ async def login_user(email: str, db: Session) -> Token:
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    # Получаем роли пользователя
-    roles = get_user_roles(db, user.id)
+    # Роли для токена читаются из БД: кэш может не знать об изменениях,
+    # сделанных вне этого процесса
+    roles = get_user_roles(db, user.id, fresh=True)
 
-    # Для MVP используем email как токен
-    # В production версии здесь должен быть JWT токен
-    access_token = f"user_{user.id}_{user.email}"
+    # Подписанный токен с данными пользователя
+    access_token = tokens.create_access_token(user, roles)
 
     user_data = {
         "id": user.id,
@@ -134,22 +161,21 @@ async def login_user(email: str, db: Session) -> Token:
     )
 
 
-async def get_current_user(
-    token: str = Depends(oauth2_scheme),
-    db: Session = Depends(get_db)
-) -> models.User:
+def get_token_claims(token: str = Depends(oauth2_scheme)) -> dict:
     """
-    Получить текущего авторизованного пользователя по токену
+    Проверить токен и вернуть его claims
+
+    Проверка локальная: подпись, срок действия, отзыв токена
+    и деактивация пользователя (по кэшу в памяти).
 
     Args:
         token: Токен авторизации
-        db: Сессия базы данных
 
     Returns:
-        User
+        Словарь claims токена
 
     Raises:
-        HTTPException: Если токен невалиден или пользователь не найден
+        HTTPException: Если токен невалиден или пользователь неактивен
     """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -157,36 +183,54 @@ async def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
 
-    # Парсим токен (для MVP это просто "user_{id}_{email}")
     try:
-        if not token.startswith("user_"):
-            raise credentials_exception
+        claims = tokens.decode_access_token(token)
+    except tokens.InvalidTokenError:
+        raise credentials_exception
+
+    if tokens.revocation_cache.is_revoked(claims):
+        raise credentials_exception
+
+    if tokens.revocation_cache.is_user_inactive(int(claims["sub"])):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Пользователь неактивен"
+        )
 
-        parts = token.split("_")
-        if len(parts) < 3:
-            raise credentials_exception
+    return claims
 
-        user_id = int(parts[1])
-        email = "_".join(parts[2:])  # На случай если в email есть _
 
-        user = db.query(models.User).filter(
-            models.User.id == user_id,
-            models.User.email == email
-        ).first()
+async def get_current_user(
+    claims: dict = Depends(get_token_claims)
+) -> models.User:
+    """
+    Получить текущего авторизованного пользователя по токену
 
-        if not user:
-            raise credentials_exception
+    Пользователь собирается из claims токена без запроса к БД;
+    объект не привязан к сессии.
 
-        if not user.is_active:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Пользователь неактивен"
-            )
+    Args:
+        claims: Claims проверенного токена
 
-        return user
+    Returns:
+        User
 
-    except (ValueError, IndexError):
-        raise credentials_exception
+    Raises:
+        HTTPException: Если токен невалиден или пользователь неактивен
+    """
+    return tokens.user_from_claims(claims)
+
+
+def logout_user(db: Session, claims: dict):
+    """
+    Отозвать токен текущего пользователя
+
+    Args:
+        db: Сессия базы данных
+        claims: Claims проверенного токена
+    """
+    tokens.revocation_cache.revoke_token(db, claims)
+    db.commit()
 
 
 async def get_current_active_user(
@@ -212,6 +256,35 @@ async def get_current_active_user(
     return current_user
 
 
+# Роли с доступом к данным всех пользователей (выгрузки, аналитика)
+STAFF_ROLES = ("admin", "teacher")
+
+
+async def get_current_staff_user(
+    claims: dict = Depends(get_token_claims)
+) -> models.User:
+    """
+    Получить текущего пользователя с ролью admin или teacher
+
+    Роли берутся из claims токена, без запроса к БД.
+
+    Args:
+        claims: Claims проверенного токена
+
+    Returns:
+        User
+
+    Raises:
+        HTTPException: Если у пользователя нет нужной роли
+    """
+    if not set(claims.get("roles", [])) & set(STAFF_ROLES):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Требуется роль: admin или teacher"
+        )
+    return tokens.user_from_claims(claims)
+
+
 def check_user_role(user: models.User, required_role: str, db: Session) -> bool:
     """
     Проверить, есть ли у пользователя требуемая роль
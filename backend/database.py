@@ -4,10 +4,14 @@
 """
 
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from typing import Generator
+from sqlalchemy.orm import Session, sessionmaker
+from starlette.concurrency import run_in_threadpool
+from typing import Any, AsyncGenerator, Callable, Dict, Generator, Optional, Union
+
+from pool_metrics import InstrumentedAsyncQueuePool, InstrumentedQueuePool, pool_status
 
 # Получение параметров подключения из переменных окружения
 DB_HOST = os.getenv("DB_HOST", "localhost")
@@ -20,17 +24,47 @@ DB_NAME = os.getenv("DB_NAME", "testgen")
 # Используем pymysql драйвер для работы с MariaDB
 DATABASE_URL = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}?charset=utf8mb4"
 
+# Профиль движка задается переменными окружения
+# DB_ECHO: false - без логирования SQL, true - логировать запросы, debug - запросы и результаты
+# DB_POOL_SIZE / DB_MAX_OVERFLOW: постоянные и дополнительные соединения пула
+#   (на один процесс uvicorn; общее число соединений = воркеры * (size + overflow))
+# DB_POOL_TIMEOUT: сколько секунд ждать свободного соединения
+# DB_POOL_RECYCLE: через сколько секунд пересоздавать соединение
+# DB_POOL_PRE_PING: проверять соединение перед использованием
+
+
+def _env_bool(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ("1", "true", "yes")
+
+
+def _echo_setting(value: str) -> Union[bool, str]:
+    value = value.lower()
+    if value == "debug":
+        return "debug"
+    return value in ("1", "true", "yes")
+
+
+DB_ECHO = _echo_setting(os.getenv("DB_ECHO", "false"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))
+DB_POOL_PRE_PING = _env_bool("DB_POOL_PRE_PING", "true")
+
+ENGINE_OPTIONS: Dict[str, Any] = {
+    "echo": DB_ECHO,
+    "pool_pre_ping": DB_POOL_PRE_PING,
+    "pool_recycle": DB_POOL_RECYCLE,
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_timeout": DB_POOL_TIMEOUT
+}
+
 # Создание движка SQLAlchemy
-# echo=True включает логирование SQL-запросов (полезно для отладки)
-# pool_pre_ping=True проверяет соединение перед использованием
-# pool_recycle=3600 пересоздает соединения каждый час
 engine = create_engine(
     DATABASE_URL,
-    echo=True,  # Для продакшена поменять на False
-    pool_pre_ping=True,
-    pool_recycle=3600,
-    pool_size=10,
-    max_overflow=20
+    poolclass=InstrumentedQueuePool,
+    **ENGINE_OPTIONS
 )
 
 # Создание фабрики сессий
@@ -42,6 +76,32 @@ SessionLocal = sessionmaker(
     bind=engine
 )
 
+# Асинхронный режим доступа к БД (DB_ASYNC=true)
+# Горячие endpoints выполняют запросы через AsyncSession на драйвере aiomysql,
+# не блокируя event loop uvicorn
+DB_ASYNC = _env_bool("DB_ASYNC", "false")
+
+ASYNC_DATABASE_URL = f"mysql+aiomysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}?charset=utf8mb4"
+
+async_engine = None
+AsyncSessionLocal: Optional[async_sessionmaker] = None
+
+if DB_ASYNC:
+    async_engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        poolclass=InstrumentedAsyncQueuePool,
+        **ENGINE_OPTIONS
+    )
+
+    # Синхронный класс сессии общий с SessionLocal, чтобы обработчики
+    # событий сессий (инвалидация кэшей) срабатывали в обоих режимах
+    AsyncSessionLocal = async_sessionmaker(
+        bind=async_engine,
+        sync_session_class=SessionLocal.class_,
+        autoflush=False,
+        expire_on_commit=False
+    )
+
 # Базовый класс для всех моделей SQLAlchemy
 Base = declarative_base()
 
@@ -68,6 +128,58 @@ def get_db() -> Generator:
         db.close()
 
 
+async def get_async_db() -> AsyncGenerator[AsyncSession, None]:
+    """
+    Генератор асинхронной сессии базы данных.
+
+    Yields:
+        AsyncSession: Асинхронная сессия SQLAlchemy
+
+    Raises:
+        RuntimeError: Если асинхронный режим не включен (DB_ASYNC)
+    """
+    if AsyncSessionLocal is None:
+        raise RuntimeError("Async database mode is disabled (set DB_ASYNC=true)")
+
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# Тип сессии, которую получают горячие endpoints
+DbSession = Union[Session, AsyncSession]
+
+# Dependency для горячих endpoints: асинхронная или синхронная сессия
+# в зависимости от DB_ASYNC
+get_session = get_async_db if DB_ASYNC else get_db
+
+
+async def run_db(db: DbSession, fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Выполнить синхронную функцию работы с БД, не блокируя event loop.
+
+    Для AsyncSession функция выполняется через run_sync на асинхронном
+    соединении, для обычной Session - в пуле потоков.
+    Функция должна сама загрузить все нужные данные и вернуть
+    готовый результат (ленивая загрузка после возврата недоступна
+    в асинхронном режиме).
+
+    Args:
+        db: Сессия (синхронная или асинхронная)
+        fn: Функция вида fn(session, *args, **kwargs)
+
+    Returns:
+        Результат fn
+
+    Example:
+        @app.get("/items")
+        async def get_items(db = Depends(get_session)):
+            return await run_db(db, lambda s: [i.id for i in s.query(Item)])
+    """
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args, **kwargs)
+    return await run_in_threadpool(fn, db, *args, **kwargs)
+
+
 def init_db():
     """
     Инициализация базы данных.
@@ -93,9 +205,34 @@ def check_db_connection() -> bool:
     """
     try:
         with engine.connect() as connection:
-            connection.execute("SELECT 1")
+            connection.execute(text("SELECT 1"))
         print("Database connection successful!")
         return True
     except Exception as e:
         print(f"Database connection failed: {e}")
         return False
+
+
+def get_pool_metrics() -> Dict[str, Any]:
+    """
+    Метрики пулов соединений (синхронного и асинхронного, если включен).
+
+    Returns:
+        Словарь с профилем движка и состоянием пулов
+    """
+    metrics = {
+        "profile": {
+            "echo": DB_ECHO,
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "pool_timeout": DB_POOL_TIMEOUT,
+            "pool_recycle": DB_POOL_RECYCLE,
+            "pool_pre_ping": DB_POOL_PRE_PING
+        },
+        "sync": pool_status(engine.pool)
+    }
+
+    if async_engine is not None:
+        metrics["async"] = pool_status(async_engine.pool)
+
+    return metrics
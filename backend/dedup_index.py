@@ -0,0 +1,347 @@
+"""
+Поиск почти одинаковых вопросов (MinHash + LSH).
+
+Для каждого вопроса текст вопроса и вариантов ответа разбивается на
+символьные 5-граммы, по ним считается MinHash-подпись из DEDUP_NUM_PERM
+значений. От каждого значения хранятся младшие 16 бит (b-bit MinHash),
+поэтому подписи занимают 128 байт на вопрос в одном NumPy-массиве.
+
+Подпись делится на полосы по 4 значения; 4 x 16 бит - это ровно один
+64-битный ключ полосы. Кандидаты в дубликаты - вопросы, совпавшие хотя
+бы в одной полосе; они ищутся двоичным поиском по отсортированным ключам
+каждой полосы (плюс небольшой дельта-сегмент недавних вопросов), без
+попарного сравнения всего банка. Кандидаты проверяются по доле
+совпавших значений подписи (оценка коэффициента Жаккара).
+
+Документы поступают от поискового индекса (search_index.add_listener):
+при построении и при каждом инкрементальном обновлении.
+"""
+
+import re
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+import search_index
+
+# Количество хеш-функций MinHash
+DEDUP_NUM_PERM = 64
+
+# Значений подписи в одной полосе LSH (4 x 16 бит = 64-битный ключ)
+DEDUP_BAND_ROWS = 4
+
+# Количество полос LSH
+DEDUP_BANDS = DEDUP_NUM_PERM // DEDUP_BAND_ROWS
+
+# Длина символьной шинглы
+DEDUP_SHINGLE_SIZE = 5
+
+# Порог сходства по умолчанию (оценка коэффициента Жаккара)
+DEDUP_THRESHOLD = 0.6
+
+# Сколько новых вопросов держать в дельта-сегменте до пересборки полос
+DEDUP_MERGE_ROWS = 20000
+
+# Простое число Мерсенна 2^31 - 1 для универсального хеширования
+_PRIME = np.uint64((1 << 31) - 1)
+_BASE = np.uint64(1009)
+
+_rng = np.random.RandomState(20240601)
+_PERM_A = _rng.randint(1, (1 << 31) - 1, size=DEDUP_NUM_PERM).astype(np.uint64)
+_PERM_B = _rng.randint(0, (1 << 31) - 1, size=DEDUP_NUM_PERM).astype(np.uint64)
+
+_NON_WORD_RE = re.compile(r"\W+", re.UNICODE)
+
+
+def document_text(question_text: str, answers: Iterable[str]) -> str:
+    """
+    Нормализованный текст вопроса с вариантами ответа
+
+    Варианты сортируются, чтобы перестановка ответов не влияла на подпись.
+    """
+    parts = [question_text or ""] + sorted(answer or "" for answer in answers)
+    return _NON_WORD_RE.sub(" ", search_index.normalize(" ".join(parts))).strip()
+
+
+def shingle_hashes(text: str) -> np.ndarray:
+    """
+    Хеши символьных 5-грамм текста (векторно, по модулю 2^31 - 1)
+
+    Args:
+        text: Нормализованный текст
+
+    Returns:
+        Массив хешей uint64
+    """
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    if len(codes) < DEDUP_SHINGLE_SIZE:
+        codes = np.concatenate((codes, np.zeros(DEDUP_SHINGLE_SIZE - len(codes), dtype=np.uint64)))
+
+    windows = len(codes) - DEDUP_SHINGLE_SIZE + 1
+    hashes = np.zeros(windows, dtype=np.uint64)
+    for offset in range(DEDUP_SHINGLE_SIZE):
+        hashes = (hashes * _BASE + codes[offset:offset + windows]) % _PRIME
+    return hashes
+
+
+def minhash_signature(text: str) -> np.ndarray:
+    """
+    16-битная MinHash-подпись текста
+
+    Args:
+        text: Нормализованный текст
+
+    Returns:
+        Массив uint16 длины DEDUP_NUM_PERM
+    """
+    # Повторы шингл не меняют минимум, поэтому дедупликация не нужна
+    hashes = shingle_hashes(text)
+    permuted = (_PERM_A[:, None] * hashes[None, :] + _PERM_B[:, None]) % _PRIME
+    return (permuted.min(axis=1) & np.uint64(0xFFFF)).astype(np.uint16)
+
+
+def signature_similarity(signature: np.ndarray, others: np.ndarray) -> np.ndarray:
+    """Доля совпавших значений подписи с каждой из других подписей"""
+    return (others == signature).mean(axis=1)
+
+
+class DuplicateIndex:
+    """
+    Хранилище MinHash-подписей с LSH-полосами
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        """Очистить индекс"""
+        with self._lock:
+            self._signatures = np.zeros((1024, DEDUP_NUM_PERM), dtype=np.uint16)
+            self._qids = np.zeros(1024, dtype=np.int64)
+            self._alive = np.zeros(1024, dtype=np.bool_)
+            self._size = 0
+            # question_id -> строка; документ-источник -> вопросы
+            self._rows: Dict[int, int] = {}
+            self._sources: Dict[int, Optional[int]] = {}
+            self._by_document: Dict[Optional[int], Set[int]] = {}
+            # Отсортированные ключи полос по строкам [0, _merged)
+            self._band_keys: List[np.ndarray] = []
+            self._band_rows: List[np.ndarray] = []
+            self._merged = 0
+            # Дельта-сегмент: ключ полосы -> строки, добавленные после пересборки
+            self._delta: List[Dict[int, List[int]]] = [{} for _ in range(DEDUP_BANDS)]
+            self._dead = 0
+
+    def _grow(self):
+        """Удвоить емкость массивов (под блокировкой)"""
+        capacity = len(self._qids) * 2
+        signatures = np.zeros((capacity, DEDUP_NUM_PERM), dtype=np.uint16)
+        signatures[:self._size] = self._signatures[:self._size]
+        qids = np.zeros(capacity, dtype=np.int64)
+        qids[:self._size] = self._qids[:self._size]
+        alive = np.zeros(capacity, dtype=np.bool_)
+        alive[:self._size] = self._alive[:self._size]
+        self._signatures, self._qids, self._alive = signatures, qids, alive
+
+    def _band_keys_of(self, signature: np.ndarray) -> np.ndarray:
+        """64-битные ключи полос подписи"""
+        return np.ascontiguousarray(signature).view(np.uint64)
+
+    def _remove(self, question_id: int):
+        """Пометить вопрос удаленным (под блокировкой)"""
+        row = self._rows.pop(question_id, None)
+        if row is None:
+            return
+        self._alive[row] = False
+        self._dead += 1
+        source = self._sources.pop(question_id, None)
+        members = self._by_document.get(source)
+        if members is not None:
+            members.discard(question_id)
+            if not members:
+                del self._by_document[source]
+
+    def add_documents(self, documents: Iterable[Dict[str, Any]]):
+        """
+        Добавить или обновить вопросы
+
+        Args:
+            documents: Документы в формате search_index (id, question_text,
+                answers, source_document_id)
+        """
+        prepared = [
+            (document, minhash_signature(document_text(document["question_text"], document["answers"])))
+            for document in documents
+        ]
+        with self._lock:
+            for document, signature in prepared:
+                question_id = document["id"]
+                self._remove(question_id)
+
+                if self._size == len(self._qids):
+                    self._grow()
+                row = self._size
+                self._size += 1
+                self._signatures[row] = signature
+                self._qids[row] = question_id
+                self._alive[row] = True
+                self._rows[question_id] = row
+
+                source = document["source_document_id"]
+                self._sources[question_id] = source
+                self._by_document.setdefault(source, set()).add(question_id)
+
+                for band, key in enumerate(self._band_keys_of(signature).tolist()):
+                    self._delta[band].setdefault(key, []).append(row)
+
+            if self._size - self._merged >= DEDUP_MERGE_ROWS:
+                self._merge()
+
+    def remove_documents(self, question_ids: Iterable[int]):
+        """Удалить вопросы из индекса"""
+        with self._lock:
+            for question_id in question_ids:
+                self._remove(question_id)
+
+    def merge(self):
+        """Перенести дельта-сегмент в отсортированные полосы"""
+        with self._lock:
+            if self._merged < self._size:
+                self._merge()
+
+    def _merge(self):
+        """Пересобрать отсортированные ключи полос (под блокировкой)"""
+        if self._dead > 1000 and self._dead * 4 > len(self._rows):
+            self._compact()
+
+        keys = self._signatures[:self._size].view(np.uint64)
+        self._band_keys, self._band_rows = [], []
+        for band in range(DEDUP_BANDS):
+            order = np.argsort(keys[:, band], kind="stable").astype(np.int32)
+            self._band_rows.append(order)
+            self._band_keys.append(keys[order, band])
+        self._merged = self._size
+        self._delta = [{} for _ in range(DEDUP_BANDS)]
+
+    def _compact(self):
+        """Удалить строки удаленных вопросов (под блокировкой)"""
+        alive = self._alive[:self._size]
+        signatures = self._signatures[:self._size][alive]
+        qids = self._qids[:self._size][alive]
+        self._size = len(qids)
+        capacity = max(1024, self._size * 2)
+        self._signatures = np.zeros((capacity, DEDUP_NUM_PERM), dtype=np.uint16)
+        self._signatures[:self._size] = signatures
+        self._qids = np.zeros(capacity, dtype=np.int64)
+        self._qids[:self._size] = qids
+        self._alive = np.zeros(capacity, dtype=np.bool_)
+        self._alive[:self._size] = True
+        self._rows = {int(question_id): row for row, question_id in enumerate(qids)}
+        self._dead = 0
+
+    def _candidates(self, row: int) -> np.ndarray:
+        """Строки, совпавшие с подписью хотя бы в одной полосе (под блокировкой)"""
+        found = []
+        for band, key in enumerate(self._band_keys_of(self._signatures[row]).tolist()):
+            if self._band_keys:
+                keys = self._band_keys[band]
+                start = np.searchsorted(keys, np.uint64(key), side="left")
+                end = np.searchsorted(keys, np.uint64(key), side="right")
+                if end > start:
+                    found.append(self._band_rows[band][start:end])
+            delta = self._delta[band].get(key)
+            if delta:
+                found.append(np.asarray(delta, dtype=np.int32))
+
+        if not found:
+            return np.zeros(0, dtype=np.int32)
+        candidates = np.unique(np.concatenate(found))
+        candidates = candidates[self._alive[candidates]]
+        return candidates[candidates != row]
+
+    def similar(self, question_id: int, threshold: float = DEDUP_THRESHOLD) -> List[Tuple[int, float]]:
+        """
+        Вопросы, похожие на данный
+
+        Args:
+            question_id: ID вопроса
+            threshold: Минимальная оценка сходства
+
+        Returns:
+            Список (question_id, сходство) по убыванию сходства
+        """
+        with self._lock:
+            row = self._rows.get(question_id)
+            if row is None:
+                return []
+            candidates = self._candidates(row)
+            if not len(candidates):
+                return []
+            similarity = signature_similarity(self._signatures[row], self._signatures[candidates])
+            keep = similarity >= threshold
+            pairs = zip(self._qids[candidates[keep]].tolist(), similarity[keep].tolist())
+            return sorted(pairs, key=lambda pair: (-pair[1], pair[0]))
+
+    def document_clusters(
+        self,
+        document_id: Optional[int],
+        threshold: float = DEDUP_THRESHOLD,
+        within_document: bool = True
+    ) -> List[List[int]]:
+        """
+        Кластеры почти одинаковых вопросов документа
+
+        Кластер - компонента связности графа "сходство >= threshold".
+
+        Args:
+            document_id: ID документа-источника (None - вопросы без документа)
+            threshold: Минимальная оценка сходства
+            within_document: Искать дубликаты только среди вопросов документа
+
+        Returns:
+            Список кластеров (списки question_id, не меньше двух в каждом)
+        """
+        with self._lock:
+            members = sorted(self._by_document.get(document_id, ()))
+            parent: Dict[int, int] = {}
+
+            def find(question_id: int) -> int:
+                root = parent.setdefault(question_id, question_id)
+                while root != parent[root]:
+                    parent[root] = parent[parent[root]]
+                    root = parent[root]
+                return root
+
+            for question_id in members:
+                for other_id, _ in self.similar(question_id, threshold):
+                    if within_document and self._sources.get(other_id) != document_id:
+                        continue
+                    first, second = find(question_id), find(other_id)
+                    if first != second:
+                        parent[max(first, second)] = min(first, second)
+
+            clusters: Dict[int, List[int]] = {}
+            for question_id in parent:
+                clusters.setdefault(find(question_id), []).append(question_id)
+
+        return sorted(
+            (sorted(cluster) for cluster in clusters.values() if len(cluster) > 1),
+            key=lambda cluster: (-len(cluster), cluster[0])
+        )
+
+    def info(self) -> Dict[str, Any]:
+        """Состояние индекса"""
+        with self._lock:
+            return {
+                "questions": len(self._rows),
+                "deleted": self._dead,
+                "delta_rows": self._size - self._merged,
+                "signature_bytes": int(self._signatures[:self._size].nbytes)
+            }
+
+
+# Общий индекс дубликатов приложения
+duplicate_index = DuplicateIndex()
+search_index.search_index.add_listener(duplicate_index)
@@ -0,0 +1,315 @@
+"""
+Потоковая выгрузка банка вопросов, сессий и ответов в NDJSON и CSV.
+
+Строки читаются курсором на стороне сервера (yield_per включает
+stream_results, для pymysql это SSCursor) и сразу кодируются в вывод,
+поэтому потребление памяти не зависит от размера таблицы: в памяти
+одновременно находятся одна пачка строк курсора и один буфер вывода.
+
+Каждая выгрузка открывает собственную сессию: ответ передается клиенту
+уже после выхода из endpoint, и сессия запроса к этому времени может
+быть закрыта.
+"""
+
+import csv
+import io
+import json
+import os
+from decimal import Decimal
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+import models
+
+# Сколько строк читать из курсора за одно обращение к серверу
+EXPORT_YIELD_PER = int(os.getenv("EXPORT_YIELD_PER", "2000"))
+
+# Размер куска ответа, отдаваемого клиенту
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+FORMAT_NDJSON = "ndjson"
+FORMAT_CSV = "csv"
+EXPORT_FORMATS = (FORMAT_NDJSON, FORMAT_CSV)
+
+MEDIA_TYPES = {
+    FORMAT_NDJSON: "application/x-ndjson",
+    FORMAT_CSV: "text/csv; charset=utf-8"
+}
+
+# Колонки CSV выгрузки вопросов: одна строка на вариант ответа
+QUESTION_CSV_COLUMNS = [
+    "question_id", "question", "source_document_id", "is_approved",
+    "approved_at", "created_at", "answer_id", "answer_order", "answer_text", "is_correct"
+]
+
+SESSION_COLUMNS = [
+    "id", "test_id", "user_id", "status", "started_at", "completed_at",
+    "time_spent_seconds", "score", "total_questions", "correct_answers", "is_passed"
+]
+
+ANSWER_COLUMNS = [
+    "id", "test_session_id", "question_id", "selected_option_id", "is_correct", "answered_at"
+]
+
+
+def export_value(value: Any) -> Any:
+    """Значение колонки в виде, пригодном для JSON и CSV"""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, Decimal):
+        return float(value)
+    if hasattr(value, "strftime"):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    # Enum-статусы сессий
+    return getattr(value, "value", str(value))
+
+
+def stream_rows(db: Session, statement, yield_per: int = EXPORT_YIELD_PER) -> Iterator[Tuple]:
+    """
+    Строки запроса через курсор на стороне сервера
+
+    Args:
+        db: Сессия базы данных
+        statement: SELECT
+        yield_per: Размер пачки строк курсора
+
+    Yields:
+        Кортежи значений колонок
+    """
+    result = db.execute(statement.execution_options(yield_per=yield_per))
+    try:
+        for row in result:
+            yield tuple(row)
+    finally:
+        result.close()
+
+
+# =====================================================
+# ЗАПРОСЫ ВЫГРУЗОК
+# =====================================================
+
+def question_statement(approved: Optional[bool] = None, source_document_id: Optional[int] = None):
+    """
+    Вопросы с вариантами ответов одним JOIN-запросом
+
+    Сортировка только по questions.id: порядок берется из первичного
+    ключа без сортировки всего результата на сервере; варианты одного
+    вопроса упорядочиваются при группировке.
+    """
+    question = models.Question
+    option = models.AnswerOption
+    statement = select(
+        question.id,
+        question.question_text,
+        question.source_document_id,
+        question.is_approved,
+        question.approved_at,
+        question.created_at,
+        option.id,
+        option.option_order,
+        option.answer_text,
+        option.is_correct
+    ).outerjoin(option, option.question_id == question.id).order_by(question.id)
+
+    if approved is not None:
+        statement = statement.where(question.is_approved == approved)
+    if source_document_id is not None:
+        statement = statement.where(question.source_document_id == source_document_id)
+    return statement
+
+
+def session_statement(test_id: Optional[int] = None, user_id: Optional[int] = None):
+    """Сессии прохождения тестов"""
+    table = models.TestSession
+    statement = select(*[getattr(table, column) for column in SESSION_COLUMNS]).order_by(table.id)
+    if test_id is not None:
+        statement = statement.where(table.test_id == test_id)
+    if user_id is not None:
+        statement = statement.where(table.user_id == user_id)
+    return statement
+
+
+def answer_statement(test_id: Optional[int] = None, session_id: Optional[int] = None):
+    """Ответы студентов"""
+    table = models.UserAnswer
+    statement = select(*[getattr(table, column) for column in ANSWER_COLUMNS]).order_by(table.id)
+    if session_id is not None:
+        statement = statement.where(table.test_session_id == session_id)
+    if test_id is not None:
+        statement = statement.join(
+            models.TestSession, models.TestSession.id == table.test_session_id
+        ).where(models.TestSession.test_id == test_id)
+    return statement
+
+
+def group_questions(rows: Iterable[Tuple]) -> Iterator[Tuple[Tuple, List[Tuple]]]:
+    """
+    Сгруппировать строки JOIN-запроса по вопросам
+
+    Yields:
+        (колонки вопроса, отсортированные колонки вариантов ответа)
+    """
+    current: Optional[Tuple] = None
+    options: List[Tuple] = []
+    for row in rows:
+        if current is None or row[0] != current[0]:
+            if current is not None:
+                yield current, sorted(options, key=lambda option: (option[1] or 0, option[0]))
+            current = row[:6]
+            options = []
+        if row[6] is not None:
+            options.append(row[6:])
+    if current is not None:
+        yield current, sorted(options, key=lambda option: (option[1] or 0, option[0]))
+
+
+# =====================================================
+# КОДИРОВАНИЕ
+# =====================================================
+
+def _dump_line(payload: Dict[str, Any]) -> str:
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+def buffered(lines: Iterable[str], chunk_bytes: int = EXPORT_CHUNK_BYTES) -> Iterator[bytes]:
+    """Склеить строки вывода в куски примерно по chunk_bytes"""
+    buffer: List[str] = []
+    size = 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= chunk_bytes:
+            yield "".join(buffer).encode("utf-8")
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+
+def csv_lines(header: Sequence[str], rows: Iterable[Sequence[Any]]) -> Iterator[str]:
+    """Строки CSV с заголовком"""
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+
+    def line(values: Sequence[Any]) -> str:
+        writer.writerow(values)
+        text = output.getvalue()
+        output.seek(0)
+        output.truncate()
+        return text
+
+    yield line(header)
+    for row in rows:
+        yield line([export_value(value) for value in row])
+
+
+def question_ndjson(rows: Iterable[Tuple]) -> Iterator[str]:
+    """Вопрос с вариантами ответа на строку, в формате ответа /api/questions"""
+    for question, options in group_questions(rows):
+        yield _dump_line({
+            "id": question[0],
+            "question": question[1],
+            "source_document_id": question[2],
+            "is_approved": bool(question[3]),
+            "approved_at": export_value(question[4]),
+            "created_at": export_value(question[5]),
+            "answers": [
+                {
+                    "id": option[0],
+                    "text": option[2],
+                    "is_correct": bool(option[3]),
+                    "order": option[1]
+                }
+                for option in options
+            ]
+        })
+
+
+def question_csv(rows: Iterable[Tuple]) -> Iterator[str]:
+    """Строка CSV на вариант ответа (вопрос без вариантов - одна строка)"""
+    def flat() -> Iterator[Tuple]:
+        for question, options in group_questions(rows):
+            if not options:
+                yield question + (None, None, None, None)
+            for option in options:
+                yield question + option
+
+    return csv_lines(QUESTION_CSV_COLUMNS, flat())
+
+
+def table_ndjson(columns: Sequence[str], rows: Iterable[Tuple]) -> Iterator[str]:
+    """Строка таблицы как JSON-объект"""
+    for row in rows:
+        yield _dump_line({column: export_value(value) for column, value in zip(columns, row)})
+
+
+# =====================================================
+# ВЫГРУЗКИ
+# =====================================================
+
+def _export(statement, encode: Callable[[Iterable[Tuple]], Iterator[str]]) -> Iterator[bytes]:
+    """Выполнить запрос в собственной сессии и отдавать закодированные куски"""
+    db = SessionLocal()
+    try:
+        yield from buffered(encode(stream_rows(db, statement)))
+    finally:
+        db.close()
+
+
+def export_questions(
+    fmt: str,
+    approved: Optional[bool] = None,
+    source_document_id: Optional[int] = None
+) -> Iterator[bytes]:
+    """
+    Выгрузка вопросов с вариантами ответов
+
+    Args:
+        fmt: ndjson или csv
+        approved: Фильтр по статусу одобрения
+        source_document_id: Фильтр по документу-источнику
+
+    Yields:
+        Куски тела ответа
+    """
+    encode = question_ndjson if fmt == FORMAT_NDJSON else question_csv
+    return _export(question_statement(approved, source_document_id), encode)
+
+
+def export_sessions(fmt: str, test_id: Optional[int] = None, user_id: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Выгрузка сессий прохождения тестов
+
+    Args:
+        fmt: ndjson или csv
+        test_id: Фильтр по тесту
+        user_id: Фильтр по пользователю
+
+    Yields:
+        Куски тела ответа
+    """
+    return _export(session_statement(test_id, user_id), _table_encoder(fmt, SESSION_COLUMNS))
+
+
+def export_answers(fmt: str, test_id: Optional[int] = None, session_id: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Выгрузка ответов студентов
+
+    Args:
+        fmt: ndjson или csv
+        test_id: Фильтр по тесту
+        session_id: Фильтр по сессии
+
+    Yields:
+        Куски тела ответа
+    """
+    return _export(answer_statement(test_id, session_id), _table_encoder(fmt, ANSWER_COLUMNS))
+
+
+def _table_encoder(fmt: str, columns: Sequence[str]) -> Callable[[Iterable[Tuple]], Iterator[str]]:
+    if fmt == FORMAT_NDJSON:
+        return lambda rows: table_ndjson(columns, rows)
+    return lambda rows: csv_lines(columns, rows)
@@ -0,0 +1,188 @@
+"""
+Быстрая сериализация ответов горячих endpoints в JSON.
+
+Ответы собираются прямо из кортежей строк БД (без Pydantic-моделей
+и jsonable_encoder) и сериализуются orjson одним вызовом. Для каждого
+endpoint есть свой кодировщик с фиксированной схемой; порядок ключей
+и формат совпадают с прежними ответами FastAPI, поэтому тела ответов
+(и их ETag) побайтно совпадают со stdlib json.
+
+Если orjson не установлен, используется json из стандартной библиотеки
+с теми же параметрами.
+"""
+
+import json
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson указан в requirements.txt
+    orjson = None
+
+
+def dumps(payload: Any) -> bytes:
+    """Сериализация в JSON в том же формате, что и JSONResponse FastAPI"""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(
+        payload,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":")
+    ).encode("utf-8")
+
+
+def answers_payload(options: Iterable[Tuple]) -> List[Dict[str, Any]]:
+    """Варианты ответа (id, answer_text, is_correct, option_order) в формате AnswerOptionResponse"""
+    return [
+        {"id": option_id, "text": answer_text, "is_correct": bool(is_correct), "order": option_order}
+        for option_id, answer_text, is_correct, option_order in options
+    ]
+
+
+def encode_question_page(
+    rows: List[Any],
+    options: Dict[int, List[Tuple]],
+    total: Optional[int],
+    limit: int,
+    offset: int,
+    next_cursor: Optional[str]
+) -> bytes:
+    """Тело ответа /api/questions"""
+    return dumps({
+        "questions": [
+            {
+                "id": row.id,
+                "question": row.question_text,
+                "answers": answers_payload(options.get(row.id, ())),
+                "is_approved": bool(row.is_approved)
+            }
+            for row in rows
+        ],
+        "total": total,
+        "limit": limit,
+        "offset": offset,
+        "next_cursor": next_cursor
+    })
+
+
+def encode_question(row: Any, options: List[Tuple]) -> bytes:
+    """Тело ответа /api/questions/{id} (схема QuestionResponse)"""
+    return dumps({
+        "id": row.id,
+        "question": row.question_text,
+        "answers": answers_payload(options),
+        "is_approved": bool(row.is_approved)
+    })
+
+
+def encode_search_results(
+    query: str,
+    rows: List[Any],
+    options: Dict[int, List[Tuple]],
+    scores: Dict[int, float],
+    total: int,
+    limit: int,
+    offset: int
+) -> bytes:
+    """Тело ответа /api/questions/search"""
+    return dumps({
+        "query": query,
+        "questions": [
+            {
+                "id": row.id,
+                "question": row.question_text,
+                "answers": answers_payload(options.get(row.id, ())),
+                "is_approved": bool(row.is_approved),
+                "source_document_id": row.source_document_id,
+                "score": scores[row.id]
+            }
+            for row in rows
+        ],
+        "total": total,
+        "limit": limit,
+        "offset": offset
+    })
+
+
+# =====================================================
+# ЗАМЕР
+# =====================================================
+
+def benchmark(questions: int = 1000, options: int = 4, repeat: int = 20) -> Dict[str, float]:
+    """
+    CPU-время сериализации страницы вопросов: прежний путь
+    (Pydantic-модели + jsonable_encoder + json) и быстрый (кортежи + orjson)
+
+    Args:
+        questions: Вопросов на странице
+        options: Вариантов ответа на вопрос
+        repeat: Количество повторов
+
+    Returns:
+        Миллисекунды CPU на страницу для обоих путей
+    """
+    import time
+    from collections import namedtuple
+
+    from fastapi.encoders import jsonable_encoder
+    from pydantic import BaseModel
+
+    class AnswerOptionResponse(BaseModel):
+        id: int
+        text: str
+        is_correct: Optional[bool] = None
+        order: int
+
+    Row = namedtuple("Row", "id question_text is_approved")
+    rows = [Row(i, f"Текст вопроса номер {i} о базах данных?", i % 2 == 0) for i in range(questions)]
+    option_rows = {
+        row.id: [(row.id * options + k, f"Вариант ответа {k}", k == 0, k + 1) for k in range(options)]
+        for row in rows
+    }
+
+    def pydantic_path() -> bytes:
+        payload = {
+            "questions": [
+                {
+                    "id": row.id,
+                    "question": row.question_text,
+                    "answers": [
+                        AnswerOptionResponse(id=o[0], text=o[1], is_correct=o[2], order=o[3])
+                        for o in option_rows[row.id]
+                    ],
+                    "is_approved": row.is_approved
+                }
+                for row in rows
+            ],
+            "total": questions, "limit": questions, "offset": 0, "next_cursor": None
+        }
+        return json.dumps(
+            jsonable_encoder(payload), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+        ).encode("utf-8")
+
+    def fast_path() -> bytes:
+        return encode_question_page(rows, option_rows, questions, questions, 0, None)
+
+    assert pydantic_path() == fast_path()
+
+    result = {}
+    for name, path in (("pydantic_ms", pydantic_path), ("fast_ms", fast_path)):
+        start = time.process_time()
+        for _ in range(repeat):
+            path()
+        result[name] = round((time.process_time() - start) * 1000 / repeat, 2)
+    result["speedup"] = round(result["pydantic_ms"] / result["fast_ms"], 1)
+    result["encoder"] = "orjson" if orjson is not None else "json"
+    return result
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Замер сериализации страницы вопросов")
+    parser.add_argument("--questions", type=int, default=1000, help="Вопросов на странице")
+    parser.add_argument("--repeat", type=int, default=20, help="Количество повторов")
+    args = parser.parse_args()
+    print(benchmark(args.questions, repeat=args.repeat))
@@ -0,0 +1,356 @@
+"""
+HTTP-кэширование ответов чтения: ETag, Last-Modified, 304 и общий кэш.
+
+Для каждого кэшируемого endpoint задается дешевый проверочный запрос
+(валидатор): updated_at строки или MAX(updated_at)/MAX(id) таблицы по
+индексам. Готовое тело ответа хранится в общем кэше процесса вместе
+с валидатором; пока валидатор не изменился, ответ не пересобирается.
+
+ETag - хэш тела ответа, поэтому он верен всегда: пересобранный ответ
+с тем же содержимым получает тот же ETag, и клиент по-прежнему получает
+304. Last-Modified отдается как дополнительная информация, 304 выдается
+только по If-None-Match (updated_at не меняется при удалении строк и при
+изменении вариантов ответа).
+
+Изменения, сделанные через сессии этого процесса (включая массовые
+операции), сразу сбрасывают записи через счетчики поколений; изменения
+из других процессов, которые не видны по валидатору, живут не дольше
+RESPONSE_CACHE_TTL_SECONDS.
+
+Политики Cache-Control задаются по маршрутам: браузер перепроверяет
+ответы условным запросом. Общего кэша прокси перед этим API нет:
+nginx из docker-compose.yml направляет /api/questions, /api/tests
+и /api/documents в сервисы generation и testing. Если такой кэш появится,
+его ключ должен учитывать Authorization для всех непубличных маршрутов.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+from database import DbSession, SessionLocal, run_db
+import fast_json
+import models
+import payload_cache
+
+# Максимальное количество ответов в кэше
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+
+# Сколько секунд ответ может жить в кэше без пересборки
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "30"))
+
+# Счетчики поколений, сбрасывающие ответы при изменениях в этом процессе
+GENERATION_QUESTIONS = "questions"
+GENERATION_TESTS = "tests"
+GENERATION_DOCUMENTS = "documents"
+
+
+@dataclass(frozen=True)
+class CachePolicy:
+    """Политика кэширования маршрута"""
+    cache_control: str
+
+
+# Публичные данные: браузер перепроверяет ответ при каждом запросе
+POLICY_PUBLIC = CachePolicy("no-cache")
+
+# Данные пользователя: только кэш браузера с перепроверкой
+POLICY_PRIVATE = CachePolicy("private, no-cache")
+
+
+@dataclass
+class CachedResponse:
+    """Готовое тело ответа и его валидаторы"""
+    validator: Hashable
+    body: bytes
+    etag: str
+    last_modified: Optional[datetime]
+    created_at: float
+
+
+def make_etag(body: bytes) -> str:
+    """Сильный ETag по содержимому ответа"""
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+def http_date(value: datetime) -> str:
+    """Дата в формате HTTP (TIMESTAMP из БД считается UTC)"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Совпадает ли ETag с заголовком If-None-Match"""
+    if not if_none_match:
+        return False
+    candidates = [value.strip().removeprefix("W/") for value in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def conditional_response(
+    request: Request,
+    body: bytes,
+    etag: str,
+    last_modified: Optional[datetime] = None,
+    policy: CachePolicy = POLICY_PUBLIC,
+    media_type: str = "application/json",
+    headers: Optional[Dict[str, str]] = None
+) -> Response:
+    """
+    Ответ с валидаторами: 304 без тела, если ETag клиента актуален
+
+    Args:
+        request: Запрос (заголовок If-None-Match)
+        body: Тело ответа
+        etag: ETag тела
+        last_modified: Время последнего изменения данных
+        policy: Политика кэширования маршрута
+        media_type: Тип содержимого
+        headers: Дополнительные заголовки ответа 200
+
+    Returns:
+        Response 200 или 304
+    """
+    cache_headers = {"ETag": etag, "Cache-Control": policy.cache_control}
+    if last_modified is not None:
+        cache_headers["Last-Modified"] = http_date(last_modified)
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=cache_headers)
+
+    return Response(content=body, media_type=media_type, headers={**cache_headers, **(headers or {})})
+
+
+class Generations:
+    """
+    Счетчики поколений данных
+
+    Значение счетчика входит в валидатор ответа; увеличение счетчика
+    делает неактуальными все ответы, построенные из этих данных.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values: Dict[str, int] = {}
+
+    def bump(self, *names: str):
+        with self._lock:
+            for name in names:
+                self._values[name] = self._values.get(name, 0) + 1
+
+    def snapshot(self, *names: str) -> Tuple[int, ...]:
+        with self._lock:
+            return tuple(self._values.get(name, 0) for name in names)
+
+
+class ResponseCache:
+    """
+    LRU-кэш готовых ответов по ключу маршрута и параметров
+    """
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, CachedResponse]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, validator: Hashable) -> Optional[CachedResponse]:
+        """Ответ, если валидатор не изменился и срок жизни не истек"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if (
+                entry is None
+                or entry.validator != validator
+                or time.monotonic() - entry.created_at > self.ttl
+            ):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: Hashable, entry: CachedResponse):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+generations = Generations()
+response_cache = ResponseCache()
+
+
+def encode_json(payload: Any) -> bytes:
+    """Тело ответа в том же формате, что и JSONResponse FastAPI"""
+    return fast_json.dumps(jsonable_encoder(payload))
+
+
+# Валидатор: функция от сессии, возвращающая (значение, last_modified)
+Validator = Callable[[Session], Tuple[Hashable, Optional[datetime]]]
+
+
+async def cached_json(
+    request: Request,
+    db: DbSession,
+    key: Hashable,
+    validate: Validator,
+    build: Callable[[Session], Any],
+    policy: CachePolicy = POLICY_PUBLIC,
+    encode: Callable[[Any], bytes] = encode_json
+) -> Response:
+    """
+    JSON-ответ через общий кэш с проверкой валидатора
+
+    При попадании в кэш выполняется только проверочный запрос; если ETag
+    клиента совпадает, тело не отправляется (304).
+
+    Args:
+        request: Запрос
+        db: Сессия БД
+        key: Ключ кэша (маршрут и параметры запроса)
+        validate: Проверочный запрос
+        build: Сборка данных или готового тела ответа (может вызвать HTTPException)
+        policy: Политика кэширования маршрута
+        encode: Сериализация данных ответа в байты
+
+    Returns:
+        Response 200 или 304
+    """
+    def load(db: Session) -> CachedResponse:
+        validator, last_modified = validate(db)
+        entry = response_cache.get(key, validator)
+        if entry is None:
+            payload = build(db)
+            # Кодировщики fast_json возвращают готовые байты
+            body = payload if isinstance(payload, bytes) else encode(payload)
+            entry = CachedResponse(
+                validator=validator,
+                body=body,
+                etag=make_etag(body),
+                last_modified=last_modified,
+                created_at=time.monotonic()
+            )
+            response_cache.put(key, entry)
+        return entry
+
+    entry = await run_db(db, load)
+    return conditional_response(request, entry.body, entry.etag, entry.last_modified, policy)
+
+
+# =====================================================
+# ВАЛИДАТОРЫ
+# =====================================================
+
+def _latest(*values: Optional[datetime]) -> Optional[datetime]:
+    present = [value for value in values if value is not None]
+    return max(present) if present else None
+
+
+def table_validator(model, *generation_names: str) -> Validator:
+    """
+    Валидатор списка: MAX(updated_at) и MAX(id) таблицы
+
+    Оба значения берутся из индексов (idx_updated_at и первичный ключ).
+    """
+    def validate(db: Session) -> Tuple[Hashable, Optional[datetime]]:
+        updated_at, max_id = db.query(func.max(model.updated_at), func.max(model.id)).one()
+        return (updated_at, max_id, generations.snapshot(*generation_names)), updated_at
+
+    return validate
+
+
+def row_validator(model, row_id: int, *generation_names: str) -> Validator:
+    """Валидатор одной строки: ее updated_at (None, если строки нет)"""
+    def validate(db: Session) -> Tuple[Hashable, Optional[datetime]]:
+        updated_at = db.query(model.updated_at).filter(model.id == row_id).scalar()
+        return (updated_at, generations.snapshot(*generation_names)), updated_at
+
+    return validate
+
+
+def documents_validator(db: Session) -> Tuple[Hashable, Optional[datetime]]:
+    """
+    Валидатор списка документов
+
+    В source_documents нет updated_at: смена статуса видна по
+    MAX(processed_at) и количеству документов в каждом статусе.
+    """
+    document = models.SourceDocument
+    max_id, processed_at, created_at = db.query(
+        func.max(document.id), func.max(document.processed_at), func.max(document.created_at)
+    ).one()
+    statuses = tuple(sorted(
+        (str(status), total)
+        for status, total in db.query(document.status, func.count()).group_by(document.status)
+    ))
+    return (
+        (max_id, processed_at, statuses, generations.snapshot(GENERATION_DOCUMENTS, GENERATION_QUESTIONS)),
+        _latest(processed_at, created_at)
+    )
+
+
+# =====================================================
+# ИНВАЛИДАЦИЯ
+# =====================================================
+
+class _GenerationInvalidator:
+    """
+    Подписчик общей инвалидации кэшей тестов (payload_cache)
+
+    Получает тесты и вопросы, измененные через ORM и массовыми
+    операциями, и увеличивает соответствующие счетчики поколений.
+    """
+
+    def invalidate_tests(self, test_ids: Iterable[int]):
+        if test_ids:
+            generations.bump(GENERATION_TESTS)
+
+    def invalidate_questions(self, question_ids: Iterable[int]):
+        if question_ids:
+            generations.bump(GENERATION_QUESTIONS)
+
+
+payload_cache.register_cache(_GenerationInvalidator())
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_document_changes(session: Session, flush_context):
+    """Запомнить, менялись ли документы в этой транзакции"""
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, models.SourceDocument):
+            session.info["http_cache_documents"] = True
+            return
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _apply_document_changes(session: Session):
+    if session.info.pop("http_cache_documents", False):
+        generations.bump(GENERATION_DOCUMENTS)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_document_changes(session: Session):
+    session.info.pop("http_cache_documents", None)
@@ -0,0 +1,504 @@
+"""
+Инструментирование запросов: латентность маршрутов, SQL и профилирование.
+
+Три части:
+
+- ASGI middleware ведет гистограммы времени ответа по шаблону маршрута
+  (/api/tests/{test_id}, а не /api/tests/42) и счетчики ответов по статусу;
+- обработчики событий движка SQLAlchemy считают SQL-запросы и время БД
+  каждого HTTP-запроса; детектор N+1 приводит запросы к форме (IN-списки
+  свернуты) и сообщает о формах, повторенных N_PLUS_ONE_THRESHOLD раз
+  и более за один HTTP-запрос;
+- семплирующий профилировщик по заголовку X-Profile (значение должно
+  совпадать с PROFILE_TOKEN): во время запроса стеки потоков снимаются
+  каждые PROFILE_INTERVAL_MS и сохраняются в PROFILE_DIR в формате
+  folded stacks (flamegraph.pl, speedscope). Снимаются все потоки
+  процесса, поэтому профиль имеет смысл на ненагруженном экземпляре.
+
+Все метрики отдаются в текстовом формате Prometheus на /metrics. Маршрут
+не проксируется nginx и доступен только внутри сети docker-compose.
+
+Счетчики запроса хранятся в contextvar: пул потоков (run_in_threadpool)
+и run_sync асинхронной сессии копируют контекст, поэтому запросы из
+функций run_db попадают в счетчики своего HTTP-запроса. Запросы фоновых
+потоков (очередь отправок, обновление индексов) учитываются в общих
+счетчиках с маршрутом "background".
+"""
+
+import bisect
+import contextvars
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Включить middleware и счетчики SQL
+INSTRUMENTATION_ENABLED = os.getenv("INSTRUMENTATION_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# Сколько одинаковых по форме запросов за HTTP-запрос считать N+1
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "10"))
+
+# Значение заголовка X-Profile, включающее профилирование (пусто - выключено)
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+
+# Интервал снятия стеков профилировщиком (мс)
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+
+# Каталог для профилей
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/testgen-profiles")
+
+# Границы корзин гистограммы времени ответа (секунды)
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# Границы корзин гистограммы количества SQL-запросов на HTTP-запрос
+STATEMENT_BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250]
+
+# Маршрут для запросов вне HTTP-запроса и для неизвестных путей
+ROUTE_BACKGROUND = "background"
+ROUTE_UNMATCHED = "unmatched"
+
+# Длина формы запроса в сообщении детектора N+1
+SHAPE_LOG_LENGTH = 200
+
+
+# =====================================================
+# ГИСТОГРАММЫ И СЧЕТЧИКИ
+# =====================================================
+
+class Histogram:
+    """
+    Гистограмма в стиле Prometheus (кумулятивные корзины при выводе)
+    """
+
+    def __init__(self, buckets: List[float]):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((_format_number(bound), total))
+        result.append(("+Inf", total + self.counts[-1]))
+        return result
+
+
+@dataclass
+class RouteMetrics:
+    """Метрики одного маршрута (метод + шаблон пути)"""
+    latency: Histogram = field(default_factory=lambda: Histogram(LATENCY_BUCKETS))
+    statements: Histogram = field(default_factory=lambda: Histogram(STATEMENT_BUCKETS))
+    db_seconds: float = 0.0
+    statuses: Counter = field(default_factory=Counter)
+    n_plus_one: int = 0
+
+
+@dataclass
+class RequestStats:
+    """Счетчики SQL одного HTTP-запроса"""
+    statements: int = 0
+    db_seconds: float = 0.0
+    shapes: Counter = field(default_factory=Counter)
+
+
+class MetricsRegistry:
+    """
+    Метрики процесса: маршруты и SQL вне HTTP-запросов
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes: Dict[Tuple[str, str], RouteMetrics] = {}
+        self.background_statements = 0
+        self.background_db_seconds = 0.0
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float, stats: RequestStats, n_plus_one: int):
+        with self._lock:
+            metrics = self._routes.get((method, route))
+            if metrics is None:
+                metrics = self._routes[(method, route)] = RouteMetrics()
+            metrics.latency.observe(seconds)
+            metrics.statements.observe(stats.statements)
+            metrics.db_seconds += stats.db_seconds
+            metrics.statuses[status] += 1
+            metrics.n_plus_one += n_plus_one
+
+    def observe_background(self, seconds: float):
+        with self._lock:
+            self.background_statements += 1
+            self.background_db_seconds += seconds
+
+    def render(self) -> List[str]:
+        """Строки метрик маршрутов в текстовом формате Prometheus"""
+        with self._lock:
+            routes = sorted(self._routes.items())
+            lines = [
+                "# HELP testgen_http_requests_total HTTP responses by route and status",
+                "# TYPE testgen_http_requests_total counter"
+            ]
+            for (method, route), metrics in routes:
+                for status, count in sorted(metrics.statuses.items()):
+                    lines.append(
+                        f"testgen_http_requests_total{_labels(method=method, route=route, status=status)} {count}"
+                    )
+
+            lines += _histogram_lines(
+                "testgen_http_request_duration_seconds", "HTTP request latency by route",
+                [((method, route), metrics.latency) for (method, route), metrics in routes]
+            )
+            lines += _histogram_lines(
+                "testgen_db_statements_per_request", "SQL statements per HTTP request by route",
+                [((method, route), metrics.statements) for (method, route), metrics in routes]
+            )
+
+            lines += [
+                "# HELP testgen_db_statements_total SQL statements by route",
+                "# TYPE testgen_db_statements_total counter"
+            ]
+            for (method, route), metrics in routes:
+                lines.append(
+                    f"testgen_db_statements_total{_labels(method=method, route=route)} {int(metrics.statements.sum)}"
+                )
+            lines.append(
+                f"testgen_db_statements_total{_labels(method='', route=ROUTE_BACKGROUND)} {self.background_statements}"
+            )
+
+            lines += [
+                "# HELP testgen_db_seconds_total Time spent executing SQL by route",
+                "# TYPE testgen_db_seconds_total counter"
+            ]
+            for (method, route), metrics in routes:
+                lines.append(
+                    f"testgen_db_seconds_total{_labels(method=method, route=route)} {_format_number(metrics.db_seconds)}"
+                )
+            lines.append(
+                f"testgen_db_seconds_total{_labels(method='', route=ROUTE_BACKGROUND)} "
+                f"{_format_number(self.background_db_seconds)}"
+            )
+
+            lines += [
+                "# HELP testgen_db_n_plus_one_total Requests with repeated identical SQL statement shapes",
+                "# TYPE testgen_db_n_plus_one_total counter"
+            ]
+            for (method, route), metrics in routes:
+                lines.append(f"testgen_db_n_plus_one_total{_labels(method=method, route=route)} {metrics.n_plus_one}")
+
+            return lines
+
+
+def _format_number(value: float) -> str:
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(round(float(value), 6))
+
+
+def _labels(**labels: Any) -> str:
+    parts = []
+    for name, value in labels.items():
+        text = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{name}="{text}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _histogram_lines(name: str, help_text: str, series: List[Tuple[Tuple[str, str], Histogram]]) -> List[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for (method, route), histogram in series:
+        for bound, count in histogram.cumulative():
+            lines.append(f"{name}_bucket{_labels(method=method, route=route, le=bound)} {count}")
+        lines.append(f"{name}_sum{_labels(method=method, route=route)} {_format_number(histogram.sum)}")
+        lines.append(f"{name}_count{_labels(method=method, route=route)} {histogram.cumulative()[-1][1]}")
+    return lines
+
+
+registry = MetricsRegistry()
+
+# Счетчики SQL текущего HTTP-запроса
+_request_stats: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "instrumentation_request_stats", default=None
+)
+
+
+# =====================================================
+# СЧЕТЧИКИ SQL И ДЕТЕКТОР N+1
+# =====================================================
+
+# Список плейсхолдеров: IN (%(id_1_1)s, %(id_1_2)s), VALUES (?, ?, ?)
+_PLACEHOLDER_LIST = re.compile(r"\(\s*(?:%\(\w+\)s|%s|\?|:\w+)(?:\s*,\s*(?:%\(\w+\)s|%s|\?|:\w+))*\s*\)")
+_NAMED_PLACEHOLDER = re.compile(r"%\(\w+\)s|:\w+\b")
+_SPACES = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=2048)
+def statement_shape(statement: str) -> str:
+    """
+    Форма SQL-запроса: списки параметров свернуты, пробелы нормализованы
+
+    Запросы, отличающиеся только количеством элементов IN-списка
+    или именами параметров, получают одну форму.
+    """
+    shape = _PLACEHOLDER_LIST.sub("(?)", statement)
+    shape = _NAMED_PLACEHOLDER.sub("?", shape)
+    return _SPACES.sub(" ", shape).strip()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._instrumentation_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_instrumentation_start", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+
+    stats = _request_stats.get()
+    if stats is None:
+        registry.observe_background(elapsed)
+        return
+    stats.statements += 1
+    stats.db_seconds += elapsed
+    stats.shapes[statement_shape(statement)] += 1
+
+
+def repeated_shapes(stats: RequestStats, threshold: int = N_PLUS_ONE_THRESHOLD) -> List[Tuple[str, int]]:
+    """
+    Формы запросов, повторенные threshold раз и более
+
+    Args:
+        stats: Счетчики HTTP-запроса
+        threshold: Порог повторов
+
+    Returns:
+        Список (форма, количество) по убыванию количества
+    """
+    return [(shape, count) for shape, count in stats.shapes.most_common() if count >= threshold]
+
+
+# =====================================================
+# ПРОФИЛИРОВЩИК
+# =====================================================
+
+# Файлы, в которых стоит простаивающий поток (ожидание задачи или событий)
+_IDLE_FILES = ("threading.py", "queue.py", "selectors.py", os.path.join("concurrent", "futures", "thread.py"))
+
+
+class SamplingProfiler:
+    """
+    Семплирующий профилировщик на sys._current_frames()
+
+    Фоновый поток снимает стеки всех потоков с заданным интервалом
+    и накапливает их в формате folded stacks. Простаивающие потоки
+    (ожидание в очереди пула, select event loop) пропускаются.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = traceback.extract_stack(frame)
+                if not stack or stack[-1].filename.endswith(_IDLE_FILES):
+                    continue
+                self.samples[";".join(
+                    f"{entry.name} ({os.path.basename(entry.filename)}:{entry.lineno})" for entry in stack
+                )] += 1
+
+    def folded(self) -> str:
+        """Профиль в формате folded stacks: "стек количество" на строку"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+# Одновременно выполняется только один профиль
+_profile_lock = threading.Lock()
+
+
+def profile_requested(headers: Dict[bytes, bytes]) -> bool:
+    """Запрошено ли профилирование заголовком X-Profile"""
+    if not PROFILE_TOKEN:
+        return False
+    return headers.get(b"x-profile", b"").decode("latin-1") == PROFILE_TOKEN
+
+
+def profile_path(method: str, path: str) -> str:
+    """Путь к файлу профиля запроса"""
+    name = re.sub(r"[^A-Za-z0-9]+", "_", f"{method} {path}").strip("_")
+    return os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{name}.folded")
+
+
+def write_profile(profiler: SamplingProfiler, path: str):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as output:
+        output.write(profiler.folded())
+
+
+# =====================================================
+# MIDDLEWARE
+# =====================================================
+
+def _shorten(shape: str, length: int = SHAPE_LOG_LENGTH) -> str:
+    """Начало и конец длинного запроса (список колонок в середине не нужен)"""
+    if len(shape) <= length:
+        return shape
+    half = length // 2
+    return shape[:half] + " ... " + shape[-half:]
+
+
+def route_template(scope: Dict[str, Any]) -> str:
+    """Шаблон маршрута, выбранного роутером (после обработки запроса)"""
+    route = scope.get("route")
+    return getattr(route, "path", None) or ROUTE_UNMATCHED
+
+
+class InstrumentationMiddleware:
+    """
+    ASGI middleware: время ответа, счетчики SQL, N+1 и профиль запроса
+
+    Время считается до окончания отправки тела, поэтому потоковые
+    выгрузки учитываются целиком вместе с их SQL-запросами.
+    """
+
+    def __init__(self, app: Callable):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not INSTRUMENTATION_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        status = 500
+
+        profiler = None
+        profile_file = None
+        if profile_requested(dict(scope["headers"])) and _profile_lock.acquire(blocking=False):
+            profiler = SamplingProfiler()
+            profile_file = profile_path(scope["method"], scope["path"])
+            profiler.start()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if profile_file is not None:
+                    message = {
+                        **message,
+                        "headers": list(message.get("headers", [])) + [
+                            (b"x-profile-file", os.path.basename(profile_file).encode("latin-1"))
+                        ]
+                    }
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            _request_stats.reset(token)
+            method = scope["method"]
+            route = route_template(scope)
+
+            repeated = repeated_shapes(stats)
+            for shape, count in repeated:
+                print(
+                    f"⚠️  N+1: {method} {route} выполнил {count} одинаковых запросов: "
+                    f"{_shorten(shape)}"
+                )
+            registry.observe_request(method, route, status, elapsed, stats, 1 if repeated else 0)
+
+            if profiler is not None:
+                profiler.stop()
+                try:
+                    write_profile(profiler, profile_file)
+                    print(f"📈 Profile {method} {scope['path']}: {profile_file}")
+                except OSError as e:
+                    print(f"❌ Failed to write profile {profile_file}: {e}")
+                finally:
+                    _profile_lock.release()
+
+
+# =====================================================
+# /metrics
+# =====================================================
+
+def _pool_lines(metrics: Dict[str, Any]) -> List[str]:
+    """Метрики пулов соединений (get_pool_metrics) в формате Prometheus"""
+    pools = [(name, status) for name, status in metrics.items() if name != "profile"]
+    lines = []
+    for gauge, help_text in (
+        ("size", "Configured pool size"),
+        ("checked_out", "Connections in use"),
+        ("overflow", "Current pool overflow")
+    ):
+        lines += [f"# HELP testgen_db_pool_{gauge} {help_text}", f"# TYPE testgen_db_pool_{gauge} gauge"]
+        for name, status in pools:
+            if gauge in status:
+                lines.append(f"testgen_db_pool_{gauge}{_labels(pool=name)} {status[gauge]}")
+
+    name = "testgen_db_pool_wait_seconds"
+    lines += [f"# HELP {name} Time waiting for a pooled connection", f"# TYPE {name} histogram"]
+    for pool, status in pools:
+        wait = status.get("wait")
+        if wait is None:
+            continue
+        for bucket, count in wait["buckets"].items():
+            bound = "+Inf" if bucket == "le_inf" else _format_number(float(bucket[3:-2]) / 1000)
+            lines.append(f"{name}_bucket{_labels(pool=pool, le=bound)} {count}")
+        lines.append(f"{name}_sum{_labels(pool=pool)} {_format_number(wait['sum_ms'] / 1000)}")
+        lines.append(f"{name}_count{_labels(pool=pool)} {wait['count']}")
+
+    lines += ["# HELP testgen_db_pool_timeouts_total Pool checkout timeouts", "# TYPE testgen_db_pool_timeouts_total counter"]
+    for pool, status in pools:
+        if "wait" in status:
+            lines.append(f"testgen_db_pool_timeouts_total{_labels(pool=pool)} {status['wait']['timeouts']}")
+    return lines
+
+
+def render_metrics(pool_metrics: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Все метрики процесса в текстовом формате Prometheus
+
+    Args:
+        pool_metrics: Результат database.get_pool_metrics()
+
+    Returns:
+        Тело ответа /metrics
+    """
+    lines = registry.render()
+    if pool_metrics is not None:
+        lines += _pool_lines(pool_metrics)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,421 @@
+"""
+Анализ заданий теста (классическая теория тестов).
+
+По завершенным сессиям теста вычисляются:
+- индекс трудности (p-value) - доля сессий с правильным ответом на вопрос;
+- дискриминативность - точечно-бисериальная корреляция ответа на вопрос
+  с баллом за остальные вопросы (item-rest) и с полным баллом;
+- статистика вариантов ответа - частота выбора и корреляция выбора
+  варианта с баллом за остальные вопросы (у хорошего дистрактора
+  она отрицательна);
+- альфа Кронбаха и стандартная ошибка измерения для теста в целом.
+
+Ответы читаются одним проходом курсора в колоночные массивы NumPy
+(сессия, вопрос, вариант, правильность), из них строится матрица
+"сессия x вопрос", и все показатели считаются векторно. Неотвеченный
+вопрос считается неправильным ответом. Балл сессии - количество
+правильных ответов.
+
+Готовый результат хранится в кэше по тесту вместе с проверочным
+значением: tests.updated_at, MAX(answered_at), количество и сумма
+правильных ответов завершенных сессий. Пока оно не изменилось,
+повторные запросы дашборда не пересчитывают анализ.
+"""
+
+import hashlib
+import itertools
+import os
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+import fast_json
+import models
+import payload_cache
+import question_loader
+
+# Максимальное количество тестов в кэше анализа
+ANALYTICS_CACHE_SIZE = int(os.getenv("ANALYTICS_CACHE_SIZE", "64"))
+
+# Сколько строк ответов читать из курсора за одно обращение к серверу
+ANALYTICS_YIELD_PER = 50000
+
+# Пороги пометок вопросов и вариантов
+EASY_P_VALUE = 0.9
+HARD_P_VALUE = 0.2
+LOW_DISCRIMINATION = 0.2
+# Дистрактор, выбранный реже, не работает
+MIN_DISTRACTOR_SHARE = 0.05
+
+FLAG_TOO_EASY = "too_easy"
+FLAG_TOO_HARD = "too_hard"
+FLAG_LOW_DISCRIMINATION = "low_discrimination"
+FLAG_NEGATIVE_DISCRIMINATION = "negative_discrimination"
+FLAG_NON_FUNCTIONING = "non_functioning"
+FLAG_ATTRACTS_STRONG = "attracts_strong"
+
+
+@dataclass
+class ItemAnalysis:
+    """Готовый анализ теста"""
+    test_id: int
+    # Проверочное значение (tests.updated_at, MAX(answered_at), ответов,
+    # правильных ответов); поле называется как у остальных записей
+    # TestPayloadCache, который сравнивает его при чтении
+    updated_at: Hashable
+    body: bytes
+    etag: str
+    payload: Dict[str, Any]
+    question_ids: Set[int] = field(default_factory=set)
+
+
+def _number(value: Any, digits: int = 4) -> Optional[float]:
+    """Число для JSON: None вместо NaN и бесконечности"""
+    value = float(value)
+    return round(value, digits) if np.isfinite(value) else None
+
+
+def _correlation(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Корреляции Пирсона столбцов x и y (y - матрица той же формы или столбец)
+
+    Для столбца с нулевой дисперсией результат - NaN.
+    """
+    x_centered = x - x.mean(axis=0)
+    y_centered = y - y.mean(axis=0)
+    covariance = (x_centered * y_centered).mean(axis=0)
+    scale = x_centered.std(axis=0) * y_centered.std(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(scale > 0, covariance / np.where(scale > 0, scale, 1), np.nan)
+
+
+# =====================================================
+# ЗАГРУЗКА
+# =====================================================
+
+def answers_validator(db: Session, test_id: int) -> Tuple[Any, ...]:
+    """MAX(answered_at), количество и сумма правильных ответов завершенных сессий теста"""
+    answer = models.UserAnswer
+    latest, total, correct = db.execute(
+        select(func.max(answer.answered_at), func.count(answer.id), func.sum(answer.is_correct))
+        .join(models.TestSession, models.TestSession.id == answer.test_session_id)
+        .where(
+            models.TestSession.test_id == test_id,
+            models.TestSession.status == models.SessionStatus.completed
+        )
+    ).one()
+    return latest, int(total or 0), int(correct or 0)
+
+
+def load_answers(db: Session, test_id: int) -> Dict[str, np.ndarray]:
+    """
+    Ответы завершенных сессий теста одним проходом курсора, по сессиям
+
+    Returns:
+        Массивы test_session_id, question_id, selected_option_id, is_correct
+    """
+    answer = models.UserAnswer
+    # Core-выполнение на соединении сессии: строки без слоя ORM
+    result = db.connection().execute(
+        select(answer.test_session_id, answer.question_id, answer.selected_option_id, answer.is_correct)
+        .join(models.TestSession, models.TestSession.id == answer.test_session_id)
+        .where(
+            models.TestSession.test_id == test_id,
+            models.TestSession.status == models.SessionStatus.completed
+        )
+        .order_by(answer.test_session_id)
+        .execution_options(yield_per=ANALYTICS_YIELD_PER)
+    )
+
+    chunks = []
+    try:
+        for partition in result.partitions():
+            chunks.append(np.fromiter(
+                itertools.chain.from_iterable(partition), dtype=np.int64, count=len(partition) * 4
+            ).reshape(-1, 4))
+    finally:
+        result.close()
+
+    data = np.concatenate(chunks) if chunks else np.zeros((0, 4), dtype=np.int64)
+    return {
+        "test_session_id": data[:, 0],
+        "question_id": data[:, 1],
+        "selected_option_id": data[:, 2],
+        "is_correct": data[:, 3].astype(bool)
+    }
+
+
+def load_items(db: Session, test_id: int) -> List[Dict[str, Any]]:
+    """Вопросы теста с вариантами ответа в порядке теста"""
+    items: List[Dict[str, Any]] = []
+    by_id: Dict[int, Dict[str, Any]] = {}
+    for row in question_loader.test_question_rows(db, test_id):
+        item = by_id.get(row.question_id)
+        if item is None:
+            item = {
+                "question_id": row.question_id,
+                "question": row.question_text,
+                "order": row.question_order,
+                "options": []
+            }
+            by_id[row.question_id] = item
+            items.append(item)
+        if row.option_id is not None:
+            item["options"].append({
+                "option_id": row.option_id,
+                "text": row.answer_text,
+                "is_correct": bool(row.is_correct),
+                "order": row.option_order
+            })
+    return items
+
+
+# =====================================================
+# ВЫЧИСЛЕНИЯ
+# =====================================================
+
+def analyze(items: List[Dict[str, Any]], answers: Dict[str, np.ndarray]) -> Dict[str, Any]:
+    """
+    Показатели заданий и теста по колоночным массивам ответов
+
+    Args:
+        items: Вопросы теста (load_items)
+        answers: Ответы завершенных сессий (load_answers)
+
+    Returns:
+        Словарь в формате ответа /api/tests/{id}/analytics (без test_id)
+    """
+    question_ids = np.array([item["question_id"] for item in items], dtype=np.int64)
+    order = np.argsort(question_ids)
+    sorted_questions = question_ids[order]
+
+    # Ответы на вопросы, которых больше нет в тесте, не учитываются
+    position = np.searchsorted(sorted_questions, answers["question_id"])
+    position[position == len(sorted_questions)] = 0
+    in_test = (
+        sorted_questions[position] == answers["question_id"]
+        if len(sorted_questions) else np.zeros(len(position), dtype=bool)
+    )
+    column = order[position[in_test]] if len(sorted_questions) else position[in_test]
+    session_ids, row = np.unique(answers["test_session_id"][in_test], return_inverse=True)
+    selected = answers["selected_option_id"][in_test]
+    is_correct = answers["is_correct"][in_test]
+
+    sessions = len(session_ids)
+    k = len(items)
+
+    # Матрица "сессия x вопрос": 1 - правильный ответ, 0 - неправильный или нет ответа
+    scores = np.zeros((sessions, k), dtype=np.float64)
+    scores[row, column] = is_correct
+    answered = np.bincount(column, minlength=k)
+
+    totals = scores.sum(axis=1)
+    rest = totals[:, None] - scores
+    p_values = scores.mean(axis=0) if sessions else np.full(k, np.nan)
+    discrimination = _correlation(scores, rest) if sessions else np.full(k, np.nan)
+    point_biserial = _correlation(scores, totals[:, None]) if sessions else np.full(k, np.nan)
+
+    # Альфа Кронбаха: k/(k-1) * (1 - сумма дисперсий заданий / дисперсия балла)
+    alpha = np.nan
+    total_variance = totals.var(ddof=1) if sessions > 1 else 0.0
+    if k > 1 and total_variance > 0:
+        alpha = k / (k - 1) * (1 - scores.var(axis=0, ddof=1).sum() / total_variance)
+    sem = np.sqrt(total_variance * (1 - alpha)) if 0 <= alpha <= 1 else np.nan
+
+    # Варианты ответа: частота выбора и корреляция выбора с баллом за остальные вопросы
+    option_ids = np.array([option["option_id"] for item in items for option in item["options"]], dtype=np.int64)
+    option_order = np.argsort(option_ids)
+    option_position = np.searchsorted(option_ids[option_order], selected)
+    option_position[option_position == len(option_ids)] = 0
+    known_option = (
+        option_ids[option_order][option_position] == selected
+        if len(option_ids) else np.zeros(len(selected), dtype=bool)
+    )
+    option_index = option_order[option_position[known_option]] if len(option_ids) else option_position[known_option]
+    answer_rest = rest[row, column][known_option]
+    option_counts = np.bincount(option_index, minlength=len(option_ids))
+    option_rest_sums = np.bincount(option_index, weights=answer_rest, minlength=len(option_ids))
+
+    # Точечно-бисериальная корреляция индикатора выбора варианта с rest:
+    # (M1 - M) / S * sqrt(p / (1 - p)), M и S - по всем сессиям
+    option_item = np.array([index for index, item in enumerate(items) for _ in item["options"]], dtype=np.int64)
+    rest_mean = rest.mean(axis=0) if sessions else np.full(k, np.nan)
+    rest_std = rest.std(axis=0) if sessions else np.full(k, np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        option_share = option_counts / sessions if sessions else np.full(len(option_ids), np.nan)
+        selected_mean = option_rest_sums / option_counts
+        option_correlation = (
+            (selected_mean - rest_mean[option_item]) / rest_std[option_item]
+            * np.sqrt(option_share / (1 - option_share))
+        )
+    option_correlation = np.where(
+        (option_counts > 0) & (option_share < 1) & (rest_std[option_item] > 0), option_correlation, np.nan
+    )
+
+    questions = []
+    option_offset = 0
+    for index, item in enumerate(items):
+        flags = []
+        p_value = _number(p_values[index])
+        item_discrimination = _number(discrimination[index])
+        if p_value is not None and p_value > EASY_P_VALUE:
+            flags.append(FLAG_TOO_EASY)
+        if p_value is not None and p_value < HARD_P_VALUE:
+            flags.append(FLAG_TOO_HARD)
+        if item_discrimination is not None:
+            if item_discrimination < 0:
+                flags.append(FLAG_NEGATIVE_DISCRIMINATION)
+            elif item_discrimination < LOW_DISCRIMINATION:
+                flags.append(FLAG_LOW_DISCRIMINATION)
+
+        options = []
+        for option in item["options"]:
+            share = _number(option_share[option_offset])
+            correlation = _number(option_correlation[option_offset])
+            option_flags = []
+            if not option["is_correct"] and sessions:
+                if share is not None and share < MIN_DISTRACTOR_SHARE:
+                    option_flags.append(FLAG_NON_FUNCTIONING)
+                if correlation is not None and correlation > 0:
+                    option_flags.append(FLAG_ATTRACTS_STRONG)
+            options.append({
+                **option,
+                "count": int(option_counts[option_offset]),
+                "share": share,
+                "discrimination": correlation,
+                "flags": option_flags
+            })
+            option_offset += 1
+
+        questions.append({
+            "question_id": item["question_id"],
+            "question": item["question"],
+            "order": item["order"],
+            "answered": int(answered[index]),
+            "p_value": p_value,
+            "discrimination": item_discrimination,
+            "point_biserial": _number(point_biserial[index]),
+            "options": options,
+            "flags": flags
+        })
+
+    return {
+        "sessions": sessions,
+        "questions_count": k,
+        "answers": int(in_test.sum()),
+        "score": {
+            "mean": _number(totals.mean()) if sessions else None,
+            "std": _number(totals.std(ddof=1)) if sessions > 1 else None,
+            "min": int(totals.min()) if sessions else None,
+            "max": int(totals.max()) if sessions else None
+        },
+        "cronbach_alpha": _number(alpha),
+        "sem": _number(sem),
+        "questions": questions
+    }
+
+
+# =====================================================
+# КЭШ
+# =====================================================
+
+# Кэш анализа, сбрасываемый вместе с кэшем ответов тестов
+analysis_cache = payload_cache.TestPayloadCache(max_tests=ANALYTICS_CACHE_SIZE)
+payload_cache.register_cache(analysis_cache)
+
+
+def get_test_analysis(db: Session, test_id: int) -> Optional[ItemAnalysis]:
+    """
+    Анализ теста из кэша или из БД
+
+    При попадании в кэш выполняются только два проверочных запроса.
+
+    Args:
+        db: Сессия базы данных
+        test_id: ID теста
+
+    Returns:
+        Анализ или None, если теста нет
+    """
+    test = db.query(models.Test.id, models.Test.title, models.Test.updated_at).filter(
+        models.Test.id == test_id
+    ).first()
+    if test is None:
+        return None
+
+    latest, total, correct = answers_validator(db, test_id)
+    validator = (test.updated_at, latest, total, correct)
+    entry = analysis_cache.get(test_id, validator)
+    if entry is not None:
+        return entry
+
+    items = load_items(db, test_id)
+    payload = {
+        "test_id": test.id,
+        "test_title": test.title,
+        "latest_answered_at": latest.strftime("%Y-%m-%d %H:%M:%S") if latest else None,
+        "computed_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        **analyze(items, load_answers(db, test_id))
+    }
+    body = fast_json.dumps(payload)
+    entry = ItemAnalysis(
+        test_id=test_id,
+        updated_at=validator,
+        body=body,
+        etag='"' + hashlib.sha1(body).hexdigest() + '"',
+        payload=payload,
+        question_ids={item["question_id"] for item in items}
+    )
+    analysis_cache.put(entry)
+    return entry
+
+
+def get_question_analysis(db: Session, question_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Показатели вопроса во всех тестах, в которые он входит
+
+    Показатели зависят от остальных вопросов теста, поэтому для каждого
+    теста берется анализ теста целиком (из кэша).
+
+    Args:
+        db: Сессия базы данных
+        question_id: ID вопроса
+
+    Returns:
+        Словарь с показателями по тестам или None, если вопроса нет
+    """
+    question = db.query(models.Question.id, models.Question.question_text).filter(
+        models.Question.id == question_id
+    ).first()
+    if question is None:
+        return None
+
+    test_ids = [
+        row.test_id for row in db.query(models.TestQuestion.test_id)
+        .filter(models.TestQuestion.question_id == question_id)
+        .order_by(models.TestQuestion.test_id)
+    ]
+
+    tests = []
+    for test_id in test_ids:
+        analysis = get_test_analysis(db, test_id)
+        if analysis is None:
+            continue
+        item = next(
+            (item for item in analysis.payload["questions"] if item["question_id"] == question_id), None
+        )
+        if item is None:
+            continue
+        tests.append({
+            "test_id": test_id,
+            "test_title": analysis.payload["test_title"],
+            "sessions": analysis.payload["sessions"],
+            "cronbach_alpha": analysis.payload["cronbach_alpha"],
+            **{key: value for key, value in item.items() if key not in ("question_id", "question")}
+        })
+
+    return {"question_id": question.id, "question": question.question_text, "tests": tests}
@@ -3,18 +3,42 @@ FastAPI приложение для системы TestGen.
 Интегрировано с MariaDB через SQLAlchemy ORM.
 """
 
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
+import os
+import tempfile
 from datetime import datetime
 from sqlalchemy.orm import Session
 from sqlalchemy import func
 
 # Импорт модулей проекта
-from database import get_db, check_db_connection
+from database import get_db, get_session, run_db, check_db_connection, get_pool_metrics, SessionLocal, DbSession
 import models
 import auth
+import question_loader
+import pagination
+import stats
+import payload_cache
+import session_engine
+import submission_queue
+import search_index
+import dedup_index
+import question_bulk
+import export_stream
+import question_import
+import moodle_export
+import http_cache
+import fast_json
+import instrumentation
+import regrade
+import item_analysis
+import user_stats
+import assigned_tests
+import audit
+import tokens
 
 app = FastAPI(
     title="TestGen MVP",
@@ -31,6 +55,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Латентность маршрутов, счетчики SQL и профилирование по X-Profile
+# (добавляется последним, чтобы измерять запрос целиком)
+app.add_middleware(instrumentation.InstrumentationMiddleware)
+
 
 # =====================================================
 # PYDANTIC МОДЕЛИ (DTO)
@@ -102,6 +130,28 @@ class TestDetailResponse(BaseModel):
         from_attributes = True
 
 
+class AnswerSubmission(BaseModel):
+    """Ответ студента на вопрос"""
+    question_id: int
+    option_id: int
+
+
+class AnswersRequest(BaseModel):
+    """Пачка ответов студента"""
+    answers: List[AnswerSubmission]
+
+
+class SubmitRequest(BaseModel):
+    """Завершение теста с последними неотправленными ответами"""
+    answers: List[AnswerSubmission] = []
+
+
+class BulkQuestionsRequest(BaseModel):
+    """Выборка вопросов для массовой операции: список id или документ"""
+    question_ids: Optional[List[int]] = None
+    source_document_id: Optional[int] = None
+
+
 # =====================================================
 # UTILITY ФУНКЦИИ
 # =====================================================
@@ -121,11 +171,38 @@ def format_datetime(dt: Optional[datetime]) -> Optional[str]:
 async def startup_event():
     """Проверка подключения к БД при старте приложения"""
     print("Starting TestGen API...")
+    tokens.check_secret_key()
     if check_db_connection():
         print("Database connection established successfully!")
     else:
         print("WARNING: Could not establish database connection!")
 
+    # Фоновое обновление снимка статистики
+    stats.stats_cache.start_background_refresh(SessionLocal)
+
+    # Пакетная запись попыток из очереди завершения тестов
+    submission_queue.submission_queue.start_worker(SessionLocal)
+
+    # Построение и обновление поискового индекса вопросов
+    search_index.search_index.start_background_refresh(SessionLocal)
+
+    # Пакетная запись журнала аудита (AUDIT_MODE=app)
+    if audit.app_mode():
+        audit.audit_pipeline.start_worker(SessionLocal)
+
+    # Периодическая пересборка user_stats (USER_STATS_REBUILD_SECONDS > 0)
+    user_stats.stats_rebuilder.start_worker(SessionLocal)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Остановка фоновых задач"""
+    stats.stats_cache.stop_background_refresh()
+    submission_queue.submission_queue.stop_worker()
+    search_index.search_index.stop_background_refresh()
+    audit.audit_pipeline.stop_worker()
+    user_stats.stats_rebuilder.stop_worker()
+
 
 @app.get("/")
 async def root():
@@ -138,7 +215,9 @@ async def root():
             "questions": "/api/questions",
             "documents": "/api/documents",
             "tests": "/api/tests",
-            "health": "/health"
+            "health": "/health",
+            "db_pool": "/api/db/pool",
+            "metrics": "/metrics"
         }
     }
 
@@ -147,36 +226,60 @@ async def root():
 async def health_check(db: Session = Depends(get_db)):
     """
     Health check endpoint для проверки состояния системы
+
+    Выполняет только SELECT 1; статистика берется из снимка в памяти.
     """
     try:
         # Проверка подключения к БД
         from sqlalchemy import text
         db.execute(text("SELECT 1"))
 
-        # Получение статистики
-        total_users = db.query(models.User).count()
-        total_questions = db.query(models.Question).count()
-        total_tests = db.query(models.Test).count()
+        snapshot = stats.stats_cache.peek()
+        statistics = None
+        if snapshot is not None:
+            statistics = {
+                "users": snapshot["users"]["total"],
+                "questions": snapshot["questions"]["total"],
+                "tests": snapshot["tests"]["total"]
+            }
 
         return {
             "status": "healthy",
             "database": "connected",
-            "statistics": {
-                "users": total_users,
-                "questions": total_questions,
-                "tests": total_tests
-            }
+            "statistics": statistics,
+            "statistics_age_seconds": stats.stats_cache.info()["age_seconds"]
         }
     except Exception as e:
         raise HTTPException(status_code=503, detail=f"Service unavailable: {str(e)}")
 
 
+@app.get("/api/db/pool")
+async def db_pool_metrics():
+    """
+    Метрики пула соединений с БД: занятые соединения, overflow,
+    гистограмма времени ожидания соединения
+    """
+    return get_pool_metrics()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """
+    Метрики в текстовом формате Prometheus: латентность и SQL-запросы
+    по маршрутам, N+1, пулы соединений
+    """
+    return Response(
+        content=instrumentation.render_metrics(get_pool_metrics()),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 # =====================================================
 # АВТОРИЗАЦИЯ (AUTH)
 # =====================================================
 
 @app.post("/api/auth/login", response_model=auth.Token)
-async def login(login_request: auth.LoginRequest, db: Session = Depends(get_db)):
+async def login(login_request: auth.LoginRequest, db: DbSession = Depends(get_session)):
     """
     Авторизация пользователя по email (без пароля для MVP)
 
@@ -190,10 +293,30 @@ async def login(login_request: auth.LoginRequest, db: Session = Depends(get_db))
     return await auth.login_user(login_request.email, db)
 
 
+@app.post("/api/auth/logout")
+async def logout(
+    claims: dict = Depends(auth.get_token_claims),
+    db: DbSession = Depends(get_session)
+):
+    """
+    Выход: отзыв текущего токена до истечения срока действия
+
+    Args:
+        claims: Claims текущего токена
+        db: Сессия БД
+    """
+    await run_db(db, auth.logout_user, claims)
+
+    return {
+        "status": "success",
+        "message": "Logged out successfully"
+    }
+
+
 @app.get("/api/auth/me", response_model=auth.UserResponse)
 async def get_current_user_info(
     current_user: models.User = Depends(auth.get_current_active_user),
-    db: Session = Depends(get_db)
+    db: DbSession = Depends(get_session)
 ):
     """
     Получить информацию о текущем пользователе
@@ -205,7 +328,7 @@ async def get_current_user_info(
     Returns:
         Данные пользователя с ролями
     """
-    roles = auth.get_user_roles(db, current_user.id)
+    roles = await run_db(db, auth.get_user_roles, current_user.id)
 
     return auth.UserResponse(
         id=current_user.id,
@@ -219,7 +342,7 @@ async def get_current_user_info(
 @app.get("/api/auth/users", response_model=list[auth.UserResponse])
 async def get_all_users(
     current_user: models.User = Depends(auth.get_current_active_user),
-    db: Session = Depends(get_db)
+    db: DbSession = Depends(get_session)
 ):
     """
     Получить список всех пользователей (требуется авторизация)
@@ -231,20 +354,25 @@ async def get_all_users(
     Returns:
         Список пользователей
     """
-    users = db.query(models.User).all()
+    def build(db: Session) -> list:
+        users = db.query(models.User).all()
+
+        # Роли всех пользователей одним пакетом
+        roles_by_user = auth.get_users_roles(db, [user.id for user in users])
 
-    result = []
-    for user in users:
-        roles = auth.get_user_roles(db, user.id)
-        result.append(auth.UserResponse(
-            id=user.id,
-            email=user.email,
-            full_name=user.full_name,
-            is_active=user.is_active,
-            roles=roles
-        ))
+        result = []
+        for user in users:
+            result.append(auth.UserResponse(
+                id=user.id,
+                email=user.email,
+                full_name=user.full_name,
+                is_active=user.is_active,
+                roles=roles_by_user.get(user.id, [])
+            ))
 
-    return result
+        return result
+
+    return await run_db(db, build)
 
 
 # =====================================================
@@ -253,91 +381,257 @@ async def get_all_users(
 
 @app.get("/api/questions", response_model=dict)
 async def get_questions(
+    request: Request,
     approved_only: bool = False,
     limit: int = 100,
     offset: int = 0,
-    db: Session = Depends(get_db)
+    after: Optional[str] = None,
+    cursor: bool = False,
+    count: str = pagination.COUNT_EXACT,
+    db: DbSession = Depends(get_session)
 ):
     """
     Получить список вопросов с фильтрацией
 
+    По умолчанию вопросы идут по id с пагинацией offset/limit.
+    Курсорная пагинация (created_at DESC) включается параметром
+    cursor=true на первой странице и далее продолжается по after.
+
     Args:
         approved_only: Только одобренные вопросы
         limit: Максимальное количество вопросов
         offset: Смещение для пагинации
+        after: Курсор следующей страницы (next_cursor из предыдущего ответа)
+        cursor: Начать курсорную пагинацию
+        count: Подсчет total - exact, estimate или none
         db: Сессия БД
     """
+    after_key = pagination.decode_cursor(after)
+    pagination.check_count_mode(count)
+    keyset = cursor or after_key is not None
+
+    def build(db: Session) -> bytes:
+        try:
+            # Страница вопросов + один пакетный запрос вариантов ответов;
+            # ответ собирается из строк без ORM-объектов и Pydantic-моделей
+            rows, options, total = question_loader.load_question_page_rows(
+                db,
+                approved_only=approved_only,
+                limit=limit,
+                offset=offset,
+                after=after_key,
+                count=count,
+                keyset=keyset
+            )
+
+            return fast_json.encode_question_page(
+                rows,
+                options,
+                total,
+                limit,
+                offset,
+                pagination.next_cursor(rows, limit) if keyset else None
+            )
+
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error fetching questions: {str(e)}")
+
+    return await http_cache.cached_json(
+        request,
+        db,
+        ("questions", approved_only, limit, offset, after, keyset, count),
+        http_cache.table_validator(models.Question, http_cache.GENERATION_QUESTIONS),
+        build
+    )
+
+
+@app.get("/api/questions/search", response_model=dict)
+async def search_questions(
+    q: str,
+    approved: Optional[bool] = None,
+    source_document_id: Optional[int] = None,
+    match: str = search_index.MATCH_ALL,
+    prefix: bool = False,
+    limit: int = 20,
+    offset: int = 0,
+    db: DbSession = Depends(get_session)
+):
+    """
+    Полнотекстовый поиск по тексту вопросов и вариантов ответов
+
+    Args:
+        q: Поисковый запрос; "слово*" - поиск по префиксу
+        approved: Фильтр по статусу одобрения
+        source_document_id: Фильтр по документу-источнику
+        match: all - все слова запроса, any - хотя бы одно
+        prefix: Искать последнее слово по префиксу (поиск по мере ввода)
+        limit: Размер страницы
+        offset: Смещение
+        db: Сессия БД
+    """
+    index = search_index.search_index
+    if not index.ready:
+        raise HTTPException(
+            status_code=503,
+            detail="Search index is being built, retry later",
+            headers={"Retry-After": "5"}
+        )
+    if match not in (search_index.MATCH_ALL, search_index.MATCH_ANY):
+        raise HTTPException(status_code=400, detail="match must be 'all' or 'any'")
+    if not search_index.parse_query(q):
+        raise HTTPException(status_code=400, detail="Empty search query")
+
+    def build(db: Session) -> bytes:
+        # Свои только что сделанные изменения должны находиться сразу
+        index.sync_dirty(db)
+
+        total, hits = index.search(
+            q,
+            approved=approved,
+            source_document_id=source_document_id,
+            limit=limit,
+            offset=offset,
+            match=match,
+            prefix_last=prefix
+        )
+        rows, options = question_loader.load_question_rows_by_ids(db, [question_id for question_id, _ in hits])
+
+        return fast_json.encode_search_results(q, rows, options, dict(hits), total, limit, offset)
+
+    body = await run_db(db, build)
+    return Response(content=body, media_type="application/json")
+
+
+@app.get("/api/questions/search/status")
+async def get_search_index_status():
+    """
+    Состояние поискового индекса
+    """
+    return search_index.search_index.info()
+
+
+def bulk_selection(request: BulkQuestionsRequest):
+    """Проверить, что задан ровно один способ выбора вопросов"""
+    if (request.question_ids is None) == (request.source_document_id is None):
+        raise HTTPException(
+            status_code=400,
+            detail="Specify either question_ids or source_document_id"
+        )
+
+
+@app.post("/api/questions/bulk/approve")
+async def bulk_approve_questions(
+    request: BulkQuestionsRequest,
+    user_id: int = 1,
+    db: DbSession = Depends(get_session)
+):
+    """
+    Одобрить вопросы пачкой: по списку id или все вопросы документа
+
+    NOTE: В MVP версии используем hardcoded user_id=1 (admin), как и
+    в /api/questions/{question_id}/approve
+    """
+    bulk_selection(request)
+    return await run_db(
+        db,
+        question_bulk.bulk_approve,
+        user_id,
+        request.question_ids,
+        request.source_document_id
+    )
+
+
+@app.post("/api/questions/bulk/delete")
+async def bulk_delete_questions(
+    request: BulkQuestionsRequest,
+    db: DbSession = Depends(get_session)
+):
+    """
+    Удалить вопросы пачкой: по списку id или все вопросы документа
+    """
+    bulk_selection(request)
+    return await run_db(
+        db,
+        question_bulk.bulk_delete,
+        request.question_ids,
+        request.source_document_id
+    )
+
+
+@app.post("/api/questions/import", status_code=202)
+async def import_questions(
+    request: Request,
+    format: str = question_import.FORMAT_NDJSON,
+    source_document_id: Optional[int] = None,
+    approve: bool = False,
+    skip: int = 0,
+    current_user: models.User = Depends(auth.get_current_staff_user)
+):
+    """
+    Импортировать банк вопросов из тела запроса (NDJSON, CSV или Moodle XML)
+
+    Тело запроса - сам файл. Он сохраняется во временный файл по мере
+    получения, импорт идет в фоне пачками; ход импорта - через
+    /api/questions/import/{import_id}. Чтобы продолжить прерванный импорт,
+    файл загружается повторно с skip=committed_records.
+    """
+    if format not in question_import.IMPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be 'ndjson', 'csv' or 'xml'")
+
+    descriptor, path = tempfile.mkstemp(prefix="question-import-", suffix=f".{format}")
     try:
-        # Базовый запрос
-        query = db.query(models.Question).join(models.AnswerOption)
-
-        # Применение фильтров
-        if approved_only:
-            query = query.filter(models.Question.is_approved == True)
-
-        # Получение общего количества
-        total = query.count()
-
-        # Пагинация
-        questions_db = query.offset(offset).limit(limit).all()
-
-        # Формирование ответа
-        questions_list = []
-        for q in questions_db:
-            answers = [
-                AnswerOptionResponse(
-                    id=a.id,
-                    text=a.answer_text,
-                    is_correct=a.is_correct,
-                    order=a.option_order
-                )
-                for a in q.answer_options
-            ]
-
-            questions_list.append({
-                "id": q.id,
-                "question": q.question_text,
-                "answers": answers,
-                "is_approved": q.is_approved
-            })
+        with os.fdopen(descriptor, "wb") as target:
+            async for chunk in request.stream():
+                target.write(chunk)
+    except Exception:
+        os.unlink(path)
+        raise
+
+    progress = question_import.import_jobs.start(
+        path,
+        request.headers.get("x-filename", f"upload.{format}"),
+        format,
+        current_user.id,
+        skip=skip,
+        source_document_id=source_document_id,
+        approve=approve
+    )
+    return progress.info()
 
-        return {
-            "questions": questions_list,
-            "total": total,
-            "limit": limit,
-            "offset": offset
-        }
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error fetching questions: {str(e)}")
+@app.get("/api/questions/import/{import_id}")
+async def get_import_status(
+    import_id: str,
+    current_user: models.User = Depends(auth.get_current_staff_user)
+):
+    """
+    Ход импорта банка вопросов
+    """
+    progress = question_import.import_jobs.get(import_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Import not found")
+    return progress.info()
 
 
 @app.get("/api/questions/{question_id}", response_model=QuestionResponse)
-async def get_question(question_id: int, db: Session = Depends(get_db)):
+async def get_question(question_id: int, request: Request, db: DbSession = Depends(get_session)):
     """
     Получить конкретный вопрос по ID
     """
-    question = db.query(models.Question).filter(models.Question.id == question_id).first()
+    def build(db: Session) -> bytes:
+        rows, options = question_loader.load_question_rows_by_ids(db, [question_id])
 
-    if not question:
-        raise HTTPException(status_code=404, detail="Question not found")
+        if not rows:
+            raise HTTPException(status_code=404, detail="Question not found")
 
-    answers = [
-        AnswerOptionResponse(
-            id=a.id,
-            text=a.answer_text,
-            is_correct=a.is_correct,
-            order=a.option_order
-        )
-        for a in question.answer_options
-    ]
-
-    return QuestionResponse(
-        id=question.id,
-        question=question.question_text,
-        answers=answers,
-        is_approved=question.is_approved,
-        difficulty=question.difficulty.value if question.difficulty else None
+        return fast_json.encode_question(rows[0], options.get(question_id, []))
+
+    return await http_cache.cached_json(
+        request,
+        db,
+        ("question", question_id),
+        http_cache.row_validator(models.Question, question_id, http_cache.GENERATION_QUESTIONS),
+        build
     )
 
 
@@ -379,6 +673,8 @@ async def delete_question(question_id: int, db: Session = Depends(get_db)):
     if not question:
         raise HTTPException(status_code=404, detail="Question not found")
 
+    # Связи с тестами удаляются каскадно: пересобрать счетчики до удаления
+    user_stats.rebuild_question_tests(db, [question_id])
     db.delete(question)
     db.commit()
 
@@ -394,10 +690,13 @@ async def delete_question(question_id: int, db: Session = Depends(get_db)):
 
 @app.get("/api/documents")
 async def get_documents(
+    request: Request,
     status: Optional[str] = None,
     limit: int = 100,
     offset: int = 0,
-    db: Session = Depends(get_db)
+    after: Optional[str] = None,
+    count: str = pagination.COUNT_EXACT,
+    db: DbSession = Depends(get_session)
 ):
     """
     Получить список загруженных документов
@@ -406,47 +705,142 @@ async def get_documents(
         status: Фильтр по статусу (pending, processing, completed, failed)
         limit: Максимальное количество документов
         offset: Смещение для пагинации
+        after: Курсор следующей страницы (next_cursor из предыдущего ответа)
+        count: Подсчет total - exact, estimate или none
         db: Сессия БД
     """
-    try:
-        # Базовый запрос
-        query = db.query(models.SourceDocument)
-
-        # Фильтр по статусу
-        if status:
-            query = query.filter(models.SourceDocument.status == status)
-
-        # Получение общего количества
-        total = query.count()
-
-        # Пагинация
-        documents_db = query.order_by(models.SourceDocument.created_at.desc()).offset(offset).limit(limit).all()
-
-        # Формирование ответа
-        documents_list = []
-        for doc in documents_db:
-            # Подсчет вопросов для документа
-            questions_count = db.query(models.Question).filter(
-                models.Question.source_document_id == doc.id
-            ).count()
-
-            documents_list.append({
-                "id": doc.id,
-                "name": doc.filename,
-                "status": doc.status.value if doc.status else "unknown",
-                "uploaded_at": format_datetime(doc.created_at),
-                "questions_count": questions_count
+    after_key = pagination.decode_cursor(after)
+    pagination.check_count_mode(count)
+
+    def build(db: Session) -> dict:
+        try:
+            # Базовый запрос
+            query = db.query(models.SourceDocument)
+
+            # Фильтр по статусу
+            if status:
+                query = query.filter(models.SourceDocument.status == status)
+
+            # Получение общего количества
+            total = pagination.count_total(db, query, models.SourceDocument, count)
+
+            # Пагинация
+            # (количество вопросов считается в том же запросе)
+            rows = pagination.paginate(
+                query.add_columns(question_loader.document_questions_count()),
+                models.SourceDocument,
+                limit=limit,
+                offset=offset,
+                after=after_key
+            )
+            documents_db = [doc for doc, _ in rows]
+
+            # Формирование ответа
+            documents_list = []
+            for doc, questions_count in rows:
+                documents_list.append({
+                    "id": doc.id,
+                    "name": doc.filename,
+                    "status": doc.status.value if doc.status else "unknown",
+                    "uploaded_at": format_datetime(doc.created_at),
+                    "questions_count": questions_count
+                })
+
+            return {
+                "documents": documents_list,
+                "total": total,
+                "limit": limit,
+                "offset": offset,
+                "next_cursor": pagination.next_cursor(documents_db, limit)
+            }
+
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error fetching documents: {str(e)}")
+
+    return await http_cache.cached_json(
+        request,
+        db,
+        ("documents", status, limit, offset, after, count),
+        http_cache.documents_validator,
+        build
+    )
+
+
+@app.get("/api/documents/{document_id}/duplicates")
+async def get_document_duplicates(
+    document_id: int,
+    threshold: float = dedup_index.DEDUP_THRESHOLD,
+    within_document: bool = True,
+    db: DbSession = Depends(get_session)
+):
+    """
+    Кластеры почти одинаковых вопросов документа
+
+    Args:
+        document_id: ID документа-источника
+        threshold: Минимальная оценка сходства (0..1)
+        within_document: Искать дубликаты только среди вопросов документа
+        db: Сессия БД
+    """
+    if not search_index.search_index.ready:
+        raise HTTPException(
+            status_code=503,
+            detail="Duplicate index is being built, retry later",
+            headers={"Retry-After": "5"}
+        )
+    if not 0 < threshold <= 1:
+        raise HTTPException(status_code=400, detail="threshold must be in (0, 1]")
+
+    def build(db: Session) -> dict:
+        # Свои только что сделанные изменения должны учитываться сразу
+        search_index.search_index.sync_dirty(db)
+
+        index = dedup_index.duplicate_index
+        clusters = index.document_clusters(document_id, threshold, within_document)
+
+        question_ids = [question_id for cluster in clusters for question_id in cluster]
+        questions = {}
+        if question_ids:
+            questions = {
+                row.id: row for row in db.query(
+                    models.Question.id,
+                    models.Question.question_text,
+                    models.Question.is_approved,
+                    models.Question.source_document_id
+                ).filter(models.Question.id.in_(question_ids))
+            }
+
+        clusters_list = []
+        for cluster in clusters:
+            rows = [questions[question_id] for question_id in cluster if question_id in questions]
+            if len(rows) < 2:
+                continue
+            # Оставить предлагается одобренный вопрос, иначе самый ранний
+            keep = next((row for row in rows if row.is_approved), rows[0])
+            similarity = dict(index.similar(keep.id, 0.0))
+            clusters_list.append({
+                "keep_id": keep.id,
+                "questions": [
+                    {
+                        "id": row.id,
+                        "question": row.question_text,
+                        "is_approved": row.is_approved,
+                        "source_document_id": row.source_document_id,
+                        "similarity": 1.0 if row.id == keep.id else round(similarity.get(row.id, 0.0), 3)
+                    }
+                    for row in rows
+                ]
             })
 
         return {
-            "documents": documents_list,
-            "total": total,
-            "limit": limit,
-            "offset": offset
+            "document_id": document_id,
+            "threshold": threshold,
+            "clusters": clusters_list,
+            "total_clusters": len(clusters_list),
+            "duplicates": sum(len(cluster["questions"]) - 1 for cluster in clusters_list)
         }
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error fetching documents: {str(e)}")
+    return await run_db(db, build)
 
 
 # =====================================================
@@ -455,10 +849,13 @@ async def get_documents(
 
 @app.get("/api/tests")
 async def get_tests(
+    request: Request,
     active_only: bool = True,
     limit: int = 100,
     offset: int = 0,
-    db: Session = Depends(get_db)
+    after: Optional[str] = None,
+    count: str = pagination.COUNT_EXACT,
+    db: DbSession = Depends(get_session)
 ):
     """
     Получить список тестов
@@ -467,176 +864,550 @@ async def get_tests(
         active_only: Только активные тесты
         limit: Максимальное количество тестов
         offset: Смещение для пагинации
+        after: Курсор следующей страницы (next_cursor из предыдущего ответа)
+        count: Подсчет total - exact, estimate или none
         db: Сессия БД
     """
-    try:
-        # Базовый запрос
-        query = db.query(models.Test)
-
-        # Фильтр активных тестов
-        if active_only:
-            query = query.filter(models.Test.is_active == True)
-
-        # Получение общего количества
-        total = query.count()
-
-        # Пагинация
-        tests_db = query.order_by(models.Test.created_at.desc()).offset(offset).limit(limit).all()
-
-        # Формирование ответа
-        tests_list = []
-        for test in tests_db:
-            # Подсчет вопросов в тесте
-            questions_count = db.query(models.TestQuestion).filter(
-                models.TestQuestion.test_id == test.id
-            ).count()
-
-            tests_list.append({
-                "id": test.id,
-                "title": test.title,
-                "description": test.description,
-                "time_limit": test.time_limit_minutes,
-                "passing_score": float(test.passing_score),
-                "questions_count": questions_count,
-                "created_at": format_datetime(test.created_at)
-            })
+    after_key = pagination.decode_cursor(after)
+    pagination.check_count_mode(count)
+
+    def build(db: Session) -> dict:
+        try:
+            # Базовый запрос
+            query = db.query(models.Test)
+
+            # Фильтр активных тестов
+            if active_only:
+                query = query.filter(models.Test.is_active == True)
+
+            # Получение общего количества
+            total = pagination.count_total(db, query, models.Test, count)
+
+            # Пагинация
+            # (количество вопросов считается в том же запросе)
+            rows = pagination.paginate(
+                query.add_columns(question_loader.test_questions_count()),
+                models.Test,
+                limit=limit,
+                offset=offset,
+                after=after_key
+            )
+            tests_db = [test for test, _ in rows]
+
+            # Формирование ответа
+            tests_list = []
+            for test, questions_count in rows:
+                tests_list.append({
+                    "id": test.id,
+                    "title": test.title,
+                    "description": test.description,
+                    "time_limit": test.time_limit_minutes,
+                    "passing_score": float(test.passing_score),
+                    "questions_count": questions_count,
+                    "created_at": format_datetime(test.created_at)
+                })
+
+            return {
+                "tests": tests_list,
+                "total": total,
+                "limit": limit,
+                "offset": offset,
+                "next_cursor": pagination.next_cursor(tests_db, limit)
+            }
 
-        return {
-            "tests": tests_list,
-            "total": total,
-            "limit": limit,
-            "offset": offset
-        }
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error fetching tests: {str(e)}")
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error fetching tests: {str(e)}")
+    return await http_cache.cached_json(
+        request,
+        db,
+        ("tests", active_only, limit, offset, after, count),
+        http_cache.table_validator(models.Test, http_cache.GENERATION_TESTS),
+        build
+    )
+
+
+@app.get("/api/tests/assigned")
+async def get_assigned_tests(
+    current_user: models.User = Depends(auth.get_current_active_user),
+    db: DbSession = Depends(get_session)
+):
+    """
+    Активные тесты, назначенные текущему пользователю лично или через группы
+
+    Список отсортирован по сроку (ближайшие первыми). Группы пользователя
+    и количество вопросов тестов берутся из кэшей в памяти.
+    """
+    tests = await run_db(db, assigned_tests.get_assigned_tests, current_user.id)
+
+    for test in tests:
+        test["deadline"] = format_datetime(test["deadline"])
+
+    return {"tests": tests, "total": len(tests)}
 
 
 @app.get("/api/tests/{test_id}")
-async def get_test(test_id: int, db: Session = Depends(get_db)):
+async def get_test(test_id: int, request: Request, db: DbSession = Depends(get_session)):
     """
     Получить детальную информацию о тесте
     """
-    test = db.query(models.Test).filter(models.Test.id == test_id).first()
+    def build(db: Session) -> dict:
+        # Тест вместе с количеством вопросов одним запросом
+        row = db.query(models.Test, question_loader.test_questions_count()).filter(
+            models.Test.id == test_id
+        ).first()
 
-    if not test:
-        raise HTTPException(status_code=404, detail="Test not found")
+        if not row:
+            raise HTTPException(status_code=404, detail="Test not found")
 
-    # Подсчет вопросов
-    questions_count = db.query(models.TestQuestion).filter(
-        models.TestQuestion.test_id == test.id
-    ).count()
+        test, questions_count = row
 
-    return {
-        "id": test.id,
-        "title": test.title,
-        "description": test.description,
-        "time_limit": test.time_limit_minutes,
-        "passing_score": float(test.passing_score),
-        "max_attempts": test.max_attempts,
-        "shuffle_questions": test.shuffle_questions,
-        "shuffle_answers": test.shuffle_answers,
-        "show_results": test.show_results,
-        "show_correct_answers": test.show_correct_answers,
-        "is_active": test.is_active,
-        "questions_count": questions_count,
-        "created_at": format_datetime(test.created_at)
-    }
+        return {
+            "id": test.id,
+            "title": test.title,
+            "description": test.description,
+            "time_limit": test.time_limit_minutes,
+            "passing_score": float(test.passing_score),
+            "max_attempts": test.max_attempts,
+            "shuffle_questions": test.shuffle_questions,
+            "shuffle_answers": test.shuffle_answers,
+            "show_results": test.show_results,
+            "show_correct_answers": test.show_correct_answers,
+            "is_active": test.is_active,
+            "questions_count": questions_count,
+            "created_at": format_datetime(test.created_at)
+        }
+
+    return await http_cache.cached_json(
+        request,
+        db,
+        ("test", test_id),
+        http_cache.row_validator(models.Test, test_id, http_cache.GENERATION_TESTS),
+        build
+    )
 
 
 @app.get("/api/tests/{test_id}/questions")
-async def get_test_questions(test_id: int, db: Session = Depends(get_db)):
+async def get_test_questions(test_id: int, request: Request, db: DbSession = Depends(get_session)):
     """
     Получить вопросы для конкретного теста
+
+    Ответ компилируется один раз и отдается из кэша готовым JSON,
+    пока не изменится tests.updated_at или состав вопросов теста.
+    Клиент с актуальным ETag получает 304 без тела.
     """
-    # Проверка существования теста
-    test = db.query(models.Test).filter(models.Test.id == test_id).first()
-    if not test:
+    entry = await run_db(db, payload_cache.get_compiled_test, test_id)
+
+    if entry is None:
         raise HTTPException(status_code=404, detail="Test not found")
 
-    # Получение вопросов теста через связующую таблицу
-    test_questions = db.query(models.TestQuestion).filter(
-        models.TestQuestion.test_id == test_id
-    ).order_by(models.TestQuestion.question_order).all()
-
-    questions_list = []
-    for tq in test_questions:
-        question = tq.question
-
-        # Получение вариантов ответов
-        answers = [
-            {
-                "id": a.id,
-                "text": a.answer_text,
-                "is_correct": a.is_correct if test.show_correct_answers else None,  # Скрываем правильные ответы если нужно
-                "order": a.option_order
-            }
-            for a in question.answer_options
-        ]
-
-        questions_list.append({
-            "id": question.id,
-            "question": question.question_text,
-            "answers": answers,
-            "difficulty": question.difficulty.value if question.difficulty else None,
-            "points": float(tq.points),
-            "order": tq.question_order
-        })
+    return http_cache.conditional_response(request, entry.body, entry.etag, entry.updated_at)
+
+
+@app.get("/api/tests/{test_id}/export/moodle")
+async def export_test_moodle(
+    test_id: int,
+    request: Request,
+    current_user: models.User = Depends(auth.get_current_staff_user),
+    db: DbSession = Depends(get_session)
+):
+    """
+    Экспорт теста в Moodle Quiz (Moodle XML)
+
+    Файл собирается один раз и отдается из кэша, пока не изменится
+    tests.updated_at или вопросы теста; повторный запрос с If-None-Match
+    получает 304 без тела.
+    """
+    export = await run_db(db, moodle_export.get_moodle_export, test_id)
+
+    if export is None:
+        raise HTTPException(status_code=404, detail="Test not found")
+
+    return http_cache.conditional_response(
+        request,
+        export.body,
+        export.etag,
+        export.updated_at,
+        policy=http_cache.POLICY_PRIVATE,
+        media_type="application/xml",
+        headers={"Content-Disposition": f'attachment; filename="test-{test_id}.xml"'}
+    )
+
+
+# =====================================================
+# ПРОХОЖДЕНИЕ ТЕСТОВ (SESSIONS)
+# =====================================================
+
+@app.post("/api/tests/{test_id}/sessions")
+async def start_test_session(
+    test_id: int,
+    current_user: models.User = Depends(auth.get_current_active_user),
+    db: DbSession = Depends(get_session)
+):
+    """
+    Начать прохождение теста текущим пользователем
+    """
+    return await run_db(db, session_engine.start_session, test_id, current_user.id)
+
+
+@app.post("/api/sessions/{session_id}/answers")
+async def save_session_answers(
+    session_id: int,
+    request: AnswersRequest,
+    current_user: models.User = Depends(auth.get_current_active_user),
+    db: DbSession = Depends(get_session)
+):
+    """
+    Сохранить ответы в буфер сессии
+
+    Ответы записываются в БД пачкой на контрольной точке или при завершении.
+    """
+    answers = [(a.question_id, a.option_id) for a in request.answers]
+    return await run_db(db, session_engine.record_answers, session_id, current_user.id, answers)
+
+
+@app.post("/api/sessions/{session_id}/submit")
+async def submit_test_session(
+    session_id: int,
+    request: SubmitRequest,
+    current_user: models.User = Depends(auth.get_current_active_user),
+    db: DbSession = Depends(get_session)
+):
+    """
+    Завершить прохождение теста и получить результат
+    """
+    answers = [(a.question_id, a.option_id) for a in request.answers]
+    return await run_db(db, session_engine.submit_session, session_id, current_user.id, answers)
+
+
+@app.post("/api/sessions/{session_id}/submissions", status_code=202)
+async def enqueue_test_submission(
+    session_id: int,
+    request: SubmitRequest,
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    """
+    Поставить завершение теста в очередь
+
+    Попытка принимается сразу, без обращения к БД; результат
+    доступен по квитанции через /api/submissions/{receipt_id}.
+    """
+    answers = [(a.question_id, a.option_id) for a in request.answers]
+    queue = submission_queue.submission_queue
+    submission = queue.submit(session_id, current_user.id, answers)
 
     return {
-        "test_id": test_id,
-        "test_title": test.title,
-        "questions": questions_list,
-        "total_questions": len(questions_list)
+        **submission.info(),
+        "position": queue.position(submission)
     }
 
 
+@app.get("/api/submissions/{receipt_id}")
+async def get_submission_status(
+    receipt_id: str,
+    current_user: models.User = Depends(auth.get_current_active_user),
+    db: DbSession = Depends(get_session)
+):
+    """
+    Состояние попытки по квитанции
+    """
+    queue = submission_queue.submission_queue
+    submission = queue.get(receipt_id)
+    if submission is not None:
+        if submission.user_id != current_user.id:
+            raise session_engine.session_forbidden()
+        info = submission.info()
+        if submission.status == submission_queue.RECEIPT_QUEUED:
+            info["position"] = queue.position(submission)
+        return info
+
+    # Квитанция другого воркера или до перезапуска - проверяем по БД
+    info = await run_db(db, submission_queue.receipt_from_db, receipt_id, current_user.id)
+    if info is None:
+        raise HTTPException(status_code=404, detail="Submission not found")
+    return info
+
+
+@app.get("/api/submissions")
+async def get_submission_queue_stats():
+    """
+    Состояние очереди завершения тестов
+    """
+    return submission_queue.submission_queue.stats()
+
+
+# =====================================================
+# ПЕРЕСЧЕТ РЕЗУЛЬТАТОВ (REGRADE)
+# =====================================================
+
+@app.post("/api/tests/{test_id}/regrade", status_code=202)
+async def regrade_test(
+    test_id: int,
+    current_user: models.User = Depends(auth.get_current_staff_user),
+    db: DbSession = Depends(get_session)
+):
+    """
+    Пересчитать правильность ответов и баллы всех сессий теста
+    по текущему ключу ответов
+
+    Пересчет идет в фоне; ход - через /api/regrade/{regrade_id}.
+    """
+    def exists(db: Session) -> bool:
+        return db.query(models.Test.id).filter(models.Test.id == test_id).first() is not None
+
+    if not await run_db(db, exists):
+        raise HTTPException(status_code=404, detail="Test not found")
+
+    return regrade.regrade_jobs.start(regrade.SCOPE_TEST, test_id).info()
+
+
+@app.post("/api/questions/{question_id}/regrade", status_code=202)
+async def regrade_question(
+    question_id: int,
+    current_user: models.User = Depends(auth.get_current_staff_user),
+    db: DbSession = Depends(get_session)
+):
+    """
+    Пересчитать ответы на вопрос и баллы сессий во всех тестах,
+    в которые входит вопрос
+
+    Пересчет идет в фоне; ход - через /api/regrade/{regrade_id}.
+    """
+    def exists(db: Session) -> bool:
+        return db.query(models.Question.id).filter(models.Question.id == question_id).first() is not None
+
+    if not await run_db(db, exists):
+        raise HTTPException(status_code=404, detail="Question not found")
+
+    return regrade.regrade_jobs.start(regrade.SCOPE_QUESTION, question_id).info()
+
+
+@app.get("/api/regrade/{regrade_id}")
+async def get_regrade_status(
+    regrade_id: str,
+    current_user: models.User = Depends(auth.get_current_staff_user)
+):
+    """
+    Ход пересчета результатов
+    """
+    progress = regrade.regrade_jobs.get(regrade_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Regrade not found")
+    return progress.info()
+
+
+# =====================================================
+# ЖУРНАЛ АУДИТА (AUDIT)
+# =====================================================
+
+def require_admin(claims: dict = Depends(auth.get_token_claims)) -> dict:
+    """Доступ только для роли admin (по claims токена)"""
+    if "admin" not in claims.get("roles", []):
+        raise HTTPException(status_code=403, detail="Требуется роль: admin")
+    return claims
+
+
+@app.get("/api/audit/stats")
+async def get_audit_stats(claims: dict = Depends(require_admin)):
+    """
+    Состояние буфера аудита: режим, ожидающие записи, вытесненные события
+    """
+    return audit.audit_pipeline.stats()
+
+
+@app.get("/api/audit/{table_name}/{record_id}")
+async def get_audit_history(
+    table_name: str,
+    record_id: int,
+    limit: int = 100,
+    before_id: Optional[int] = None,
+    claims: dict = Depends(require_admin),
+    db: DbSession = Depends(get_session)
+):
+    """
+    История изменений записи (users, tests, test_sessions), от новых к старым
+
+    Args:
+        limit: Максимальное количество записей
+        before_id: Курсор следующей страницы (next_before_id из предыдущего ответа)
+    """
+    if table_name not in {table.name for table in audit.AUDITED_TABLES.values()}:
+        raise HTTPException(status_code=404, detail="Table is not audited")
+
+    return await run_db(db, audit.get_record_history, table_name, record_id, limit, before_id)
+
+
+# =====================================================
+# ВЫГРУЗКА ДАННЫХ (EXPORT)
+# =====================================================
+
+def export_response(chunks, fmt: str, name: str) -> StreamingResponse:
+    """Потоковый ответ с выгрузкой в виде файла"""
+    return StreamingResponse(
+        chunks,
+        media_type=export_stream.MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'}
+    )
+
+
+def check_export_format(fmt: str):
+    """Проверить формат выгрузки"""
+    if fmt not in export_stream.EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'csv'")
+
+
+@app.get("/api/export/questions")
+async def export_questions(
+    format: str = export_stream.FORMAT_NDJSON,
+    approved: Optional[bool] = None,
+    source_document_id: Optional[int] = None
+):
+    """
+    Выгрузить банк вопросов с вариантами ответов (NDJSON или CSV)
+
+    Строки отдаются по мере чтения из БД, без сборки списка в памяти.
+    """
+    check_export_format(format)
+    return export_response(
+        export_stream.export_questions(format, approved, source_document_id),
+        format,
+        "questions"
+    )
+
+
+@app.get("/api/export/sessions")
+async def export_sessions(
+    format: str = export_stream.FORMAT_NDJSON,
+    test_id: Optional[int] = None,
+    user_id: Optional[int] = None,
+    current_user: models.User = Depends(auth.get_current_staff_user)
+):
+    """
+    Выгрузить сессии прохождения тестов (admin/teacher)
+    """
+    check_export_format(format)
+    return export_response(export_stream.export_sessions(format, test_id, user_id), format, "sessions")
+
+
+@app.get("/api/export/answers")
+async def export_answers(
+    format: str = export_stream.FORMAT_NDJSON,
+    test_id: Optional[int] = None,
+    session_id: Optional[int] = None,
+    current_user: models.User = Depends(auth.get_current_staff_user)
+):
+    """
+    Выгрузить ответы студентов (admin/teacher)
+    """
+    check_export_format(format)
+    return export_response(export_stream.export_answers(format, test_id, session_id), format, "answers")
+
+
 # =====================================================
 # СТАТИСТИКА И АНАЛИТИКА
 # =====================================================
 
+@app.get("/api/tests/{test_id}/analytics")
+async def get_test_analytics(
+    test_id: int,
+    request: Request,
+    current_user: models.User = Depends(auth.get_current_staff_user),
+    db: DbSession = Depends(get_session)
+):
+    """
+    Анализ заданий теста: трудность (p-value), дискриминативность,
+    статистика вариантов ответа, альфа Кронбаха
+
+    Анализ пересчитывается только при появлении новых ответов;
+    повторный запрос с If-None-Match получает 304 без тела.
+    """
+    analysis = await run_db(db, item_analysis.get_test_analysis, test_id)
+
+    if analysis is None:
+        raise HTTPException(status_code=404, detail="Test not found")
+
+    return http_cache.conditional_response(
+        request, analysis.body, analysis.etag, policy=http_cache.POLICY_PRIVATE
+    )
+
+
+@app.get("/api/questions/{question_id}/analytics")
+async def get_question_analytics(
+    question_id: int,
+    current_user: models.User = Depends(auth.get_current_staff_user),
+    db: DbSession = Depends(get_session)
+):
+    """
+    Показатели вопроса во всех тестах, в которые он входит
+    """
+    analysis = await run_db(db, item_analysis.get_question_analysis, question_id)
+
+    if analysis is None:
+        raise HTTPException(status_code=404, detail="Question not found")
+
+    return analysis
+
+
+@app.get("/api/stats/me")
+async def get_my_statistics(
+    tests: bool = False,
+    current_user: models.User = Depends(auth.get_current_active_user),
+    db: DbSession = Depends(get_session)
+):
+    """
+    Статистика прохождения тестов текущим пользователем
+
+    Читается из сводных таблиц user_stats / user_test_stats
+    по первичному ключу (tests=true - с разбивкой по тестам).
+    """
+    return await run_db(db, user_stats.get_user_statistics, current_user.id, tests)
+
+
+@app.get("/api/stats/users/{user_id}")
+async def get_user_statistics(
+    user_id: int,
+    tests: bool = False,
+    claims: dict = Depends(auth.get_token_claims),
+    db: DbSession = Depends(get_session)
+):
+    """
+    Статистика прохождения тестов пользователем (свои данные или роль admin/teacher)
+    """
+    if int(claims["sub"]) != user_id and not set(claims.get("roles", [])) & set(auth.STAFF_ROLES):
+        raise HTTPException(status_code=403, detail="Требуется роль: admin или teacher")
+
+    return await run_db(db, user_stats.get_user_statistics, user_id, tests)
+
+
+@app.post("/api/stats/rebuild")
+async def rebuild_user_statistics(
+    test_id: Optional[List[int]] = Query(None),
+    claims: dict = Depends(require_admin),
+    db: DbSession = Depends(get_session)
+):
+    """
+    Пересобрать сводные таблицы user_stats / user_test_stats по test_sessions
+
+    Исправляет расхождения счетчиков после изменений в обход приложения.
+
+    Args:
+        test_id: Пересобрать только указанные тесты (по умолчанию - все)
+    """
+    return await run_db(db, user_stats.rebuild_and_commit, test_id)
+
+
 @app.get("/api/stats/overview")
 async def get_stats_overview(db: Session = Depends(get_db)):
     """
     Получить общую статистику системы
+
+    Данные отдаются из снимка в памяти; если снимок устарел,
+    он пересобирается агрегирующими запросами (по одному на таблицу).
     """
     try:
-        stats = {
-            "users": {
-                "total": db.query(models.User).count(),
-                "active": db.query(models.User).filter(models.User.is_active == True).count()
-            },
-            "questions": {
-                "total": db.query(models.Question).count(),
-                "approved": db.query(models.Question).filter(models.Question.is_approved == True).count(),
-                "by_difficulty": {
-                    "easy": db.query(models.Question).filter(models.Question.difficulty == "easy").count(),
-                    "medium": db.query(models.Question).filter(models.Question.difficulty == "medium").count(),
-                    "hard": db.query(models.Question).filter(models.Question.difficulty == "hard").count()
-                }
-            },
-            "tests": {
-                "total": db.query(models.Test).count(),
-                "active": db.query(models.Test).filter(models.Test.is_active == True).count()
-            },
-            "sessions": {
-                "total": db.query(models.TestSession).count(),
-                "completed": db.query(models.TestSession).filter(
-                    models.TestSession.status == "completed"
-                ).count(),
-                "in_progress": db.query(models.TestSession).filter(
-                    models.TestSession.status == "in_progress"
-                ).count()
-            },
-            "documents": {
-                "total": db.query(models.SourceDocument).count(),
-                "processed": db.query(models.SourceDocument).filter(
-                    models.SourceDocument.status == "completed"
-                ).count()
-            }
-        }
-
-        return stats
+        overview = dict(stats.stats_cache.get(db))
+        overview["snapshot"] = stats.stats_cache.info()
+        return overview
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching statistics: {str(e)}")
@@ -249,7 +249,12 @@ class Question(Base):
     source_document = relationship("SourceDocument", back_populates="questions")
     creator = relationship("User", back_populates="created_questions", foreign_keys=[creator_id])
     approver = relationship("User", back_populates="approved_questions", foreign_keys=[approved_by])
-    answer_options = relationship("AnswerOption", back_populates="question", cascade="all, delete-orphan")
+    answer_options = relationship(
+        "AnswerOption",
+        back_populates="question",
+        cascade="all, delete-orphan",
+        order_by="AnswerOption.option_order"
+    )
     test_questions = relationship("TestQuestion", back_populates="question")
     user_answers = relationship("UserAnswer", back_populates="question")
 
@@ -257,6 +262,8 @@ class Question(Base):
         Index('idx_source_document_id', 'source_document_id'),
         Index('idx_creator_id', 'creator_id'),
         Index('idx_is_approved', 'is_approved'),
+        Index('idx_created_at', 'created_at'),
+        Index('idx_updated_at', 'updated_at'),
     )
 
     def __repr__(self):
@@ -474,6 +481,71 @@ class UserAnswer(Base):
     )
 
 
+# =====================================================
+# СВОДНАЯ СТАТИСТИКА ПОЛЬЗОВАТЕЛЕЙ
+# =====================================================
+
+class UserStats(Base):
+    """Счетчики сессий пользователя (ведутся приложением, см. user_stats.py)"""
+    __tablename__ = "user_stats"
+
+    user_id = Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    total_sessions = Column(Integer, nullable=False, default=0, comment="Всего сессий")
+    completed_sessions = Column(Integer, nullable=False, default=0, comment="Завершенных сессий")
+    score_sum = Column(DECIMAL(14, 2), nullable=False, default=0, comment="Сумма баллов завершенных сессий")
+    passed_tests = Column(Integer, nullable=False, default=0, comment="Пройденных попыток")
+    failed_tests = Column(Integer, nullable=False, default=0, comment="Непройденных попыток")
+    updated_at = Column(
+        TIMESTAMP,
+        nullable=False,
+        server_default=func.current_timestamp(),
+        onupdate=func.current_timestamp()
+    )
+
+
+class UserTestStats(Base):
+    """Счетчики сессий пользователя по тесту (ведутся приложением, см. user_stats.py)"""
+    __tablename__ = "user_test_stats"
+
+    user_id = Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    test_id = Column(BigInteger, ForeignKey("tests.id", ondelete="CASCADE"), primary_key=True)
+    total_sessions = Column(Integer, nullable=False, default=0, comment="Всего сессий")
+    completed_sessions = Column(Integer, nullable=False, default=0, comment="Завершенных сессий")
+    score_sum = Column(DECIMAL(14, 2), nullable=False, default=0, comment="Сумма баллов завершенных сессий")
+    passed_tests = Column(Integer, nullable=False, default=0, comment="Пройденных попыток")
+    failed_tests = Column(Integer, nullable=False, default=0, comment="Непройденных попыток")
+    updated_at = Column(
+        TIMESTAMP,
+        nullable=False,
+        server_default=func.current_timestamp(),
+        onupdate=func.current_timestamp()
+    )
+
+    __table_args__ = (
+        Index('idx_test_id', 'test_id'),
+    )
+
+
+# =====================================================
+# ОТОЗВАННЫЕ ТОКЕНЫ
+# =====================================================
+
+class RevokedToken(Base):
+    """Токен доступа, отозванный до истечения срока (см. tokens.py)"""
+    __tablename__ = "revoked_tokens"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    jti = Column(String(32), nullable=False, comment="Идентификатор токена")
+    user_id = Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    expires_at = Column(TIMESTAMP, nullable=False, comment="Срок действия токена")
+    revoked_at = Column(TIMESTAMP, nullable=False, server_default=func.current_timestamp())
+
+    __table_args__ = (
+        Index('unique_jti', 'jti', unique=True),
+        Index('idx_expires_at', 'expires_at'),
+    )
+
+
 # =====================================================
 # СИСТЕМА АУДИТА
 # =====================================================
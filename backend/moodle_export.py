@@ -0,0 +1,219 @@
+"""
+Экспорт тестов в Moodle Quiz (формат Moodle XML).
+
+XML пишется последовательно, фрагмент за фрагментом, без построения
+DOM: строки одного JOIN-запроса test_questions/questions/answer_options
+идут в порядке вопросов теста, и каждый вопрос записывается, как только
+прочитаны все его варианты ответа. Готовый файл хранится в кэше по
+(test_id, tests.updated_at) вместе с ETag и сбрасывается при изменении
+вопросов теста так же, как кэш /api/tests/{id}/questions.
+"""
+
+import hashlib
+import io
+import os
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable, Iterable, List, Optional, Set
+from xml.sax.saxutils import escape
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import models
+import payload_cache
+
+# Максимальное количество тестов в кэше экспорта
+MOODLE_EXPORT_CACHE_SIZE = int(os.getenv("MOODLE_EXPORT_CACHE_SIZE", "64"))
+
+# Длина названия вопроса, если moodle_name не задан
+QUESTION_NAME_LENGTH = 50
+
+# Категория банка вопросов Moodle, в которую импортируется тест
+CATEGORY_PREFIX = "$course$/top/TestGen"
+
+
+@dataclass
+class MoodleExport:
+    """Готовый Moodle XML теста"""
+    test_id: int
+    updated_at: Optional[datetime]
+    body: bytes
+    etag: str
+    question_ids: Set[int] = field(default_factory=set)
+
+
+def export_rows(db: Session, test_id: int) -> Iterable[Any]:
+    """
+    Вопросы теста с вариантами ответов и полями Moodle одним JOIN-запросом
+
+    Строки идут в порядке вопросов теста, внутри вопроса - в порядке
+    вариантов ответа.
+    """
+    question = models.Question
+    option = models.AnswerOption
+    link = models.TestQuestion
+    return db.execute(
+        select(
+            question.id.label("question_id"),
+            question.question_text,
+            question.moodle_name,
+            question.default_grade,
+            question.penalty,
+            question.shuffle_answers,
+            option.answer_text,
+            option.is_correct
+        )
+        .select_from(link)
+        .join(question, question.id == link.question_id)
+        .outerjoin(option, option.question_id == question.id)
+        .where(link.test_id == test_id)
+        .order_by(link.question_order, link.id, option.option_order, option.id)
+    )
+
+
+def grade_fraction(count: int) -> str:
+    """Доля оценки 100/count в записи Moodle (50, 33.33333, 25, ...)"""
+    return f"{100 / count:.5f}".rstrip("0").rstrip(".")
+
+
+def decimal_text(value: Any, default: float) -> str:
+    """Число в формате Moodle XML (7 знаков после запятой)"""
+    return f"{float(value if value is not None else default):.7f}"
+
+
+def question_name(text: str, moodle_name: Optional[str]) -> str:
+    """Название вопроса: moodle_name или начало текста"""
+    if moodle_name:
+        return moodle_name
+    text = " ".join(text.split())
+    return text if len(text) <= QUESTION_NAME_LENGTH else text[:QUESTION_NAME_LENGTH - 3] + "..."
+
+
+def write_question(write: Callable[[str], Any], row: Any, answers: List[Any]):
+    """
+    Записать вопрос multichoice
+
+    Один правильный вариант - single=true с долей 100; несколько -
+    single=false, правильные делят 100%, неправильные - минус 100%.
+    """
+    correct = sum(1 for answer in answers if answer.is_correct)
+    wrong = len(answers) - correct
+    single = correct <= 1
+
+    write('  <question type="multichoice">\n')
+    write(f"    <name><text>{escape(question_name(row.question_text, row.moodle_name))}</text></name>\n")
+    write(f'    <questiontext format="plain_text"><text>{escape(row.question_text)}</text></questiontext>\n')
+    write(f"    <defaultgrade>{decimal_text(row.default_grade, 1.0)}</defaultgrade>\n")
+    write(f"    <penalty>{decimal_text(row.penalty, 0.3333333)}</penalty>\n")
+    write("    <hidden>0</hidden>\n")
+    write(f"    <single>{'true' if single else 'false'}</single>\n")
+    write(f"    <shuffleanswers>{'true' if row.shuffle_answers is not False else 'false'}</shuffleanswers>\n")
+    write("    <answernumbering>abc</answernumbering>\n")
+
+    for answer in answers:
+        if answer.is_correct:
+            fraction = grade_fraction(correct)
+        elif single or wrong == 0:
+            fraction = "0"
+        else:
+            fraction = "-" + grade_fraction(wrong)
+        write(
+            f'    <answer fraction="{fraction}" format="plain_text">'
+            f"<text>{escape(answer.answer_text)}</text></answer>\n"
+        )
+
+    write("  </question>\n")
+
+
+def write_quiz(write: Callable[[str], Any], title: str, rows: Iterable[Any]) -> Set[int]:
+    """
+    Записать Moodle XML теста по строкам export_rows()
+
+    Args:
+        write: Функция записи фрагмента текста
+        title: Название теста (категория в банке вопросов Moodle)
+        rows: Строки export_rows()
+
+    Returns:
+        ID записанных вопросов
+    """
+    write('<?xml version="1.0" encoding="UTF-8"?>\n<quiz>\n')
+    write('  <question type="category">\n')
+    write(f"    <category><text>{escape(CATEGORY_PREFIX + '/' + title.replace('/', '-'))}</text></category>\n")
+    write("  </question>\n")
+
+    question_ids: Set[int] = set()
+    current = None
+    answers: List[Any] = []
+    for row in rows:
+        if current is None or row.question_id != current.question_id:
+            if current is not None:
+                write_question(write, current, answers)
+            current = row
+            answers = []
+            question_ids.add(row.question_id)
+        if row.answer_text is not None:
+            answers.append(row)
+    if current is not None:
+        write_question(write, current, answers)
+
+    write("</quiz>\n")
+    return question_ids
+
+
+def compile_moodle_export(db: Session, test: Any) -> MoodleExport:
+    """
+    Собрать Moodle XML теста
+
+    Args:
+        db: Сессия базы данных
+        test: Строка теста (id, title, updated_at)
+
+    Returns:
+        Готовый экспорт с ETag
+    """
+    output = io.StringIO()
+    question_ids = write_quiz(output.write, test.title, export_rows(db, test.id))
+    body = output.getvalue().encode("utf-8")
+
+    return MoodleExport(
+        test_id=test.id,
+        updated_at=test.updated_at,
+        body=body,
+        etag='"' + hashlib.sha1(body).hexdigest() + '"',
+        question_ids=question_ids
+    )
+
+
+# Кэш экспорта, сбрасываемый вместе с кэшем ответов тестов
+moodle_export_cache = payload_cache.TestPayloadCache(max_tests=MOODLE_EXPORT_CACHE_SIZE)
+payload_cache.register_cache(moodle_export_cache)
+
+
+def get_moodle_export(db: Session, test_id: int) -> Optional[MoodleExport]:
+    """
+    Moodle XML теста из кэша или из БД
+
+    Args:
+        db: Сессия базы данных
+        test_id: ID теста
+
+    Returns:
+        Экспорт или None, если теста нет
+    """
+    test = db.query(
+        models.Test.id,
+        models.Test.title,
+        models.Test.updated_at
+    ).filter(models.Test.id == test_id).first()
+
+    if test is None:
+        return None
+
+    entry = moodle_export_cache.get(test.id, test.updated_at)
+    if entry is None:
+        entry = compile_moodle_export(db, test)
+        moodle_export_cache.put(entry)
+
+    return entry
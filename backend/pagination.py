@@ -0,0 +1,217 @@
+"""
+Пагинация списков: классическая offset/limit и keyset (курсорная).
+
+Курсорный режим сортирует записи по ключу (created_at DESC, id DESC)
+и продолжает выборку условием "строго после последней записи страницы",
+что позволяет MariaDB идти по индексу idx_created_at без пропуска
+OFFSET строк. Курсор - непрозрачная строка, кодирующая этот ключ.
+"""
+
+import base64
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import and_, or_, text
+from sqlalchemy.orm import Query, Session
+
+# Режимы подсчета общего количества записей
+COUNT_EXACT = "exact"
+COUNT_ESTIMATE = "estimate"
+COUNT_NONE = "none"
+COUNT_MODES = (COUNT_EXACT, COUNT_ESTIMATE, COUNT_NONE)
+
+# Время жизни кэша оценок количества строк (секунды)
+ESTIMATE_TTL_SECONDS = 300
+
+# Кэш оценок: имя таблицы -> (время получения, количество строк)
+_estimate_cache: Dict[str, Tuple[float, int]] = {}
+
+CursorKey = Tuple[datetime, int]
+
+
+def encode_cursor(created_at: datetime, record_id: int) -> str:
+    """
+    Закодировать ключ сортировки в непрозрачный курсор
+
+    Args:
+        created_at: Время создания последней записи страницы
+        record_id: ID последней записи страницы
+
+    Returns:
+        Строка курсора (base64url)
+    """
+    raw = f"{created_at.isoformat()}|{record_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[CursorKey]:
+    """
+    Раскодировать курсор, полученный от клиента
+
+    Args:
+        cursor: Строка курсора или None
+
+    Returns:
+        Кортеж (created_at, id) или None, если курсор не передан
+
+    Raises:
+        HTTPException: Если курсор поврежден
+    """
+    if not cursor:
+        return None
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8")
+        created_at_str, record_id_str = raw.split("|", 1)
+        return datetime.fromisoformat(created_at_str), int(record_id_str)
+    except (ValueError, UnicodeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Некорректный курсор пагинации"
+        )
+
+
+def check_count_mode(count: str) -> str:
+    """
+    Проверить режим подсчета общего количества
+
+    Args:
+        count: exact, estimate или none
+
+    Returns:
+        Режим подсчета
+
+    Raises:
+        HTTPException: Если режим неизвестен
+    """
+    if count not in COUNT_MODES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Параметр count должен быть одним из: {', '.join(COUNT_MODES)}"
+        )
+    return count
+
+
+def paginate(
+    query: Query,
+    model: Any,
+    limit: int,
+    offset: int = 0,
+    after: Optional[CursorKey] = None
+) -> List[Any]:
+    """
+    Выбрать страницу записей, отсортированных по (created_at DESC, id DESC)
+
+    Если передан курсор, offset игнорируется и используется seek-условие
+    по индексу created_at; иначе - обычный OFFSET.
+
+    Args:
+        query: Запрос с уже примененными фильтрами
+        model: Модель с колонками created_at и id
+        limit: Размер страницы
+        offset: Смещение (только без курсора)
+        after: Ключ последней записи предыдущей страницы
+
+    Returns:
+        Список записей страницы
+    """
+    if after is not None:
+        created_at, record_id = after
+        query = query.filter(
+            or_(
+                model.created_at < created_at,
+                and_(model.created_at == created_at, model.id < record_id)
+            )
+        )
+
+    query = query.order_by(model.created_at.desc(), model.id.desc())
+
+    if after is None and offset:
+        query = query.offset(offset)
+
+    return query.limit(limit).all()
+
+
+def next_cursor(rows: List[Any], limit: int) -> Optional[str]:
+    """
+    Курсор для следующей страницы
+
+    Args:
+        rows: Записи текущей страницы
+        limit: Запрошенный размер страницы
+
+    Returns:
+        Курсор или None, если страница последняя
+    """
+    if not rows or len(rows) < limit:
+        return None
+    last = rows[-1]
+    return encode_cursor(last.created_at, last.id)
+
+
+def estimate_table_rows(db: Session, table_name: str) -> Optional[int]:
+    """
+    Оценка количества строк таблицы по статистике InnoDB
+
+    Значение берется из information_schema.TABLES и кэшируется
+    в памяти процесса на ESTIMATE_TTL_SECONDS.
+
+    Args:
+        db: Сессия базы данных
+        table_name: Имя таблицы
+
+    Returns:
+        Оценка количества строк или None, если статистика недоступна
+    """
+    now = time.monotonic()
+    cached = _estimate_cache.get(table_name)
+    if cached and now - cached[0] < ESTIMATE_TTL_SECONDS:
+        return cached[1]
+
+    try:
+        rows = db.execute(
+            text(
+                "SELECT TABLE_ROWS FROM information_schema.TABLES "
+                "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name"
+            ),
+            {"table_name": table_name}
+        ).scalar()
+    except Exception:
+        db.rollback()
+        return None
+
+    if rows is None:
+        return None
+
+    _estimate_cache[table_name] = (now, int(rows))
+    return int(rows)
+
+
+def count_total(db: Session, query: Query, model: Any, count: str) -> Optional[int]:
+    """
+    Общее количество записей в выбранном режиме
+
+    Режим estimate возвращает оценку размера всей таблицы без учета фильтров;
+    если статистика недоступна, выполняется точный COUNT.
+
+    Args:
+        db: Сессия базы данных
+        query: Запрос с примененными фильтрами
+        model: Модель, по таблице которой делается оценка
+        count: exact, estimate или none
+
+    Returns:
+        Количество записей или None для режима none
+    """
+    if count == COUNT_NONE:
+        return None
+
+    if count == COUNT_ESTIMATE:
+        estimate = estimate_table_rows(db, model.__tablename__)
+        if estimate is not None:
+            return estimate
+
+    return query.count()
@@ -0,0 +1,423 @@
+"""
+Кэш скомпилированных ответов /api/tests/{id}/questions.
+
+Ответ для теста собирается одним JOIN-запросом (как sp_get_test_questions),
+сериализуется в JSON один раз и хранится в памяти процесса в виде готовых
+байтов. Запись проверяется по версии теста: tests.updated_at и отпечаток
+содержимого (количество, максимальные id и суммы по test_questions
+и answer_options, MAX(questions.updated_at)), которые читаются тем же
+запросом, что и строка теста. Так видны изменения, сделанные другими
+процессами и в обход ORM, в том числе исправление правильного ответа.
+Правки, не меняющие отпечаток (например, текста варианта ответа
+в другом процессе), видны не позже чем через TEST_PAYLOAD_TTL_SECONDS.
+
+Изменения test_questions, вопросов и вариантов ответов, сделанные через
+сессии этого процесса, сбрасывают записи затронутых тестов сразу.
+Запись, собранная по данным, прочитанным до такого сброса, в кэш
+не сохраняется.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import case, event, func
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+import fast_json
+import models
+import question_loader
+
+# Максимальное количество тестов в кэше
+TEST_PAYLOAD_CACHE_SIZE = int(os.getenv("TEST_PAYLOAD_CACHE_SIZE", "256"))
+
+# Время жизни скомпилированного ответа (секунды)
+TEST_PAYLOAD_TTL_SECONDS = float(os.getenv("TEST_PAYLOAD_TTL_SECONDS", "60"))
+
+
+# Колонки строки теста для сборки ответа
+_TEST_COLUMNS = (
+    models.Test.id,
+    models.Test.title,
+    models.Test.updated_at,
+    models.Test.show_correct_answers,
+    models.Test.passing_score,
+    models.Test.show_results,
+)
+
+
+@dataclass
+class CompiledTestPayload:
+    """Скомпилированный ответ для теста и ключ ответов для проверки"""
+    test_id: int
+    updated_at: Optional[datetime]
+    # Версия теста: (tests.updated_at, отпечаток содержимого), см. test_version()
+    version: Tuple
+    body: bytes
+    question_ids: Set[int] = field(default_factory=set)
+    # ETag тела ответа
+    etag: str = ""
+    # question_id -> ID правильных вариантов ответа
+    answer_key: Dict[int, Set[int]] = field(default_factory=dict)
+    # option_id -> question_id
+    option_questions: Dict[int, int] = field(default_factory=dict)
+    # question_id -> баллы за правильный ответ (TestQuestion.points)
+    question_points: Dict[int, float] = field(default_factory=dict)
+    passing_score: float = 0.0
+    show_results: bool = True
+    # time.monotonic() сборки
+    compiled_at: float = field(default_factory=time.monotonic)
+
+
+def _test_version_columns() -> List[Any]:
+    """
+    Колонки отпечатка содержимого теста
+
+    Добавление, удаление и переупорядочивание вопросов и вариантов,
+    смена баллов и правильных ответов, правка вопроса (updated_at)
+    меняют хотя бы одно значение.
+    """
+    test_question = models.TestQuestion
+    option = models.AnswerOption
+    return [
+        func.count(test_question.id),
+        func.max(test_question.id),
+        func.sum(test_question.question_order),
+        func.sum(test_question.points),
+        func.max(models.Question.updated_at),
+        func.count(option.id),
+        func.max(option.id),
+        func.sum(option.option_order),
+        func.sum(case((option.is_correct == True, option.id), else_=0)),
+    ]
+
+
+def test_version(test: Any) -> Tuple:
+    """Версия теста из строки запроса get_compiled_test()"""
+    return (test.updated_at,) + tuple(
+        value if value is None or isinstance(value, datetime) else float(value)
+        for value in test[len(_TEST_COLUMNS):]
+    )
+
+
+def dump_json(payload) -> bytes:
+    """Сериализация в JSON в том же формате, что и JSONResponse FastAPI"""
+    return fast_json.dumps(payload)
+
+
+def compile_test_payload(db: Session, test: models.Test) -> CompiledTestPayload:
+    """
+    Собрать ответ для теста одним JOIN-запросом
+
+    Args:
+        db: Сессия базы данных
+        test: Строка теста (id, title, updated_at, show_correct_answers,
+            passing_score, show_results)
+
+    Returns:
+        Скомпилированный ответ
+    """
+    questions_list = []
+    by_id: Dict[int, dict] = {}
+    answer_key: Dict[int, Set[int]] = {}
+    option_questions: Dict[int, int] = {}
+    question_points: Dict[int, float] = {}
+
+    for row in question_loader.test_question_rows(db, test.id):
+        question = by_id.get(row.question_id)
+        if question is None:
+            question = {
+                "id": row.question_id,
+                "question": row.question_text,
+                "answers": [],
+                "points": float(row.points),
+                "order": row.question_order
+            }
+            by_id[row.question_id] = question
+            questions_list.append(question)
+            answer_key[row.question_id] = set()
+            question_points[row.question_id] = float(row.points)
+
+        if row.option_id is not None:
+            option_questions[row.option_id] = row.question_id
+            if row.is_correct:
+                answer_key[row.question_id].add(row.option_id)
+            question["answers"].append({
+                "id": row.option_id,
+                "text": row.answer_text,
+                "is_correct": row.is_correct if test.show_correct_answers else None,  # Скрываем правильные ответы если нужно
+                "order": row.option_order
+            })
+
+    body = dump_json({
+        "test_id": test.id,
+        "test_title": test.title,
+        "questions": questions_list,
+        "total_questions": len(questions_list)
+    })
+
+    return CompiledTestPayload(
+        test_id=test.id,
+        updated_at=test.updated_at,
+        version=test_version(test),
+        body=body,
+        question_ids=set(by_id),
+        etag='"' + hashlib.sha1(body).hexdigest() + '"',
+        answer_key=answer_key,
+        option_questions=option_questions,
+        question_points=question_points,
+        passing_score=float(test.passing_score),
+        show_results=bool(test.show_results)
+    )
+
+
+class TestPayloadCache:
+    """
+    LRU-кэш скомпилированных ответов по test_id
+    """
+
+    def __init__(self, max_tests: int = TEST_PAYLOAD_CACHE_SIZE, ttl_seconds: float = TEST_PAYLOAD_TTL_SECONDS):
+        self.max_tests = max_tests
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, CompiledTestPayload]" = OrderedDict()
+        # Обратный индекс: question_id -> тесты, в которые входит вопрос
+        self._tests_by_question: Dict[int, Set[int]] = {}
+        # Растет при каждом сбросе записей
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self) -> int:
+        """Номер поколения; запоминается до чтения данных теста для put()"""
+        with self._lock:
+            return self._generation
+
+    def get(self, test_id: int, version: Tuple) -> Optional[CompiledTestPayload]:
+        """
+        Получить актуальный ответ для теста
+
+        Args:
+            test_id: ID теста
+            version: Текущая версия теста (test_version())
+
+        Returns:
+            Скомпилированный ответ или None
+        """
+        with self._lock:
+            entry = self._entries.get(test_id)
+            if (
+                entry is None
+                or entry.version != version
+                or time.monotonic() - entry.compiled_at >= self.ttl_seconds
+            ):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(test_id)
+            self.hits += 1
+            return entry
+
+    def put(self, entry: CompiledTestPayload, generation: int) -> bool:
+        """
+        Сохранить скомпилированный ответ
+
+        Args:
+            entry: Скомпилированный ответ
+            generation: Значение generation() до чтения данных теста
+
+        Returns:
+            False, если с тех пор записи сбрасывались и ответ мог устареть
+        """
+        with self._lock:
+            if generation != self._generation:
+                return False
+            self._drop(entry.test_id)
+            self._entries[entry.test_id] = entry
+            for question_id in entry.question_ids:
+                self._tests_by_question.setdefault(question_id, set()).add(entry.test_id)
+            while len(self._entries) > self.max_tests:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+            return True
+
+    def _drop(self, test_id: int):
+        """Удалить запись теста (вызывается под блокировкой)"""
+        entry = self._entries.pop(test_id, None)
+        if entry is None:
+            return
+        for question_id in entry.question_ids:
+            tests = self._tests_by_question.get(question_id)
+            if tests is not None:
+                tests.discard(test_id)
+                if not tests:
+                    del self._tests_by_question[question_id]
+
+    def invalidate_tests(self, test_ids: Iterable[int]):
+        """Сбросить записи тестов"""
+        test_ids = list(test_ids)
+        if not test_ids:
+            return
+        with self._lock:
+            self._generation += 1
+            for test_id in test_ids:
+                self._drop(test_id)
+
+    def invalidate_questions(self, question_ids: Iterable[int]):
+        """Сбросить записи всех тестов, содержащих вопросы"""
+        question_ids = list(question_ids)
+        if not question_ids:
+            return
+        with self._lock:
+            # Вопрос мог попасть в тест, который сейчас собирается
+            self._generation += 1
+            test_ids: Set[int] = set()
+            for question_id in question_ids:
+                test_ids |= self._tests_by_question.get(question_id, set())
+            for test_id in test_ids:
+                self._drop(test_id)
+
+    def clear(self):
+        """Сбросить весь кэш"""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._tests_by_question.clear()
+
+
+# Общий кэш ответов приложения
+test_payload_cache = TestPayloadCache()
+
+# Кэши, записи которых строятся из вопросов тестов и сбрасываются вместе
+_test_caches: List[Any] = [test_payload_cache]
+
+
+def register_cache(cache: Any):
+    """
+    Подключить кэш с записями по тестам к общей инвалидации
+
+    Подойдет любой объект с методами invalidate_tests(test_ids)
+    и invalidate_questions(question_ids).
+    """
+    _test_caches.append(cache)
+
+
+def get_compiled_test(db: Session, test_id: int) -> Optional[CompiledTestPayload]:
+    """
+    Скомпилированный тест из кэша или из БД
+
+    На попадании в кэш выполняется один запрос (строка теста с версией),
+    на промахе - еще один JOIN-запрос для сборки ответа.
+
+    Args:
+        db: Сессия базы данных
+        test_id: ID теста
+
+    Returns:
+        Скомпилированный тест или None, если теста нет
+    """
+    generation = test_payload_cache.generation()
+    test = (
+        db.query(*_TEST_COLUMNS, *_test_version_columns())
+        .select_from(models.Test)
+        .outerjoin(models.TestQuestion, models.TestQuestion.test_id == models.Test.id)
+        .outerjoin(models.Question, models.Question.id == models.TestQuestion.question_id)
+        .outerjoin(models.AnswerOption, models.AnswerOption.question_id == models.Question.id)
+        .filter(models.Test.id == test_id)
+        .group_by(*_TEST_COLUMNS)
+        .first()
+    )
+
+    if test is None:
+        return None
+
+    entry = test_payload_cache.get(test.id, test_version(test))
+    if entry is None:
+        entry = compile_test_payload(db, test)
+        test_payload_cache.put(entry, generation)
+
+    return entry
+
+
+def get_test_payload(db: Session, test_id: int) -> Optional[bytes]:
+    """
+    Готовый JSON-ответ /api/tests/{id}/questions
+
+    Args:
+        db: Сессия базы данных
+        test_id: ID теста
+
+    Returns:
+        Тело ответа в JSON или None, если теста нет
+    """
+    entry = get_compiled_test(db, test_id)
+    return entry.body if entry is not None else None
+
+
+# =====================================================
+# ИНВАЛИДАЦИЯ ПРИ ИЗМЕНЕНИИ ДАННЫХ ТЕСТА
+# =====================================================
+
+def note_question_changes(session: Session, question_ids: Iterable[int]):
+    """
+    Учесть вопросы, измененные в обход ORM (массовые UPDATE/DELETE)
+
+    Такие изменения не попадают в session.dirty, поэтому записи
+    тестов сбрасываются так же, как после flush: при фиксации транзакции.
+    """
+    session.info.setdefault("payload_cache_questions", set()).update(question_ids)
+
+
+def note_test_changes(session: Session, test_ids: Iterable[int]):
+    """
+    Учесть тесты, результаты или ключ ответов которых изменены в обход ORM
+
+    Записи всех подключенных кэшей для этих тестов сбрасываются
+    при фиксации транзакции.
+    """
+    session.info.setdefault("payload_cache_tests", set()).update(test_ids)
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_payload_changes(session: Session, flush_context):
+    """Запомнить тесты и вопросы, измененные в этой транзакции"""
+    tests: Set[int] = session.info.setdefault("payload_cache_tests", set())
+    questions: Set[int] = session.info.setdefault("payload_cache_questions", set())
+
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, models.TestQuestion):
+            if obj.test_id is not None:
+                tests.add(obj.test_id)
+            if obj.question_id is not None:
+                questions.add(obj.question_id)
+        elif isinstance(obj, models.AnswerOption):
+            if obj.question_id is not None:
+                questions.add(obj.question_id)
+        elif isinstance(obj, models.Question):
+            if obj.id is not None:
+                questions.add(obj.id)
+        elif isinstance(obj, models.Test):
+            if obj.id is not None:
+                tests.add(obj.id)
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _apply_payload_changes(session: Session):
+    """Сбросить затронутые записи после фиксации транзакции"""
+    tests = session.info.pop("payload_cache_tests", set())
+    questions = session.info.pop("payload_cache_questions", set())
+    for cache in _test_caches:
+        cache.invalidate_tests(tests)
+        cache.invalidate_questions(questions)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_payload_changes(session: Session):
+    """Забыть изменения отмененной транзакции"""
+    session.info.pop("payload_cache_tests", None)
+    session.info.pop("payload_cache_questions", None)
@@ -0,0 +1,124 @@
+"""
+Метрики пула соединений SQLAlchemy.
+
+Пул с измерением времени ожидания соединения: каждая выдача соединения
+из пула попадает в гистограмму времени ожидания, таймауты считаются
+отдельно. Вместе с текущим состоянием пула (занято, overflow) это
+позволяет подбирать pool_size под количество воркеров uvicorn.
+"""
+
+import bisect
+import threading
+import time
+from typing import Any, Dict, List
+
+from sqlalchemy import exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Границы корзин гистограммы времени ожидания (миллисекунды)
+WAIT_BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+class PoolWaitHistogram:
+    """
+    Гистограмма времени ожидания соединения из пула
+    """
+
+    def __init__(self, buckets_ms: List[float] = WAIT_BUCKETS_MS):
+        self.buckets_ms = list(buckets_ms)
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.buckets_ms) + 1)
+        self._sum_ms = 0.0
+        self._max_ms = 0.0
+        self._timeouts = 0
+
+    def observe(self, wait_ms: float):
+        """Учесть одно ожидание соединения"""
+        index = bisect.bisect_left(self.buckets_ms, wait_ms)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum_ms += wait_ms
+            self._max_ms = max(self._max_ms, wait_ms)
+
+    def observe_timeout(self):
+        """Учесть таймаут ожидания соединения"""
+        with self._lock:
+            self._timeouts += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Текущее состояние гистограммы (кумулятивные корзины)"""
+        with self._lock:
+            counts = list(self._counts)
+            total = sum(counts)
+            buckets = {}
+            cumulative = 0
+            for bound, count in zip(self.buckets_ms, counts):
+                cumulative += count
+                buckets[f"le_{bound}ms"] = cumulative
+            buckets["le_inf"] = total
+
+            return {
+                "count": total,
+                "sum_ms": round(self._sum_ms, 3),
+                "avg_ms": round(self._sum_ms / total, 3) if total else 0.0,
+                "max_ms": round(self._max_ms, 3),
+                "timeouts": self._timeouts,
+                "buckets": buckets
+            }
+
+
+class _WaitTimingMixin:
+    """Измерение времени получения соединения из пула"""
+
+    wait_histogram: PoolWaitHistogram
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.wait_histogram.observe_timeout()
+            raise
+        self.wait_histogram.observe((time.perf_counter() - start) * 1000)
+        return connection
+
+
+class InstrumentedQueuePool(_WaitTimingMixin, QueuePool):
+    """QueuePool с гистограммой времени ожидания"""
+
+    wait_histogram = PoolWaitHistogram()
+
+
+class InstrumentedAsyncQueuePool(_WaitTimingMixin, AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool с гистограммой времени ожидания"""
+
+    wait_histogram = PoolWaitHistogram()
+
+
+def pool_status(pool: Any) -> Dict[str, Any]:
+    """
+    Состояние пула соединений
+
+    Args:
+        pool: Пул движка (engine.pool)
+
+    Returns:
+        Словарь с размером пула, занятыми соединениями, overflow и ожиданием
+    """
+    status: Dict[str, Any] = {"class": type(pool).__name__}
+
+    # Пулы без очереди (NullPool, StaticPool) этих счетчиков не имеют
+    if isinstance(pool, QueuePool):
+        status.update({
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "timeout_seconds": pool.timeout()
+        })
+
+    histogram = getattr(pool, "wait_histogram", None)
+    if histogram is not None:
+        status["wait"] = histogram.snapshot()
+
+    return status
@@ -0,0 +1,242 @@
+"""
+Массовое одобрение и удаление вопросов.
+
+Вместо SELECT + изменение объекта + commit + refresh на каждый вопрос
+пачка id обрабатывается одним UPDATE/DELETE ... WHERE id IN (...).
+Большие выборки делятся на части по BULK_CHUNK_SIZE, и каждая часть
+фиксируется отдельной транзакцией, чтобы не держать блокировки строк
+долго. Массовые запросы идут в обход ORM, поэтому затронутые вопросы
+явно передаются кэшу ответов тестов и поисковому индексу.
+"""
+
+import os
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy import delete, func, update
+from sqlalchemy.orm import Session
+
+import models
+import payload_cache
+import search_index
+import user_stats
+
+# Сколько вопросов обрабатывать в одной транзакции
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "500"))
+
+# Исходы обработки отдельного вопроса
+OUTCOME_APPROVED = "approved"
+OUTCOME_ALREADY_APPROVED = "already_approved"
+OUTCOME_DELETED = "deleted"
+OUTCOME_NOT_FOUND = "not_found"
+
+
+def chunk_ids(question_ids: List[int], size: int) -> Iterator[List[int]]:
+    """Разбить список id на части, сохранив порядок и убрав повторы"""
+    unique = list(dict.fromkeys(question_ids))
+    for start in range(0, len(unique), size):
+        yield unique[start:start + size]
+
+
+def document_chunks(
+    db: Session,
+    source_document_id: int,
+    size: int,
+    only_unapproved: bool = False
+) -> Iterator[List[int]]:
+    """
+    id вопросов документа частями (keyset-пагинация по id)
+
+    Каждая следующая часть читается после фиксации предыдущей,
+    поэтому удаленные строки не сбивают смещение.
+
+    Args:
+        db: Сессия базы данных
+        source_document_id: ID документа-источника
+        size: Размер части
+        only_unapproved: Только неодобренные вопросы
+    """
+    last_id = 0
+    while True:
+        query = db.query(models.Question.id).filter(
+            models.Question.source_document_id == source_document_id,
+            models.Question.id > last_id
+        )
+        if only_unapproved:
+            query = query.filter(models.Question.is_approved == False)  # noqa: E712
+        ids = [question_id for (question_id,) in query.order_by(models.Question.id).limit(size)]
+        if not ids:
+            return
+        yield ids
+        last_id = ids[-1]
+
+
+def _lock_existing(db: Session, ids: List[int]) -> Dict[int, bool]:
+    """Заблокировать строки части и вернуть {id: is_approved} существующих"""
+    rows = db.query(models.Question.id, models.Question.is_approved).filter(
+        models.Question.id.in_(ids)
+    ).with_for_update()
+    return {question_id: bool(is_approved) for question_id, is_approved in rows}
+
+
+def _note_changes(db: Session, ids: List[int]):
+    """Передать измененные вопросы кэшам (применится при commit)"""
+    payload_cache.note_question_changes(db, ids)
+    search_index.note_question_changes(db, ids)
+
+
+def approve_chunk(db: Session, ids: List[int], user_id: int) -> Dict[int, str]:
+    """
+    Одобрить часть вопросов одним UPDATE и зафиксировать транзакцию
+
+    Обновляются только неодобренные вопросы, как и в триггере
+    trg_questions_approve: approved_at и approved_by уже одобренных
+    вопросов не меняются. На MySQL approved_at проставляет сам триггер.
+
+    Args:
+        db: Сессия базы данных
+        ids: ID вопросов части
+        user_id: ID одобряющего пользователя
+
+    Returns:
+        {question_id: исход}
+    """
+    try:
+        existing = _lock_existing(db, ids)
+        pending = [question_id for question_id in ids if existing.get(question_id) is False]
+
+        if pending:
+            db.execute(
+                update(models.Question)
+                .where(models.Question.id.in_(pending), models.Question.is_approved == False)  # noqa: E712
+                .values(is_approved=True, approved_by=user_id, approved_at=func.now()),
+                execution_options={"synchronize_session": False}
+            )
+            _note_changes(db, pending)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    outcomes = {}
+    for question_id in ids:
+        if question_id not in existing:
+            outcomes[question_id] = OUTCOME_NOT_FOUND
+        elif existing[question_id]:
+            outcomes[question_id] = OUTCOME_ALREADY_APPROVED
+        else:
+            outcomes[question_id] = OUTCOME_APPROVED
+    return outcomes
+
+
+def delete_chunk(db: Session, ids: List[int]) -> Dict[int, str]:
+    """
+    Удалить часть вопросов одним DELETE и зафиксировать транзакцию
+
+    Варианты ответов, связи с тестами и ответы студентов удаляются
+    каскадно внешними ключами (ON DELETE CASCADE); счетчики user_stats
+    тестов с этими вопросами пересобираются в той же транзакции.
+
+    Args:
+        db: Сессия базы данных
+        ids: ID вопросов части
+
+    Returns:
+        {question_id: исход}
+    """
+    try:
+        existing = _lock_existing(db, ids)
+        found = [question_id for question_id in ids if question_id in existing]
+
+        if found:
+            user_stats.rebuild_question_tests(db, found)
+            db.execute(
+                delete(models.Question).where(models.Question.id.in_(found)),
+                execution_options={"synchronize_session": False}
+            )
+            _note_changes(db, found)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    return {
+        question_id: OUTCOME_DELETED if question_id in existing else OUTCOME_NOT_FOUND
+        for question_id in ids
+    }
+
+
+def _run(db: Session, chunks: Iterator[List[int]], apply) -> dict:
+    """Обработать части по очереди и собрать исходы"""
+    results = []
+    counts: Dict[str, int] = {}
+    transactions = 0
+    for ids in chunks:
+        outcomes = apply(db, ids)
+        transactions += 1
+        for question_id in ids:
+            outcome = outcomes[question_id]
+            results.append({"question_id": question_id, "status": outcome})
+            counts[outcome] = counts.get(outcome, 0) + 1
+
+    return {
+        "status": "success",
+        "processed": len(results),
+        "counts": counts,
+        "transactions": transactions,
+        "results": results
+    }
+
+
+def bulk_approve(
+    db: Session,
+    user_id: int,
+    question_ids: Optional[List[int]] = None,
+    source_document_id: Optional[int] = None,
+    chunk_size: int = BULK_CHUNK_SIZE
+) -> dict:
+    """
+    Одобрить вопросы по списку id или все вопросы документа
+
+    Args:
+        db: Сессия базы данных
+        user_id: ID одобряющего пользователя
+        question_ids: Список ID вопросов
+        source_document_id: ID документа-источника (если список не задан)
+        chunk_size: Вопросов в одной транзакции
+
+    Returns:
+        Сводка и исход по каждому вопросу
+    """
+    if question_ids is not None:
+        chunks = chunk_ids(question_ids, chunk_size)
+    else:
+        # Уже одобренные вопросы документа не выбираются вовсе
+        chunks = document_chunks(db, source_document_id, chunk_size, only_unapproved=True)
+
+    return _run(db, chunks, lambda db, ids: approve_chunk(db, ids, user_id))
+
+
+def bulk_delete(
+    db: Session,
+    question_ids: Optional[List[int]] = None,
+    source_document_id: Optional[int] = None,
+    chunk_size: int = BULK_CHUNK_SIZE
+) -> dict:
+    """
+    Удалить вопросы по списку id или все вопросы документа
+
+    Args:
+        db: Сессия базы данных
+        question_ids: Список ID вопросов
+        source_document_id: ID документа-источника (если список не задан)
+        chunk_size: Вопросов в одной транзакции
+
+    Returns:
+        Сводка и исход по каждому вопросу
+    """
+    if question_ids is not None:
+        chunks = chunk_ids(question_ids, chunk_size)
+    else:
+        chunks = document_chunks(db, source_document_id, chunk_size)
+
+    return _run(db, chunks, delete_chunk)
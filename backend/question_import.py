@@ -0,0 +1,595 @@
+"""
+Потоковый импорт банка вопросов из NDJSON, CSV и Moodle XML.
+
+Файл читается по одной записи, записи проверяются в цепочке генераторов
+и вставляются пачками по IMPORT_BATCH_SIZE вопросов: один executemany
+INSERT ... RETURNING для questions (id возвращаются в порядке параметров,
+MariaDB 10.5+) и один executemany для answer_options с полученными id.
+Каждая пачка - отдельная транзакция; после фиксации пачки сохраняется
+контрольная точка (номер последней прочитанной записи), с которой
+импорт можно продолжить после сбоя.
+
+Форматы:
+    ndjson - объект на строку: {"question": "...", "answers": [{"text": "...",
+             "is_correct": true}, ...]} (формат /api/export/questions);
+             ответы можно задать списком строк и индексом "correct"
+    csv    - строка на вариант ответа (формат /api/export/questions?format=csv);
+             варианты одного вопроса идут подряд с одинаковым question_id
+    xml    - Moodle XML, вопросы multichoice и truefalse
+
+Примеры:
+    python question_import.py bank.ndjson --creator-id 1
+    python question_import.py quiz.xml --format xml --checkpoint quiz.ckpt
+"""
+
+import argparse
+import csv
+import html
+import itertools
+import json
+import os
+import re
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+import models
+import search_index
+
+# Вопросов в одной пачке (одна транзакция)
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+
+# Сколько ошибок проверки хранить в отчете об импорте
+IMPORT_MAX_ERRORS = 100
+
+# Сколько завершенных импортов помнить для /api/questions/import/{id}
+IMPORT_JOBS_KEEP = 100
+
+FORMAT_NDJSON = "ndjson"
+FORMAT_CSV = "csv"
+FORMAT_XML = "xml"
+IMPORT_FORMATS = (FORMAT_NDJSON, FORMAT_CSV, FORMAT_XML)
+
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+
+# Значения по умолчанию колонок Moodle (как в models.Question)
+DEFAULT_GRADE = 1.0
+DEFAULT_PENALTY = 0.3333333
+
+_TRUE_VALUES = ("1", "true", "yes", "y", "t")
+
+_HTML_TAG = re.compile(r"<[^>]+>")
+_SPACES = re.compile(r"\s+")
+
+
+class InvalidRecord(ValueError):
+    """Запись файла не прошла проверку"""
+
+
+def parse_bool(value: Any, default: bool = False) -> bool:
+    """Булево значение из JSON, CSV или XML"""
+    if value is None or value == "":
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in _TRUE_VALUES
+
+
+def parse_optional_int(value: Any) -> Optional[int]:
+    if value is None or value == "":
+        return None
+    return int(value)
+
+
+# =====================================================
+# ЧТЕНИЕ ФАЙЛОВ
+# =====================================================
+
+def read_ndjson(path: str) -> Iterator[Any]:
+    """Записи NDJSON (пустые строки пропускаются)"""
+    with open(path, encoding="utf-8") as source:
+        for line in source:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as exc:
+                    yield InvalidRecord(f"invalid JSON: {exc.msg}")
+
+
+def read_csv(path: str) -> Iterator[Any]:
+    """Записи CSV: строки с одинаковым question_id собираются в один вопрос"""
+    with open(path, encoding="utf-8-sig", newline="") as source:
+        rows = csv.DictReader(source)
+        for _, group in itertools.groupby(rows, key=lambda row: row.get("question_id")):
+            group = list(group)
+            first = group[0]
+            group.sort(key=lambda row: int(row.get("answer_order") or 0))
+            yield {
+                "question": first.get("question") or first.get("question_text"),
+                "source_document_id": first.get("source_document_id"),
+                "is_approved": first.get("is_approved"),
+                "answers": [
+                    {"text": row.get("answer_text"), "is_correct": row.get("is_correct")}
+                    for row in group
+                    if row.get("answer_text")
+                ]
+            }
+
+
+def _xml_text(element: Optional[ET.Element], path: str = "text") -> Optional[str]:
+    """Текст дочернего узла; HTML (format="html") приводится к простому тексту"""
+    if element is None:
+        return None
+    node = element.find(path)
+    if node is None or node.text is None:
+        return None
+    if element.get("format") == "html":
+        return _SPACES.sub(" ", html.unescape(_HTML_TAG.sub(" ", node.text))).strip()
+    return node.text
+
+
+def _fraction(answer: ET.Element) -> float:
+    """Доля оценки за вариант ответа Moodle (0 - неправильный)"""
+    try:
+        return float(answer.get("fraction") or 0)
+    except ValueError:
+        return 0.0
+
+
+def read_moodle_xml(path: str) -> Iterator[Any]:
+    """
+    Вопросы Moodle XML через iterparse
+
+    Разобранные вопросы удаляются из дерева, поэтому в памяти
+    находится только текущий вопрос.
+    """
+    context = ET.iterparse(path, events=("start", "end"))
+    _, root = next(context)
+    for event_name, element in context:
+        if event_name != "end" or element.tag != "question":
+            continue
+
+        question_type = element.get("type")
+        if question_type != "category":
+            if question_type not in ("multichoice", "truefalse"):
+                yield InvalidRecord(f"unsupported question type: {question_type}")
+            else:
+                yield {
+                    "question": _xml_text(element.find("questiontext")),
+                    "moodle_name": _xml_text(element.find("name")),
+                    "default_grade": _xml_text(element, "defaultgrade"),
+                    "penalty": _xml_text(element, "penalty"),
+                    "shuffle_answers": _xml_text(element, "shuffleanswers"),
+                    "answers": [
+                        {
+                            "text": _xml_text(answer),
+                            "is_correct": _fraction(answer) > 0
+                        }
+                        for answer in element.findall("answer")
+                    ]
+                }
+        root.clear()
+
+
+READERS: Dict[str, Callable[[str], Iterator[Any]]] = {
+    FORMAT_NDJSON: read_ndjson,
+    FORMAT_CSV: read_csv,
+    FORMAT_XML: read_moodle_xml
+}
+
+
+# =====================================================
+# ПРОВЕРКА ЗАПИСЕЙ
+# =====================================================
+
+def normalize_record(
+    record: Any,
+    source_document_id: Optional[int] = None,
+    approve: bool = False
+) -> Dict[str, Any]:
+    """
+    Проверить запись и привести ее к колонкам questions
+
+    Args:
+        record: Запись файла
+        source_document_id: Документ-источник для записей без него
+        approve: Одобрить вопросы, если в записи не указано иное
+
+    Returns:
+        Словарь колонок вопроса с ключом answers: [(текст, правильный)]
+
+    Raises:
+        InvalidRecord: Если запись не проходит проверку
+    """
+    if isinstance(record, InvalidRecord):
+        raise record
+    if not isinstance(record, dict):
+        raise InvalidRecord("record must be an object")
+
+    text = record.get("question") or record.get("question_text")
+    if not isinstance(text, str) or not text.strip():
+        raise InvalidRecord("question text is empty")
+
+    answers = record.get("answers") or []
+    if answers and all(isinstance(answer, str) for answer in answers):
+        # Сокращенная форма: список строк и индекс правильного ответа
+        correct = record.get("correct", 0)
+        answers = [{"text": answer, "is_correct": index == correct} for index, answer in enumerate(answers)]
+
+    options: List[Tuple[str, bool]] = []
+    for answer in answers:
+        answer_text = answer.get("text") if isinstance(answer, dict) else None
+        if not isinstance(answer_text, str) or not answer_text.strip():
+            raise InvalidRecord("answer text is empty")
+        options.append((answer_text.strip(), parse_bool(answer.get("is_correct"))))
+
+    if len(options) < 2:
+        raise InvalidRecord("question needs at least two answers")
+    if not any(is_correct for _, is_correct in options):
+        raise InvalidRecord("question has no correct answer")
+
+    try:
+        document_id = parse_optional_int(record.get("source_document_id"))
+        default_grade = float(record.get("default_grade") or DEFAULT_GRADE)
+        penalty = float(record.get("penalty") or DEFAULT_PENALTY)
+    except (TypeError, ValueError):
+        raise InvalidRecord("invalid numeric field")
+
+    return {
+        "question_text": text.strip(),
+        "source_document_id": document_id if document_id is not None else source_document_id,
+        "is_approved": parse_bool(record.get("is_approved"), approve),
+        "moodle_name": (record.get("moodle_name") or None),
+        "default_grade": default_grade,
+        "penalty": penalty,
+        "shuffle_answers": parse_bool(record.get("shuffle_answers"), True),
+        "answers": options
+    }
+
+
+@dataclass
+class ImportProgress:
+    """Состояние импорта (общее для API и CLI)"""
+    import_id: str
+    filename: str
+    format: str
+    status: str = JOB_RUNNING
+    # Прочитано записей файла, включая пропущенные при возобновлении
+    records: int = 0
+    # Номер последней записи, зафиксированной в БД (контрольная точка)
+    committed_records: int = 0
+    questions: int = 0
+    answer_options: int = 0
+    invalid: int = 0
+    errors: List[Dict[str, Any]] = field(default_factory=list)
+    started_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    detail: Optional[str] = None
+
+    def error(self, record_number: int, message: str):
+        self.invalid += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append({"record": record_number, "error": message})
+
+    def info(self) -> Dict[str, Any]:
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "import_id": self.import_id,
+            "filename": self.filename,
+            "format": self.format,
+            "status": self.status,
+            "records": self.records,
+            "committed_records": self.committed_records,
+            "questions": self.questions,
+            "answer_options": self.answer_options,
+            "invalid": self.invalid,
+            "errors": self.errors,
+            "elapsed_seconds": round(elapsed, 2),
+            "questions_per_minute": round(self.questions * 60 / elapsed) if elapsed > 0 else None,
+            "detail": self.detail
+        }
+
+
+def valid_records(
+    records: Iterable[Any],
+    progress: ImportProgress,
+    skip: int = 0,
+    source_document_id: Optional[int] = None,
+    approve: bool = False
+) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """
+    Пронумеровать записи, пропустить уже импортированные и отбросить ошибочные
+
+    Yields:
+        (номер записи, начиная с 1; колонки вопроса)
+    """
+    for number, record in enumerate(records, start=1):
+        progress.records = number
+        if number <= skip:
+            continue
+        try:
+            yield number, normalize_record(record, source_document_id, approve)
+        except InvalidRecord as exc:
+            progress.error(number, str(exc))
+
+
+# =====================================================
+# ВСТАВКА ПАЧЕК
+# =====================================================
+
+def insert_batch(db: Session, questions: List[Dict[str, Any]], creator_id: int) -> List[int]:
+    """
+    Вставить пачку вопросов с вариантами ответов (без commit)
+
+    Args:
+        db: Сессия базы данных
+        questions: Колонки вопросов из normalize_record()
+        creator_id: ID создателя вопросов
+
+    Returns:
+        ID вставленных вопросов в порядке пачки
+    """
+    question_table = models.Question.__table__
+    rows = [
+        {
+            "question_text": question["question_text"],
+            "source_document_id": question["source_document_id"],
+            "creator_id": creator_id,
+            "is_approved": question["is_approved"],
+            "approved_by": creator_id if question["is_approved"] else None,
+            "approved_at": datetime.now() if question["is_approved"] else None,
+            "moodle_name": question["moodle_name"],
+            "default_grade": question["default_grade"],
+            "penalty": question["penalty"],
+            "shuffle_answers": question["shuffle_answers"]
+        }
+        for question in questions
+    ]
+
+    if db.get_bind().dialect.insert_executemany_returning_sort_by_parameter_order:
+        result = db.execute(
+            insert(question_table).returning(question_table.c.id, sort_by_parameter_order=True),
+            rows
+        )
+        question_ids = [question_id for (question_id,) in result]
+    else:
+        # Без INSERT ... RETURNING id получаем по одному запросу на вопрос
+        question_ids = [
+            db.execute(insert(question_table), row).inserted_primary_key[0]
+            for row in rows
+        ]
+
+    db.execute(insert(models.AnswerOption.__table__), [
+        {
+            "question_id": question_id,
+            "answer_text": answer_text,
+            "is_correct": is_correct,
+            "option_order": order
+        }
+        for question_id, question in zip(question_ids, questions)
+        for order, (answer_text, is_correct) in enumerate(question["answers"], start=1)
+    ])
+    search_index.note_question_changes(db, question_ids)
+    return question_ids
+
+
+def run_import(
+    path: str,
+    fmt: str,
+    creator_id: int,
+    progress: ImportProgress,
+    batch_size: int = IMPORT_BATCH_SIZE,
+    skip: int = 0,
+    source_document_id: Optional[int] = None,
+    approve: bool = False,
+    on_commit: Optional[Callable[[ImportProgress], None]] = None
+) -> ImportProgress:
+    """
+    Импортировать файл пачками, фиксируя каждую пачку отдельно
+
+    Args:
+        path: Путь к файлу
+        fmt: ndjson, csv или xml
+        creator_id: ID создателя вопросов
+        progress: Состояние импорта (обновляется по ходу)
+        batch_size: Вопросов в пачке
+        skip: Сколько записей пропустить (продолжение с контрольной точки)
+        source_document_id: Документ-источник для записей без него
+        approve: Импортировать вопросы одобренными
+        on_commit: Вызывается после фиксации каждой пачки
+
+    Returns:
+        Итоговое состояние импорта
+    """
+    progress.committed_records = skip
+    records = valid_records(READERS[fmt](path), progress, skip, source_document_id, approve)
+
+    db = SessionLocal()
+    try:
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+
+            try:
+                insert_batch(db, [question for _, question in batch], creator_id)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+
+            progress.questions += len(batch)
+            progress.answer_options += sum(len(question["answers"]) for _, question in batch)
+            progress.committed_records = batch[-1][0]
+            if on_commit is not None:
+                on_commit(progress)
+
+        # Хвост файла мог состоять из ошибочных записей
+        progress.committed_records = progress.records
+        progress.status = JOB_COMPLETED
+    except Exception as exc:
+        progress.status = JOB_FAILED
+        progress.detail = str(exc)
+        print(f"Question import {progress.import_id} failed: {exc}")
+    finally:
+        progress.finished_at = time.time()
+        db.close()
+
+    return progress
+
+
+# =====================================================
+# КОНТРОЛЬНЫЕ ТОЧКИ
+# =====================================================
+
+def load_checkpoint(checkpoint_path: str, path: str) -> int:
+    """
+    Номер последней зафиксированной записи из файла контрольной точки
+
+    Контрольная точка другого файла (по имени и размеру) игнорируется.
+    """
+    try:
+        with open(checkpoint_path, encoding="utf-8") as source:
+            checkpoint = json.load(source)
+    except (OSError, ValueError):
+        return 0
+
+    if checkpoint.get("source") != os.path.abspath(path) or checkpoint.get("size") != os.path.getsize(path):
+        return 0
+    return int(checkpoint.get("committed_records", 0))
+
+
+def save_checkpoint(checkpoint_path: str, path: str, progress: ImportProgress):
+    """Атомарно записать контрольную точку"""
+    temporary = checkpoint_path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as target:
+        json.dump({
+            "source": os.path.abspath(path),
+            "size": os.path.getsize(path),
+            "committed_records": progress.committed_records,
+            "questions": progress.questions
+        }, target)
+    os.replace(temporary, checkpoint_path)
+
+
+# =====================================================
+# ФОНОВЫЕ ИМПОРТЫ ДЛЯ API
+# =====================================================
+
+class ImportJobs:
+    """
+    Импорты, запущенные через API, в фоновых потоках
+    """
+
+    def __init__(self, keep: int = IMPORT_JOBS_KEEP):
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, ImportProgress] = {}
+
+    def start(
+        self,
+        path: str,
+        filename: str,
+        fmt: str,
+        creator_id: int,
+        skip: int = 0,
+        source_document_id: Optional[int] = None,
+        approve: bool = False
+    ) -> ImportProgress:
+        """
+        Запустить импорт загруженного файла; файл удаляется по завершении
+
+        Returns:
+            Состояние импорта
+        """
+        progress = ImportProgress(import_id=uuid.uuid4().hex, filename=filename, format=fmt)
+        with self._lock:
+            self._jobs[progress.import_id] = progress
+            finished = [job_id for job_id, job in self._jobs.items() if job.status != JOB_RUNNING]
+            for job_id in finished[:max(0, len(self._jobs) - self.keep)]:
+                del self._jobs[job_id]
+
+        def worker():
+            try:
+                run_import(
+                    path, fmt, creator_id, progress,
+                    skip=skip,
+                    source_document_id=source_document_id,
+                    approve=approve,
+                    on_commit=lambda state: print(
+                        f"Question import {state.import_id}: {state.questions} questions, "
+                        f"{state.records} records read"
+                    )
+                )
+            finally:
+                os.unlink(path)
+
+        threading.Thread(target=worker, name=f"question-import-{progress.import_id[:8]}", daemon=True).start()
+        return progress
+
+    def get(self, import_id: str) -> Optional[ImportProgress]:
+        with self._lock:
+            return self._jobs.get(import_id)
+
+
+# Импорты приложения
+import_jobs = ImportJobs()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Потоковый импорт банка вопросов")
+    parser.add_argument("path", help="Файл NDJSON, CSV или Moodle XML")
+    parser.add_argument("--format", choices=IMPORT_FORMATS, help="Формат (по умолчанию - по расширению)")
+    parser.add_argument("--creator-id", type=int, default=1, help="ID создателя вопросов")
+    parser.add_argument("--source-document-id", type=int, help="Документ-источник для записей без него")
+    parser.add_argument("--approve", action="store_true", help="Импортировать вопросы одобренными")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="Вопросов в пачке")
+    parser.add_argument("--checkpoint", help="Файл контрольной точки (по умолчанию <path>.checkpoint)")
+    parser.add_argument("--restart", action="store_true", help="Игнорировать контрольную точку")
+    args = parser.parse_args()
+
+    fmt = args.format or os.path.splitext(args.path)[1].lstrip(".").lower()
+    if fmt == "jsonl":
+        fmt = FORMAT_NDJSON
+    if fmt not in IMPORT_FORMATS:
+        parser.error("cannot detect format, use --format")
+
+    checkpoint_path = args.checkpoint or args.path + ".checkpoint"
+    skip = 0 if args.restart else load_checkpoint(checkpoint_path, args.path)
+    if skip:
+        print(f"Resuming after record {skip}")
+
+    def on_commit(progress: ImportProgress):
+        save_checkpoint(checkpoint_path, args.path, progress)
+        info = progress.info()
+        print(
+            f"{info['questions']} questions, {info['records']} records, "
+            f"{info['invalid']} invalid, {info['questions_per_minute']} questions/min"
+        )
+
+    progress = run_import(
+        args.path, fmt, args.creator_id,
+        ImportProgress(import_id="cli", filename=os.path.basename(args.path), format=fmt),
+        batch_size=args.batch_size,
+        skip=skip,
+        source_document_id=args.source_document_id,
+        approve=args.approve,
+        on_commit=on_commit
+    )
+    if progress.status == JOB_COMPLETED:
+        save_checkpoint(checkpoint_path, args.path, progress)
+    print(json.dumps(progress.info(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
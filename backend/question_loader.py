@@ -0,0 +1,230 @@
+"""
+Слой загрузки вопросов с пакетной подгрузкой вариантов ответов.
+
+Вместо ленивой загрузки `answer_options` для каждого вопроса (N+1 запросов)
+сначала выбирается страница уникальных вопросов, а затем все их варианты
+ответов загружаются одним запросом `SELECT ... WHERE question_id IN (...)`.
+Количество запросов не зависит от размера страницы.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session, Query
+
+import models
+import pagination
+
+
+def questions_query(db: Session, approved_only: bool = False) -> Query:
+    """
+    Базовый запрос вопросов, у которых есть хотя бы один вариант ответа
+
+    Фильтр через EXISTS вместо JOIN, чтобы строки вопросов не дублировались
+    и пагинация шла по уникальным вопросам.
+
+    Args:
+        db: Сессия базы данных
+        approved_only: Только одобренные вопросы
+
+    Returns:
+        Query по модели Question
+    """
+    query = db.query(models.Question).filter(models.Question.answer_options.any())
+
+    if approved_only:
+        query = query.filter(models.Question.is_approved == True)
+
+    return query
+
+
+# =====================================================
+# ЗАГРУЗКА СТРОК БЕЗ ORM-ОБЪЕКТОВ
+# =====================================================
+
+# Колонки вопроса для быстрой сериализации ответов (fast_json)
+QUESTION_ROW_COLUMNS = (
+    models.Question.id,
+    models.Question.question_text,
+    models.Question.is_approved,
+    models.Question.source_document_id,
+    models.Question.created_at
+)
+
+
+def load_option_rows(db: Session, question_ids: List[int]) -> Dict[int, List[Tuple]]:
+    """
+    Варианты ответов вопросов одним запросом, в виде кортежей
+
+    Args:
+        db: Сессия базы данных
+        question_ids: ID вопросов
+
+    Returns:
+        question_id -> [(id, answer_text, is_correct, option_order)]
+        в порядке option_order
+    """
+    options: Dict[int, List[Tuple]] = {}
+    if not question_ids:
+        return options
+
+    rows = db.execute(
+        select(
+            models.AnswerOption.question_id,
+            models.AnswerOption.id,
+            models.AnswerOption.answer_text,
+            models.AnswerOption.is_correct,
+            models.AnswerOption.option_order
+        )
+        .where(models.AnswerOption.question_id.in_(question_ids))
+        .order_by(models.AnswerOption.question_id, models.AnswerOption.option_order)
+    )
+    for question_id, option_id, answer_text, is_correct, option_order in rows:
+        options.setdefault(question_id, []).append((option_id, answer_text, is_correct, option_order))
+    return options
+
+
+def load_question_page_rows(
+    db: Session,
+    approved_only: bool = False,
+    limit: int = 100,
+    offset: int = 0,
+    after: Optional[pagination.CursorKey] = None,
+    count: str = pagination.COUNT_EXACT,
+    keyset: bool = False
+) -> Tuple[List[Any], Dict[int, List[Tuple]], Optional[int]]:
+    """
+    Страница вопросов строками, без ORM-объектов
+
+    Выполняет не более трех запросов: COUNT (если нужен), страницу вопросов
+    и один пакетный запрос вариантов ответов.
+
+    Без курсора вопросы идут в прежнем порядке (по id) с OFFSET;
+    сортировка (created_at DESC, id DESC) используется только
+    в курсорном режиме (keyset или передан after).
+
+    Args:
+        db: Сессия базы данных
+        approved_only: Только одобренные вопросы
+        limit: Размер страницы
+        offset: Смещение для пагинации (без курсора)
+        after: Ключ курсора предыдущей страницы
+        count: Режим подсчета общего количества (exact, estimate, none)
+        keyset: Курсорный режим с первой страницы
+
+    Returns:
+        Кортеж (строки QUESTION_ROW_COLUMNS, варианты из load_option_rows(),
+        общее количество или None)
+    """
+    query = questions_query(db, approved_only)
+    total = pagination.count_total(db, query, models.Question, count)
+
+    query = query.with_entities(*QUESTION_ROW_COLUMNS)
+    if keyset or after is not None:
+        rows = pagination.paginate(query, models.Question, limit=limit, after=after)
+    else:
+        rows = query.order_by(models.Question.id).offset(offset).limit(limit).all()
+
+    return rows, load_option_rows(db, [row.id for row in rows]), total
+
+
+def load_question_rows_by_ids(
+    db: Session,
+    question_ids: List[int]
+) -> Tuple[List[Any], Dict[int, List[Tuple]]]:
+    """
+    Вопросы по списку id в том же порядке, строками, без ORM-объектов
+
+    Returns:
+        Кортеж (строки QUESTION_ROW_COLUMNS, варианты из load_option_rows());
+        отсутствующие в БД id пропускаются
+    """
+    if not question_ids:
+        return [], {}
+
+    by_id = {
+        row.id: row
+        for row in db.query(*QUESTION_ROW_COLUMNS).filter(models.Question.id.in_(question_ids))
+    }
+    rows = [by_id[question_id] for question_id in question_ids if question_id in by_id]
+    return rows, load_option_rows(db, [row.id for row in rows])
+
+
+def test_question_rows(db: Session, test_id: int) -> List[Any]:
+    """
+    Вопросы теста с вариантами ответов одним JOIN-запросом
+
+    Аналог процедуры sp_get_test_questions: по строке на каждый вариант
+    ответа (вопрос без вариантов дает одну строку с option_id = NULL),
+    в порядке вопросов теста и вариантов ответа.
+
+    Args:
+        db: Сессия базы данных
+        test_id: ID теста
+
+    Returns:
+        Список строк с полями question_id, question_text, points,
+        question_order, option_id, answer_text, is_correct, option_order
+    """
+    return (
+        db.query(
+            models.Question.id.label("question_id"),
+            models.Question.question_text,
+            models.TestQuestion.points,
+            models.TestQuestion.question_order,
+            models.AnswerOption.id.label("option_id"),
+            models.AnswerOption.answer_text,
+            models.AnswerOption.is_correct,
+            models.AnswerOption.option_order
+        )
+        .select_from(models.TestQuestion)
+        .join(models.Question, models.Question.id == models.TestQuestion.question_id)
+        .outerjoin(models.AnswerOption, models.AnswerOption.question_id == models.Question.id)
+        .filter(models.TestQuestion.test_id == test_id)
+        .order_by(
+            models.TestQuestion.question_order,
+            models.TestQuestion.id,
+            models.AnswerOption.option_order,
+            models.AnswerOption.id
+        )
+        .all()
+    )
+
+
+def document_questions_count():
+    """
+    Количество вопросов документа как коррелированный подзапрос
+
+    Добавляется колонкой к запросу по SourceDocument, поэтому количество
+    считается в том же запросе, что и страница документов, и только для
+    строк этой страницы (по индексу idx_source_document_id).
+
+    Returns:
+        Скалярный подзапрос COUNT(questions.id)
+    """
+    return (
+        select(func.count(models.Question.id))
+        .where(models.Question.source_document_id == models.SourceDocument.id)
+        .correlate(models.SourceDocument)
+        .scalar_subquery()
+        .label("questions_count")
+    )
+
+
+def test_questions_count():
+    """
+    Количество вопросов теста как коррелированный подзапрос
+
+    Добавляется колонкой к запросу по Test и считается по индексу
+    idx_test_id только для выбранных тестов.
+
+    Returns:
+        Скалярный подзапрос COUNT(test_questions.id)
+    """
+    return (
+        select(func.count(models.TestQuestion.id))
+        .where(models.TestQuestion.test_id == models.Test.id)
+        .correlate(models.Test)
+        .scalar_subquery()
+        .label("questions_count")
+    )
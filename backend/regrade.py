@@ -0,0 +1,578 @@
+"""
+Пересчет результатов тестирования после исправления ключа ответов.
+
+Когда меняется AnswerOption.is_correct, сохраненные UserAnswer.is_correct
+и TestSession.score затронутых сессий устаревают. Пересчет выполняется
+для теста или для вопроса (во всех тестах, куда он входит):
+
+1. ключ ответов (варианты затронутых вопросов), баллы вопросов тестов
+   (TestQuestion.points) и сессии загружаются тремя запросами;
+2. ответы всех затронутых сессий читаются одним проходом курсора
+   на стороне сервера в массивы NumPy;
+3. правильность ответов, набранные баллы, количество правильных ответов
+   и результат сессий вычисляются векторными операциями (searchsorted
+   по ключу, bincount по сессиям);
+4. изменившиеся строки записываются пакетными UPDATE ... WHERE id IN:
+   ответы - двумя списками (стали правильными / неправильными), сессии -
+   списком на каждое сочетание новых значений, не более
+   REGRADE_CHUNK_SIZE строк в одном запросе.
+
+Весь пересчет - одна транзакция; в ней же пересобираются счетчики
+затронутых тестов в user_stats / user_test_stats, а при фиксации
+сбрасываются кэши этих тестов (payload_cache), чтобы следующие оценки
+использовали исправленный ключ. Балл сессии
+вычисляется так же, как при завершении теста (session_engine): сумма
+баллов правильных ответов от суммы баллов всех вопросов теста,
+в процентах. Балл обновляется только у завершенных сессий;
+правильность ответов - у всех.
+
+Примеры:
+    python regrade.py --test-id 12
+    python regrade.py --question-id 345
+"""
+
+import argparse
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+import audit
+import models
+import payload_cache
+import user_stats
+
+# Строк в одном UPDATE
+REGRADE_CHUNK_SIZE = int(os.getenv("REGRADE_CHUNK_SIZE", "2000"))
+
+# Сколько строк ответов читать из курсора за одно обращение к серверу
+REGRADE_YIELD_PER = 50000
+
+# Сколько завершенных пересчетов помнить для /api/regrade/{id}
+REGRADE_JOBS_KEEP = 100
+
+SCOPE_TEST = "test"
+SCOPE_QUESTION = "question"
+
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+
+PHASE_LOADING = "loading"
+PHASE_GRADING = "grading"
+PHASE_WRITING = "writing"
+PHASE_DONE = "done"
+
+# Составной ключ (test_id, question_id) в int64: test_id << 32 | question_id
+_KEY_SHIFT = 32
+
+
+@dataclass
+class RegradeProgress:
+    """Состояние пересчета (общее для API и CLI)"""
+    regrade_id: str
+    scope: str
+    target_id: int
+    status: str = JOB_RUNNING
+    phase: str = PHASE_LOADING
+    tests: int = 0
+    sessions: int = 0
+    answers: int = 0
+    # Прочитано строк ответов (растет во время загрузки)
+    answers_loaded: int = 0
+    answers_changed: int = 0
+    sessions_changed: int = 0
+    # Записано строк (растет во время записи)
+    rows_written: int = 0
+    started_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    detail: Optional[str] = None
+
+    def info(self) -> Dict[str, Any]:
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "regrade_id": self.regrade_id,
+            "scope": self.scope,
+            "target_id": self.target_id,
+            "status": self.status,
+            "phase": self.phase,
+            "tests": self.tests,
+            "sessions": self.sessions,
+            "answers": self.answers,
+            "answers_loaded": self.answers_loaded,
+            "answers_changed": self.answers_changed,
+            "sessions_changed": self.sessions_changed,
+            "rows_written": self.rows_written,
+            "rows_to_write": self.answers_changed + self.sessions_changed,
+            "elapsed_seconds": round(elapsed, 2),
+            "detail": self.detail
+        }
+
+
+@dataclass
+class GradeResult:
+    """Результат векторного пересчета"""
+    # Ответы, ставшие правильными и неправильными
+    became_correct: np.ndarray
+    became_wrong: np.ndarray
+    # Изменившиеся завершенные сессии и их новые значения
+    session_ids: np.ndarray
+    scores: np.ndarray
+    correct_answers: np.ndarray
+    is_passed: np.ndarray
+
+
+def _pack_keys(test_ids: np.ndarray, question_ids: np.ndarray) -> np.ndarray:
+    return (test_ids.astype(np.int64) << _KEY_SHIFT) | question_ids.astype(np.int64)
+
+
+def _lookup(sorted_keys: np.ndarray, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Позиции keys в отсортированном массиве sorted_keys
+
+    Returns:
+        (позиции, маска найденных); позиции ненайденных ключей равны 0
+    """
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+    positions = np.searchsorted(sorted_keys, keys)
+    positions[positions == len(sorted_keys)] = 0
+    return positions, sorted_keys[positions] == keys
+
+
+# =====================================================
+# ЗАГРУЗКА
+# =====================================================
+
+def affected_tests(db: Session, test_id: Optional[int] = None, question_id: Optional[int] = None) -> List[int]:
+    """Тесты, результаты которых пересчитываются"""
+    if test_id is not None:
+        return [test_id] if db.query(models.Test.id).filter(models.Test.id == test_id).first() else []
+    return [
+        row.test_id for row in db.query(models.TestQuestion.test_id)
+        .filter(models.TestQuestion.question_id == question_id)
+        .order_by(models.TestQuestion.test_id)
+    ]
+
+
+def load_answer_key(db: Session, test_ids: List[int], question_id: Optional[int] = None) -> Dict[str, np.ndarray]:
+    """
+    Варианты ответов пересчитываемых вопросов, отсортированные по id
+
+    Returns:
+        Массивы option_id, question_id, is_correct
+    """
+    option = models.AnswerOption
+    statement = select(option.id, option.question_id, option.is_correct).order_by(option.id)
+    if question_id is not None:
+        statement = statement.where(option.question_id == question_id)
+    else:
+        statement = statement.where(option.question_id.in_(
+            select(models.TestQuestion.question_id).where(models.TestQuestion.test_id.in_(test_ids))
+        ))
+
+    rows = db.execute(statement).all()
+    return {
+        "option_id": np.array([row[0] for row in rows], dtype=np.int64),
+        "question_id": np.array([row[1] for row in rows], dtype=np.int64),
+        "is_correct": np.array([bool(row[2]) for row in rows], dtype=bool)
+    }
+
+
+def load_points(db: Session, test_ids: List[int]) -> Dict[str, np.ndarray]:
+    """
+    Баллы вопросов тестов
+
+    Returns:
+        Отсортированные ключи (test_id, question_id) и баллы
+    """
+    link = models.TestQuestion
+    rows = db.execute(
+        select(link.test_id, link.question_id, link.points).where(link.test_id.in_(test_ids))
+    ).all()
+    keys = _pack_keys(
+        np.array([row[0] for row in rows], dtype=np.int64),
+        np.array([row[1] for row in rows], dtype=np.int64)
+    )
+    points = np.array([float(row[2]) for row in rows], dtype=np.float64)
+    order = np.argsort(keys)
+    return {"key": keys[order], "points": points[order]}
+
+
+def load_sessions(db: Session, test_ids: List[int]) -> Dict[str, np.ndarray]:
+    """
+    Сессии затронутых тестов, отсортированные по id, с проходным баллом теста
+
+    Returns:
+        Массивы id, test_id, completed, score, correct_answers, is_passed, passing_score, user_id
+    """
+    table = models.TestSession
+    rows = db.execute(
+        select(
+            table.id, table.test_id, table.status, table.score,
+            table.correct_answers, table.is_passed, models.Test.passing_score, table.user_id
+        )
+        .join(models.Test, models.Test.id == table.test_id)
+        .where(table.test_id.in_(test_ids))
+        .order_by(table.id)
+    ).all()
+    return {
+        "id": np.array([row[0] for row in rows], dtype=np.int64),
+        "test_id": np.array([row[1] for row in rows], dtype=np.int64),
+        "completed": np.array([row[2] == models.SessionStatus.completed for row in rows], dtype=bool),
+        "score": np.array([float(row[3]) if row[3] is not None else np.nan for row in rows], dtype=np.float64),
+        "correct_answers": np.array([row[4] if row[4] is not None else -1 for row in rows], dtype=np.int64),
+        "is_passed": np.array([bool(row[5]) for row in rows], dtype=bool),
+        "passing_score": np.array([float(row[6]) for row in rows], dtype=np.float64),
+        "user_id": np.array([row[7] for row in rows], dtype=np.int64)
+    }
+
+
+def load_answers(db: Session, test_ids: List[int], progress: Optional[RegradeProgress] = None) -> Dict[str, np.ndarray]:
+    """
+    Ответы всех сессий затронутых тестов одним проходом курсора
+
+    Returns:
+        Массивы id, test_session_id, test_id, question_id, selected_option_id, is_correct
+    """
+    answer = models.UserAnswer
+    # Core-выполнение на соединении сессии: строки без слоя ORM
+    result = db.connection().execute(
+        select(
+            answer.id,
+            answer.test_session_id,
+            models.TestSession.test_id,
+            answer.question_id,
+            answer.selected_option_id,
+            answer.is_correct
+        )
+        .join(models.TestSession, models.TestSession.id == answer.test_session_id)
+        .where(models.TestSession.test_id.in_(test_ids))
+        .execution_options(yield_per=REGRADE_YIELD_PER)
+    )
+
+    chunks = []
+    try:
+        for partition in result.partitions():
+            chunks.append(np.fromiter(
+                itertools.chain.from_iterable(partition), dtype=np.int64, count=len(partition) * 6
+            ).reshape(-1, 6))
+            if progress is not None:
+                progress.answers_loaded += len(partition)
+    finally:
+        result.close()
+
+    data = np.concatenate(chunks) if chunks else np.zeros((0, 6), dtype=np.int64)
+    return {
+        "id": data[:, 0],
+        "test_session_id": data[:, 1],
+        "test_id": data[:, 2],
+        "question_id": data[:, 3],
+        "selected_option_id": data[:, 4],
+        "is_correct": data[:, 5].astype(bool)
+    }
+
+
+# =====================================================
+# ПЕРЕСЧЕТ
+# =====================================================
+
+def grade(
+    answers: Dict[str, np.ndarray],
+    answer_key: Dict[str, np.ndarray],
+    points: Dict[str, np.ndarray],
+    sessions: Dict[str, np.ndarray],
+    question_id: Optional[int] = None
+) -> GradeResult:
+    """
+    Векторный пересчет правильности ответов и результатов сессий
+
+    Args:
+        answers: Массивы load_answers()
+        answer_key: Массивы load_answer_key()
+        points: Массивы load_points()
+        sessions: Массивы load_sessions()
+        question_id: Пересчитывать правильность только ответов этого вопроса
+
+    Returns:
+        Изменившиеся ответы и сессии
+    """
+    # Правильность: выбранный вариант правильный и относится к этому вопросу
+    position, found = _lookup(answer_key["option_id"], answers["selected_option_id"])
+    is_correct = (
+        found
+        & answer_key["is_correct"][position]
+        & (answer_key["question_id"][position] == answers["question_id"])
+    )
+    if question_id is not None:
+        is_correct = np.where(answers["question_id"] == question_id, is_correct, answers["is_correct"])
+
+    changed = is_correct != answers["is_correct"]
+    became_correct = answers["id"][changed & is_correct]
+    became_wrong = answers["id"][changed & ~is_correct]
+
+    # Баллы ответа: points вопроса в тесте сессии (0, если вопрос убран из теста)
+    point_position, in_test = _lookup(points["key"], _pack_keys(answers["test_id"], answers["question_id"]))
+    answer_points = np.where(in_test, points["points"][point_position], 0.0)
+
+    session_count = len(sessions["id"])
+    session_index = np.searchsorted(sessions["id"], answers["test_session_id"])
+    counted = is_correct & in_test
+    correct_points = np.bincount(session_index, weights=answer_points * counted, minlength=session_count)
+    correct_answers = np.bincount(session_index, weights=counted, minlength=session_count).astype(np.int64)
+
+    # Сумма баллов теста сессии
+    test_ids = np.unique(points["key"] >> _KEY_SHIFT)
+    test_totals = np.bincount(
+        np.searchsorted(test_ids, points["key"] >> _KEY_SHIFT), weights=points["points"], minlength=len(test_ids)
+    )
+    test_position, has_questions = _lookup(test_ids, sessions["test_id"])
+    total_points = np.where(has_questions, test_totals[test_position] if len(test_totals) else 0.0, 0.0)
+
+    scores = np.round(
+        np.divide(correct_points * 100, total_points, out=np.zeros(session_count), where=total_points > 0), 2
+    )
+    is_passed = scores >= sessions["passing_score"]
+
+    session_changed = sessions["completed"] & (
+        ~(np.abs(scores - sessions["score"]) < 0.005)
+        | (correct_answers != sessions["correct_answers"])
+        | (is_passed != sessions["is_passed"])
+    )
+
+    return GradeResult(
+        became_correct=became_correct,
+        became_wrong=became_wrong,
+        session_ids=sessions["id"][session_changed],
+        scores=scores[session_changed],
+        correct_answers=correct_answers[session_changed],
+        is_passed=is_passed[session_changed]
+    )
+
+
+# =====================================================
+# ЗАПИСЬ
+# =====================================================
+
+def _update_ids(db: Session, table, ids: List[int], values: Dict[str, Any], progress: Optional[RegradeProgress]):
+    """UPDATE table SET values WHERE id IN (...) по REGRADE_CHUNK_SIZE строк"""
+    for start in range(0, len(ids), REGRADE_CHUNK_SIZE):
+        chunk = ids[start:start + REGRADE_CHUNK_SIZE]
+        db.execute(update(table).where(table.c.id.in_(chunk)).values(**values))
+        if progress is not None:
+            progress.rows_written += len(chunk)
+
+
+def write_answers(db: Session, result: GradeResult, progress: Optional[RegradeProgress] = None):
+    """Записать правильность ответов: два списка IN (стали правильными и неправильными)"""
+    table = models.UserAnswer.__table__
+    _update_ids(db, table, result.became_correct.tolist(), {"is_correct": True}, progress)
+    _update_ids(db, table, result.became_wrong.tolist(), {"is_correct": False}, progress)
+
+
+def write_sessions(db: Session, result: GradeResult, progress: Optional[RegradeProgress] = None):
+    """
+    Записать результаты сессий
+
+    Сессии группируются по новым значениям (score, correct_answers,
+    is_passed); различных сочетаний немного (баллы ограничены числом
+    вопросов теста), и каждая группа записывается списками IN.
+    """
+    if len(result.session_ids) == 0:
+        return
+    table = models.TestSession.__table__
+    values = np.column_stack([result.scores, result.correct_answers, result.is_passed])
+    groups, inverse = np.unique(values, axis=0, return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    bounds = np.searchsorted(inverse[order], np.arange(len(groups) + 1))
+    for index, (score, correct_answers, is_passed) in enumerate(groups.tolist()):
+        ids = result.session_ids[order[bounds[index]:bounds[index + 1]]].tolist()
+        _update_ids(
+            db, table, ids,
+            {"score": score, "correct_answers": int(correct_answers), "is_passed": bool(is_passed)},
+            progress
+        )
+
+
+def audit_sessions(db: Session, result: GradeResult, sessions: Dict[str, np.ndarray]):
+    """
+    Записать аудит измененных сессий в транзакции пересчета (AUDIT_MODE=app)
+
+    Пересчет может изменить сотни тысяч сессий, поэтому строки
+    audit_log пишутся сразу пачками, минуя буфер приложения.
+    """
+    positions = np.searchsorted(sessions["id"], result.session_ids)
+    changed_at = datetime.now()
+    rows = []
+    for index, position in enumerate(positions.tolist()):
+        old_score = sessions["score"][position]
+        old_correct = int(sessions["correct_answers"][position])
+        rows.append(audit.audit_row(
+            "test_sessions", models.AuditOperationType.UPDATE, int(result.session_ids[index]),
+            {
+                "status": models.SessionStatus.completed,
+                "score": None if np.isnan(old_score) else float(old_score),
+                "correct_answers": None if old_correct < 0 else old_correct,
+                "is_passed": bool(sessions["is_passed"][position])
+            },
+            {
+                "status": models.SessionStatus.completed,
+                "score": float(result.scores[index]),
+                "correct_answers": int(result.correct_answers[index]),
+                "is_passed": bool(result.is_passed[index])
+            },
+            int(sessions["user_id"][position]),
+            changed_at
+        ))
+        if len(rows) == REGRADE_CHUNK_SIZE:
+            audit.write_rows(db, rows)
+            rows = []
+    audit.write_rows(db, rows)
+
+
+def run_regrade(
+    progress: RegradeProgress,
+    session_factory: Callable[[], Session] = SessionLocal
+) -> RegradeProgress:
+    """
+    Пересчитать результаты теста или вопроса в одной транзакции
+
+    Args:
+        progress: Состояние пересчета (scope и target_id; обновляется по ходу)
+        session_factory: Фабрика сессий БД
+
+    Returns:
+        Итоговое состояние пересчета
+    """
+    test_id = progress.target_id if progress.scope == SCOPE_TEST else None
+    question_id = progress.target_id if progress.scope == SCOPE_QUESTION else None
+
+    db = session_factory()
+    try:
+        test_ids = affected_tests(db, test_id, question_id)
+        progress.tests = len(test_ids)
+
+        if test_ids:
+            answer_key = load_answer_key(db, test_ids, question_id)
+            points = load_points(db, test_ids)
+            sessions = load_sessions(db, test_ids)
+            progress.sessions = len(sessions["id"])
+            answers = load_answers(db, test_ids, progress)
+            progress.answers = len(answers["id"])
+
+            progress.phase = PHASE_GRADING
+            result = grade(answers, answer_key, points, sessions, question_id)
+            progress.answers_changed = len(result.became_correct) + len(result.became_wrong)
+            progress.sessions_changed = len(result.session_ids)
+
+            progress.phase = PHASE_WRITING
+            write_answers(db, result, progress)
+            write_sessions(db, result, progress)
+            if audit.app_mode():
+                audit_sessions(db, result, sessions)
+            if len(result.session_ids):
+                user_stats.rebuild(db, test_ids)
+            # Скомпилированные тесты (ключ ответов для оценки), аналитика
+            # и другие кэши тестов сбрасываются при фиксации
+            payload_cache.note_test_changes(db, test_ids)
+            db.commit()
+
+        progress.phase = PHASE_DONE
+        progress.status = JOB_COMPLETED
+    except Exception as exc:
+        db.rollback()
+        progress.status = JOB_FAILED
+        progress.detail = str(exc)
+        print(f"Regrade {progress.regrade_id} failed: {exc}")
+    finally:
+        progress.finished_at = time.time()
+        db.close()
+
+    return progress
+
+
+class RegradeJobs:
+    """
+    Пересчеты, запущенные через API, в фоновых потоках
+    """
+
+    def __init__(self, keep: int = REGRADE_JOBS_KEEP):
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, RegradeProgress] = {}
+
+    def start(self, scope: str, target_id: int) -> RegradeProgress:
+        """
+        Запустить пересчет теста или вопроса
+
+        Args:
+            scope: test или question
+            target_id: ID теста или вопроса
+
+        Returns:
+            Состояние пересчета
+        """
+        progress = RegradeProgress(regrade_id=uuid.uuid4().hex, scope=scope, target_id=target_id)
+        with self._lock:
+            self._jobs[progress.regrade_id] = progress
+            finished = [job_id for job_id, job in self._jobs.items() if job.status != JOB_RUNNING]
+            for job_id in finished[:max(0, len(self._jobs) - self.keep)]:
+                del self._jobs[job_id]
+
+        def worker():
+            run_regrade(progress)
+            info = progress.info()
+            print(
+                f"Regrade {progress.regrade_id} ({scope} {target_id}): {info['status']}, "
+                f"{info['answers']} answers, {info['answers_changed']} answers and "
+                f"{info['sessions_changed']} sessions changed in {info['elapsed_seconds']}s"
+            )
+
+        threading.Thread(target=worker, name=f"regrade-{progress.regrade_id[:8]}", daemon=True).start()
+        return progress
+
+    def get(self, regrade_id: str) -> Optional[RegradeProgress]:
+        with self._lock:
+            return self._jobs.get(regrade_id)
+
+
+# Пересчеты приложения
+regrade_jobs = RegradeJobs()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пересчет результатов после исправления ключа ответов")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--test-id", type=int, help="Пересчитать все сессии теста")
+    target.add_argument("--question-id", type=int, help="Пересчитать ответы на вопрос во всех тестах")
+    args = parser.parse_args()
+
+    if args.test_id is not None:
+        progress = RegradeProgress(regrade_id="cli", scope=SCOPE_TEST, target_id=args.test_id)
+    else:
+        progress = RegradeProgress(regrade_id="cli", scope=SCOPE_QUESTION, target_id=args.question_id)
+
+    worker = threading.Thread(target=run_regrade, args=(progress,))
+    worker.start()
+    while worker.is_alive():
+        worker.join(1.0)
+        if worker.is_alive():
+            print(
+                f"{progress.phase}: {progress.answers_loaded} answers loaded, "
+                f"{progress.rows_written} rows written"
+            )
+    print(json.dumps(progress.info(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
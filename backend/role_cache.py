@@ -0,0 +1,219 @@
+"""
+Кэш ролей пользователей.
+
+Справочник ролей (таблица roles) загружается в память один раз, а роли
+пользователя определяются одним запросом к user_roles. Результаты хранятся
+в ограниченном LRU-кэше по user_id, который сбрасывается при изменении
+user_roles через сессии SQLAlchemy этого процесса.
+
+Изменения ролей, сделанные в обход этого процесса (другие воркеры,
+сервисы, прямые запросы к БД), видны не позже чем через
+ROLE_CACHE_TTL_SECONDS: записи кэша и справочник ролей старше этого
+срока перечитываются. При входе роли всегда читаются из БД, минуя кэш,
+поэтому в новый токен попадают актуальные роли.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+import models
+
+# Максимальное количество пользователей в кэше ролей
+ROLE_CACHE_SIZE = int(os.getenv("ROLE_CACHE_SIZE", "10000"))
+
+# Время жизни записи кэша ролей (секунды)
+ROLE_CACHE_TTL_SECONDS = float(os.getenv("ROLE_CACHE_TTL_SECONDS", "60"))
+
+# Размер пачки user_id для массовой загрузки ролей
+ROLE_BULK_CHUNK_SIZE = 1000
+
+
+class RoleResolver:
+    """
+    Разрешение ролей пользователей с кэшированием в памяти
+    """
+
+    def __init__(self, max_users: int = ROLE_CACHE_SIZE, ttl_seconds: float = ROLE_CACHE_TTL_SECONDS):
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._role_names: Optional[Dict[int, str]] = None
+        self._role_names_loaded_at = 0.0
+        # user_id -> (время загрузки, роли)
+        self._user_roles: "OrderedDict[int, Tuple[float, List[str]]]" = OrderedDict()
+
+    def _load_role_names(self, db: Session) -> Dict[int, str]:
+        """Загрузить справочник ролей (id -> name)"""
+        role_names = {role_id: name for role_id, name in db.query(models.Role.id, models.Role.name)}
+        with self._lock:
+            self._role_names = role_names
+            self._role_names_loaded_at = time.monotonic()
+        return role_names
+
+    def _role_names_for(self, db: Session, role_ids: Iterable[int]) -> Dict[int, str]:
+        """Справочник ролей, перечитанный, если он устарел или встретилась неизвестная роль"""
+        role_names = self._role_names
+        if (
+            role_names is None
+            or time.monotonic() - self._role_names_loaded_at >= self.ttl_seconds
+            or any(role_id not in role_names for role_id in role_ids)
+        ):
+            role_names = self._load_role_names(db)
+        return role_names
+
+    def _remember(self, user_id: int, roles: List[str]):
+        """Сохранить роли пользователя в LRU-кэше"""
+        with self._lock:
+            self._user_roles[user_id] = (time.monotonic(), roles)
+            self._user_roles.move_to_end(user_id)
+            while len(self._user_roles) > self.max_users:
+                self._user_roles.popitem(last=False)
+
+    def _cached(self, user_id: int) -> Optional[List[str]]:
+        """Роли пользователя из кэша или None (в том числе для устаревшей записи)"""
+        with self._lock:
+            entry = self._user_roles.get(user_id)
+            if entry is None:
+                return None
+            loaded_at, roles = entry
+            if time.monotonic() - loaded_at >= self.ttl_seconds:
+                del self._user_roles[user_id]
+                return None
+            self._user_roles.move_to_end(user_id)
+            return roles
+
+    def get_roles(self, db: Session, user_id: int, fresh: bool = False) -> List[str]:
+        """
+        Получить роли пользователя
+
+        Args:
+            db: Сессия базы данных
+            user_id: ID пользователя
+            fresh: Прочитать роли из БД, минуя кэш (например, при входе)
+
+        Returns:
+            Список названий ролей
+        """
+        if fresh:
+            # Названия ролей тоже из БД: один запрос с JOIN к roles
+            roles = [
+                name for (name,) in db.query(models.Role.name)
+                .join(models.UserRole, models.UserRole.role_id == models.Role.id)
+                .filter(models.UserRole.user_id == user_id)
+                .order_by(models.UserRole.id)
+            ]
+            self._remember(user_id, roles)
+            return list(roles)
+
+        cached = self._cached(user_id)
+        if cached is not None:
+            return list(cached)
+
+        role_ids = [
+            role_id for (role_id,) in db.query(models.UserRole.role_id)
+            .filter(models.UserRole.user_id == user_id)
+            .order_by(models.UserRole.id)
+        ]
+        role_names = self._role_names_for(db, role_ids)
+        roles = [role_names[role_id] for role_id in role_ids if role_id in role_names]
+
+        self._remember(user_id, roles)
+        return list(roles)
+
+    def get_roles_bulk(self, db: Session, user_ids: Iterable[int]) -> Dict[int, List[str]]:
+        """
+        Получить роли для множества пользователей
+
+        Пользователи, которых нет в кэше, загружаются запросами
+        WHERE user_id IN (...) пачками по ROLE_BULK_CHUNK_SIZE.
+
+        Args:
+            db: Сессия базы данных
+            user_ids: ID пользователей
+
+        Returns:
+            Словарь user_id -> список названий ролей
+        """
+        result: Dict[int, List[str]] = {}
+        missing: List[int] = []
+
+        for user_id in dict.fromkeys(user_ids):
+            cached = self._cached(user_id)
+            if cached is not None:
+                result[user_id] = list(cached)
+            else:
+                missing.append(user_id)
+
+        for start in range(0, len(missing), ROLE_BULK_CHUNK_SIZE):
+            chunk = missing[start:start + ROLE_BULK_CHUNK_SIZE]
+            rows = (
+                db.query(models.UserRole.user_id, models.UserRole.role_id)
+                .filter(models.UserRole.user_id.in_(chunk))
+                .order_by(models.UserRole.user_id, models.UserRole.id)
+                .all()
+            )
+            role_names = self._role_names_for(db, [role_id for _, role_id in rows])
+
+            loaded: Dict[int, List[str]] = {user_id: [] for user_id in chunk}
+            for user_id, role_id in rows:
+                if role_id in role_names:
+                    loaded[user_id].append(role_names[role_id])
+
+            for user_id, roles in loaded.items():
+                self._remember(user_id, roles)
+                result[user_id] = list(roles)
+
+        return result
+
+    def invalidate_user(self, user_id: int):
+        """Сбросить кэш ролей пользователя"""
+        with self._lock:
+            self._user_roles.pop(user_id, None)
+
+    def invalidate_all(self):
+        """Сбросить весь кэш, включая справочник ролей"""
+        with self._lock:
+            self._user_roles.clear()
+            self._role_names = None
+
+
+# Общий кэш ролей приложения
+role_resolver = RoleResolver()
+
+
+# =====================================================
+# ИНВАЛИДАЦИЯ ПРИ ИЗМЕНЕНИИ user_roles / roles
+# =====================================================
+
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_role_changes(session: Session, flush_context):
+    """Запомнить пользователей, чьи роли изменились в этой транзакции"""
+    changed: Set[int] = session.info.setdefault("role_cache_users", set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, models.UserRole) and obj.user_id is not None:
+            changed.add(obj.user_id)
+        elif isinstance(obj, models.Role):
+            session.info["role_cache_reset"] = True
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _apply_role_changes(session: Session):
+    """Сбросить кэш после фиксации транзакции"""
+    if session.info.pop("role_cache_reset", False):
+        role_resolver.invalidate_all()
+    for user_id in session.info.pop("role_cache_users", set()):
+        role_resolver.invalidate_user(user_id)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_role_changes(session: Session):
+    """Забыть изменения отмененной транзакции"""
+    session.info.pop("role_cache_users", None)
+    session.info.pop("role_cache_reset", None)
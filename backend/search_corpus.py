@@ -0,0 +1,299 @@
+"""
+Генератор синтетического банка вопросов и замер задержки поиска.
+
+Слова генерируются из слогов, частоты слов подчиняются закону Ципфа,
+как в текстах на естественном языке. Корпус можно загрузить в БД
+или сразу проиндексировать в памяти и замерить задержку search_index.
+
+Примеры:
+    python search_corpus.py --questions 500000 --bench
+    python search_corpus.py --questions 100000 --load-db --creator-id 1
+    python search_corpus.py --check
+"""
+
+import argparse
+import itertools
+import random
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+_SYLLABLES = [
+    "ка", "ло", "ри", "те", "на", "ви", "мо", "за", "ду", "пе", "ся", "ни",
+    "ра", "то", "ли", "го", "бе", "ст", "ко", "ме", "ци", "ян", "ор", "ин",
+    "ал", "ус", "ек", "ом", "ит", "аз", "ер", "ов", "ам", "ес", "ум", "ик"
+]
+
+
+def make_vocabulary(size: int, rng: random.Random) -> List[str]:
+    """Словарь уникальных псевдослов из 2-5 слогов"""
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 5))))
+    # Порядок множества зависит от PYTHONHASHSEED, поэтому сначала сортируем
+    vocabulary = sorted(words)
+    rng.shuffle(vocabulary)
+    return vocabulary
+
+
+def generate_questions(
+    count: int,
+    seed: int = 42,
+    vocabulary_size: int = 50000,
+    documents: int = 200
+) -> Iterator[Dict[str, Any]]:
+    """
+    Сгенерировать вопросы с четырьмя вариантами ответа
+
+    Args:
+        count: Количество вопросов
+        seed: Зерно генератора (корпус воспроизводим)
+        vocabulary_size: Размер словаря
+        documents: Количество документов-источников (source_document_id 1..N)
+
+    Yields:
+        Словари с ключами id, question_text, answers, is_approved,
+        source_document_id, updated_at
+    """
+    vocabulary = make_vocabulary(vocabulary_size, random.Random(seed))
+    rng = random.Random(seed)
+    cum_weights = list(itertools.accumulate(1.0 / rank for rank in range(1, vocabulary_size + 1)))
+
+    def sentence(low: int, high: int) -> str:
+        return " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(low, high)))
+
+    for question_id in range(1, count + 1):
+        yield {
+            "id": question_id,
+            "question_text": sentence(8, 20).capitalize() + "?",
+            "answers": [sentence(1, 6) for _ in range(4)],
+            "is_approved": rng.random() < 0.6,
+            "source_document_id": rng.randint(1, documents) if rng.random() < 0.8 else None,
+            "updated_at": None
+        }
+
+
+def sample_queries(
+    count: int,
+    seed: int = 42,
+    vocabulary_size: int = 50000,
+    query_seed: int = 7
+) -> List[Dict[str, Any]]:
+    """
+    Набор запросов для замера: частые и редкие слова, префиксы, фильтры
+
+    Словарь совпадает со словарем generate_questions при тех же seed
+    и vocabulary_size.
+    """
+    vocabulary = make_vocabulary(vocabulary_size, random.Random(seed))
+    rng = random.Random(query_seed)
+    queries = []
+    for _ in range(count):
+        # Слова из "головы" и "хвоста" распределения
+        words = [vocabulary[min(int(rng.paretovariate(0.6)) - 1, vocabulary_size - 1)] for _ in range(rng.randint(1, 3))]
+        query: Dict[str, Any] = {"query": " ".join(words)}
+        kind = rng.random()
+        if kind < 0.25:
+            query["query"] = query["query"][:-1] + "*"
+        elif kind < 0.4:
+            query["approved"] = True
+        elif kind < 0.5:
+            query["source_document_id"] = rng.randint(1, 200)
+        elif kind < 0.6:
+            query["match"] = "any"
+        queries.append(query)
+    return queries
+
+
+def percentile(values: List[float], share: float) -> float:
+    """Перцентиль отсортированного списка"""
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def benchmark(index, queries: List[Dict[str, Any]], limit: int = 20) -> Dict[str, float]:
+    """
+    Замерить задержку поиска
+
+    Args:
+        index: SearchIndex
+        queries: Запросы из sample_queries()
+        limit: Размер страницы
+
+    Returns:
+        Перцентили задержки в миллисекундах
+    """
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(
+            query["query"],
+            approved=query.get("approved"),
+            source_document_id=query.get("source_document_id"),
+            match=query.get("match", "all"),
+            limit=limit
+        )
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    return {
+        "queries": len(timings),
+        "p50_ms": round(percentile(timings, 0.50), 2),
+        "p95_ms": round(percentile(timings, 0.95), 2),
+        "p99_ms": round(percentile(timings, 0.99), 2),
+        "max_ms": round(timings[-1], 2)
+    }
+
+
+def check_edit_ranking() -> Dict[str, Any]:
+    """
+    Проверить ранжирование после изменения вопроса
+
+    Вхождения старой версии измененного документа остаются в индексе
+    до уплотнения; выдача должна совпадать с выдачей индекса, построенного
+    заново по актуальным документам, а все оценки - быть положительными.
+
+    Returns:
+        Выдача измененного и заново построенного индекса
+
+    Raises:
+        AssertionError: Если выдача расходится или есть неположительные оценки
+    """
+    from search_index import SearchIndex
+
+    def question(question_id: int, text: str) -> Dict[str, Any]:
+        return {
+            "id": question_id,
+            "question_text": text,
+            "answers": ["Paris", "Rome", "Madrid", "Berlin"],
+            "is_approved": True,
+            "source_document_id": None,
+            "updated_at": None
+        }
+
+    questions = [
+        question(1, "What is the capital of France?"),
+        question(2, "Which city is the capital of Italy?"),
+        question(3, "Name the capital of Spain"),
+        question(4, "The capital of Germany is?"),
+    ]
+    edited = question(1, "What is the capital city of France, the country in western Europe?")
+
+    index = SearchIndex()
+    index.add_documents(questions)
+    index.merge()
+    index.add_documents([edited])
+
+    fresh = SearchIndex()
+    fresh.add_documents([edited] + questions[1:])
+    fresh.merge()
+
+    result = {"edited": index.search("capital")[1], "fresh": fresh.search("capital")[1]}
+    assert all(score > 0 for _, score in result["edited"]), result
+    assert [question_id for question_id, _ in result["edited"]] == [
+        question_id for question_id, _ in result["fresh"]
+    ], result
+    return result
+
+
+def load_into_database(
+    count: int,
+    creator_id: int,
+    seed: int = 42,
+    document_ids: Optional[List[int]] = None,
+    batch_size: int = 2000
+):
+    """
+    Загрузить корпус в БД многострочными INSERT
+
+    Рассчитано на отдельную БД для замеров: id вставленной пачки
+    вопросов определяются по max(id) до вставки.
+
+    Args:
+        count: Количество вопросов
+        creator_id: ID пользователя-создателя
+        seed: Зерно генератора
+        document_ids: ID существующих документов для source_document_id
+        batch_size: Размер пачки
+    """
+    from sqlalchemy import func, insert
+
+    from database import SessionLocal
+    import models
+
+    db = SessionLocal()
+    try:
+        generated = generate_questions(count, seed)
+        loaded = 0
+        while True:
+            batch = list(itertools.islice(generated, batch_size))
+            if not batch:
+                break
+
+            last_id = db.query(func.max(models.Question.id)).scalar() or 0
+            db.execute(insert(models.Question), [
+                {
+                    "question_text": question["question_text"],
+                    "creator_id": creator_id,
+                    "is_approved": question["is_approved"],
+                    "source_document_id": (
+                        document_ids[question["source_document_id"] % len(document_ids)]
+                        if document_ids and question["source_document_id"] else None
+                    )
+                }
+                for question in batch
+            ])
+            question_ids = [
+                question_id for (question_id,) in db.query(models.Question.id)
+                .filter(models.Question.id > last_id)
+                .order_by(models.Question.id)
+                .limit(len(batch))
+            ]
+            db.execute(insert(models.AnswerOption), [
+                {
+                    "question_id": question_id,
+                    "answer_text": answer_text,
+                    "is_correct": order == 1,
+                    "option_order": order
+                }
+                for question_id, question in zip(question_ids, batch)
+                for order, answer_text in enumerate(question["answers"], start=1)
+            ])
+            db.commit()
+
+            loaded += len(batch)
+            print(f"Loaded {loaded}/{count} questions")
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетический банк вопросов для замеров поиска")
+    parser.add_argument("--questions", type=int, default=500000, help="Количество вопросов")
+    parser.add_argument("--seed", type=int, default=42, help="Зерно генератора")
+    parser.add_argument("--bench", action="store_true", help="Проиндексировать в памяти и замерить поиск")
+    parser.add_argument("--queries", type=int, default=2000, help="Количество запросов для замера")
+    parser.add_argument("--check", action="store_true", help="Проверить ранжирование после изменения вопроса")
+    parser.add_argument("--load-db", action="store_true", help="Загрузить корпус в БД")
+    parser.add_argument("--creator-id", type=int, default=1, help="ID создателя вопросов")
+    parser.add_argument("--document-ids", type=int, nargs="*", help="ID документов-источников")
+    args = parser.parse_args()
+
+    if args.check:
+        print(check_edit_ranking())
+
+    if args.load_db:
+        load_into_database(args.questions, args.creator_id, args.seed, args.document_ids)
+
+    if args.bench:
+        from search_index import SearchIndex
+
+        index = SearchIndex()
+        start = time.perf_counter()
+        index.add_documents(generate_questions(args.questions, args.seed))
+        index.merge()
+        print(f"Indexed {args.questions} questions in {time.perf_counter() - start:.1f}s")
+        print(index.info())
+        print(benchmark(index, sample_queries(args.queries, args.seed)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,808 @@
+"""
+Полнотекстовый поиск по банку вопросов.
+
+Инвертированный индекс в памяти процесса по questions.question_text
+и answer_options.answer_text с ранжированием BM25. Индекс строится
+при старте пачками по id и затем обновляется инкрементально:
+вопросы с questions.updated_at не раньше последнего просмотренного
+значения, а также вопросы, измененные или удаленные через сессии
+этого процесса, переиндексируются фоновым потоком.
+
+Устройство индекса:
+- основной сегмент: term -> NumPy-массивы порядковых номеров документов
+  (отсортированы), частот и заранее посчитанного насыщения BM25;
+  запрос с несколькими терминами начинает с самого редкого и пересекает
+  кандидатов с остальными через двоичный поиск;
+- дельта-сегмент: недавно добавленные документы в обычных списках,
+  периодически сливается с основным;
+- измененный документ получает новый порядковый номер, старый помечается
+  удаленным; при накоплении удаленных индекс уплотняется.
+
+Загруженные из БД документы передаются подписчикам (add_listener), чтобы
+другие индексы по банку вопросов не читали те же строки повторно.
+"""
+
+import bisect
+import heapq
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+import models
+
+# Интервал инкрементального обновления индекса (секунды)
+SEARCH_REFRESH_SECONDS = float(os.getenv("SEARCH_REFRESH_SECONDS", "5"))
+
+# Интервал сверки индекса со списком id вопросов (удаления другими процессами)
+SEARCH_RECONCILE_SECONDS = float(os.getenv("SEARCH_RECONCILE_SECONDS", "300"))
+
+# Размер пачки вопросов при построении индекса
+SEARCH_BUILD_CHUNK_SIZE = 5000
+
+# Сколько вхождений накапливать в дельта-сегменте до слияния
+SEARCH_MERGE_POSTINGS = 200000
+
+# Максимальное количество терминов, в которые раскрывается префикс
+SEARCH_PREFIX_MAX_TERMS = 64
+
+# Параметры BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Вес слов текста вопроса относительно слов вариантов ответа
+QUESTION_TEXT_WEIGHT = 2
+
+# Режимы сопоставления запроса
+MATCH_ALL = "all"
+MATCH_ANY = "any"
+
+# Насыщение BM25 пересчитывается, если средняя длина документа ушла дальше
+BM25_AVERAGE_LENGTH_DRIFT = 0.1
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_QUERY_RE = re.compile(r"(\w+)(\*?)", re.UNICODE)
+
+
+def normalize(text: str) -> str:
+    """Нижний регистр и ё -> е"""
+    return text.lower().replace("ё", "е")
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """
+    Разбить текст на термины
+
+    Args:
+        text: Исходный текст
+
+    Returns:
+        Список терминов в нижнем регистре
+    """
+    if not text:
+        return []
+    return _TOKEN_RE.findall(normalize(text))
+
+
+def parse_query(query: str, prefix_last: bool = False) -> List[Tuple[str, bool]]:
+    """
+    Разобрать поисковый запрос
+
+    Термин со звездочкой на конце ("интегр*") ищется по префиксу.
+
+    Args:
+        query: Строка запроса
+        prefix_last: Искать последний термин по префиксу (поиск по мере ввода)
+
+    Returns:
+        Список пар (термин, искать по префиксу)
+    """
+    terms = [(term, bool(star)) for term, star in _QUERY_RE.findall(normalize(query))]
+    if prefix_last and terms:
+        terms[-1] = (terms[-1][0], True)
+    # Повтор слова в запросе не меняет выдачу
+    return list(dict.fromkeys(terms))
+
+
+def bm25_saturation(tfs: np.ndarray, lengths: np.ndarray, average_length: float) -> np.ndarray:
+    """Множитель BM25 без IDF: tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl))"""
+    tfs = tfs.astype(np.float32)
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / average_length)
+    return (tfs * (BM25_K1 + 1) / (tfs + norm)).astype(np.float32)
+
+
+class _Column:
+    """Растущий NumPy-массив с удвоением емкости"""
+
+    def __init__(self, dtype, fill=0):
+        self.dtype = dtype
+        self.fill = fill
+        self.data = np.full(1024, fill, dtype=dtype)
+        self.size = 0
+
+    def append(self, value):
+        if self.size == len(self.data):
+            grown = np.full(len(self.data) * 2, self.fill, dtype=self.dtype)
+            grown[:self.size] = self.data
+            self.data = grown
+        self.data[self.size] = value
+        self.size += 1
+
+    def view(self) -> np.ndarray:
+        return self.data[:self.size]
+
+    def replace(self, values: np.ndarray):
+        self.data = np.full(max(1024, len(values) * 2), self.fill, dtype=self.dtype)
+        self.data[:len(values)] = values
+        self.size = len(values)
+
+
+class SearchIndex:
+    """
+    Инвертированный индекс вопросов с ранжированием BM25
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._listeners: List[Any] = []
+        self._reset()
+
+    def add_listener(self, listener: Any):
+        """
+        Подписать индекс на документы, загружаемые из БД
+
+        Подписчик реализует reset(), add_documents(documents),
+        remove_documents(question_ids) и merge().
+
+        Args:
+            listener: Подписчик
+        """
+        self._listeners.append(listener)
+
+    def _reset(self):
+        """Пустой индекс"""
+        # Атрибуты документов по порядковому номеру
+        self._qids = _Column(np.int64)
+        self._lengths = _Column(np.float32)
+        self._approved = _Column(np.bool_, False)
+        self._sources = _Column(np.int64, -1)
+        self._alive = _Column(np.bool_, False)
+        # question_id -> (порядковый номер, updated_at)
+        self._docs: Dict[int, Tuple[int, Optional[datetime]]] = {}
+        # Основной сегмент: term -> (ordinals, tfs, saturation)
+        self._postings: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+        # Средняя длина документа, с которой посчитано насыщение
+        self._saturation_length = 1.0
+        # Отсортированный словарь для префиксов
+        self._vocab: List[str] = []
+        # Дельта-сегмент
+        self._delta: Dict[str, Tuple[List[int], List[float]]] = {}
+        self._delta_postings = 0
+        self._total_length = 0.0
+        self._dead = 0
+        # Вопросы, измененные или удаленные через сессии этого процесса
+        self._dirty: Set[int] = set()
+        self._watermark: Optional[datetime] = None
+        self.ready = False
+        self.built_at: Optional[float] = None
+        self.refreshed_at: Optional[float] = None
+        self.reconciled_at: Optional[float] = None
+
+    # -------------------------------------------------
+    # Изменение индекса
+    # -------------------------------------------------
+
+    def _remove(self, question_id: int):
+        """Пометить документ удаленным (вызывается под блокировкой)"""
+        doc = self._docs.pop(question_id, None)
+        if doc is None:
+            return
+        ordinal = doc[0]
+        self._alive.data[ordinal] = False
+        self._total_length -= float(self._lengths.data[ordinal])
+        self._dead += 1
+
+    def _add(self, document: Dict[str, Any]):
+        """Добавить документ в дельта-сегмент (вызывается под блокировкой)"""
+        question_id = document["id"]
+        self._remove(question_id)
+
+        frequencies: Counter = Counter()
+        for term in tokenize(document["question_text"]):
+            frequencies[term] += QUESTION_TEXT_WEIGHT
+        for answer_text in document["answers"]:
+            for term in tokenize(answer_text):
+                frequencies[term] += 1
+        length = float(sum(frequencies.values()))
+
+        ordinal = self._qids.size
+        self._qids.append(question_id)
+        self._lengths.append(length)
+        self._approved.append(bool(document["is_approved"]))
+        source_document_id = document["source_document_id"]
+        self._sources.append(source_document_id if source_document_id is not None else -1)
+        self._alive.append(True)
+        self._docs[question_id] = (ordinal, document["updated_at"])
+        self._total_length += length
+
+        for term, frequency in frequencies.items():
+            ordinals, tfs = self._delta.setdefault(term, ([], []))
+            ordinals.append(ordinal)
+            tfs.append(frequency)
+        self._delta_postings += len(frequencies)
+
+    def add_documents(self, documents: Iterable[Dict[str, Any]]):
+        """
+        Добавить или обновить документы
+
+        Args:
+            documents: Словари с ключами id, question_text, answers,
+                is_approved, source_document_id, updated_at
+        """
+        with self._lock:
+            for document in documents:
+                self._add(document)
+                if self._delta_postings >= SEARCH_MERGE_POSTINGS:
+                    self._merge()
+
+    def remove_documents(self, question_ids: Iterable[int]):
+        """Удалить документы из индекса"""
+        with self._lock:
+            for question_id in question_ids:
+                self._remove(question_id)
+
+    def merge(self):
+        """Слить дельта-сегмент с основным"""
+        with self._lock:
+            self._merge()
+
+    def _average_length(self) -> float:
+        return self._total_length / len(self._docs) if self._docs else 1.0
+
+    def _merge(self):
+        """Слить дельта-сегмент с основным (вызывается под блокировкой)"""
+        average_length = self._average_length()
+        if abs(average_length - self._saturation_length) > BM25_AVERAGE_LENGTH_DRIFT * self._saturation_length:
+            self._rescore(average_length)
+
+        if not self._delta:
+            return
+
+        lengths = self._lengths.view()
+        new_terms = []
+        for term, (ordinals, tfs) in self._delta.items():
+            # Номера дельты больше любых номеров основного сегмента,
+            # поэтому после склейки массив остается отсортированным
+            delta_ordinals = np.asarray(ordinals, dtype=np.int32)
+            delta_tfs = np.minimum(np.asarray(tfs), 255).astype(np.uint8)
+            delta_saturation = bm25_saturation(delta_tfs, lengths[delta_ordinals], self._saturation_length)
+            existing = self._postings.get(term)
+            if existing is None:
+                self._postings[term] = (delta_ordinals, delta_tfs, delta_saturation)
+                new_terms.append(term)
+            else:
+                self._postings[term] = (
+                    np.concatenate((existing[0], delta_ordinals)),
+                    np.concatenate((existing[1], delta_tfs)),
+                    np.concatenate((existing[2], delta_saturation))
+                )
+
+        if new_terms:
+            new_terms.sort()
+            self._vocab = list(heapq.merge(self._vocab, new_terms))
+
+        self._delta = {}
+        self._delta_postings = 0
+
+        if self._dead > 1000 and self._dead * 4 > len(self._docs):
+            self._compact()
+
+    def _rescore(self, average_length: float):
+        """Пересчитать насыщение BM25 под новую среднюю длину (под блокировкой)"""
+        lengths = self._lengths.view()
+        for term, (ordinals, tfs, _) in self._postings.items():
+            self._postings[term] = (ordinals, tfs, bm25_saturation(tfs, lengths[ordinals], average_length))
+        self._saturation_length = average_length
+
+    def _compact(self):
+        """Удалить помеченные документы и перенумеровать оставшиеся (под блокировкой)"""
+        alive = self._alive.view()
+        remap = np.cumsum(alive, dtype=np.int64) - 1
+
+        postings = {}
+        for term, (ordinals, tfs, saturation) in self._postings.items():
+            keep = alive[ordinals]
+            if keep.any():
+                postings[term] = (remap[ordinals[keep]].astype(np.int32), tfs[keep], saturation[keep])
+        self._postings = postings
+        self._vocab = sorted(postings)
+
+        for column in (self._qids, self._lengths, self._approved, self._sources, self._alive):
+            column.replace(column.view()[alive])
+        self._docs = {
+            question_id: (int(remap[ordinal]), updated_at)
+            for question_id, (ordinal, updated_at) in self._docs.items()
+        }
+        self._dead = 0
+
+    # -------------------------------------------------
+    # Загрузка из БД
+    # -------------------------------------------------
+
+    @staticmethod
+    def _documents(db: Session, rows: List[Any]) -> List[Dict[str, Any]]:
+        """Документы для строк вопросов с вариантами ответов (один запрос)"""
+        if not rows:
+            return []
+
+        answers: Dict[int, List[str]] = {row.id: [] for row in rows}
+        for question_id, answer_text in db.query(
+            models.AnswerOption.question_id,
+            models.AnswerOption.answer_text
+        ).filter(models.AnswerOption.question_id.in_(list(answers))):
+            answers[question_id].append(answer_text)
+
+        return [
+            {
+                "id": row.id,
+                "question_text": row.question_text,
+                "answers": answers[row.id],
+                "is_approved": row.is_approved,
+                "source_document_id": row.source_document_id,
+                "updated_at": row.updated_at
+            }
+            for row in rows
+        ]
+
+    @staticmethod
+    def _question_rows(db: Session):
+        """Запрос колонок вопросов, нужных индексу"""
+        return db.query(
+            models.Question.id,
+            models.Question.question_text,
+            models.Question.is_approved,
+            models.Question.source_document_id,
+            models.Question.updated_at
+        )
+
+    def _advance_watermark(self, rows: List[Any]):
+        """Сдвинуть отметку последнего просмотренного updated_at"""
+        for row in rows:
+            if row.updated_at is not None and (self._watermark is None or row.updated_at > self._watermark):
+                self._watermark = row.updated_at
+
+    def build(self, db: Session):
+        """
+        Построить индекс заново
+
+        Вопросы читаются пачками по SEARCH_BUILD_CHUNK_SIZE (keyset по id),
+        варианты ответов - одним запросом на пачку.
+
+        Args:
+            db: Сессия базы данных
+        """
+        fresh = SearchIndex()
+        for listener in self._listeners:
+            listener.reset()
+
+        last_id = 0
+        while True:
+            rows = (
+                self._question_rows(db)
+                .filter(models.Question.id > last_id)
+                .order_by(models.Question.id)
+                .limit(SEARCH_BUILD_CHUNK_SIZE)
+                .all()
+            )
+            if not rows:
+                break
+            documents = self._documents(db, rows)
+            fresh.add_documents(documents)
+            fresh._advance_watermark(rows)
+            for listener in self._listeners:
+                listener.add_documents(documents)
+            last_id = rows[-1].id
+
+        fresh.merge()
+        for listener in self._listeners:
+            listener.merge()
+
+        now = time.monotonic()
+        with self._lock:
+            dirty = self._dirty
+            self._qids, self._lengths = fresh._qids, fresh._lengths
+            self._approved, self._sources, self._alive = fresh._approved, fresh._sources, fresh._alive
+            self._docs, self._postings, self._vocab = fresh._docs, fresh._postings, fresh._vocab
+            self._saturation_length = fresh._saturation_length
+            self._delta, self._delta_postings = fresh._delta, fresh._delta_postings
+            self._total_length, self._dead = fresh._total_length, fresh._dead
+            self._watermark = fresh._watermark
+            # Изменения, сделанные во время построения, переиндексируются
+            self._dirty = dirty
+            self.ready = True
+            self.built_at = self.refreshed_at = self.reconciled_at = now
+
+    def _reindex(self, db: Session, question_ids: List[int]):
+        """Переиндексировать вопросы по id; отсутствующие в БД удаляются"""
+        for start in range(0, len(question_ids), SEARCH_BUILD_CHUNK_SIZE):
+            chunk = question_ids[start:start + SEARCH_BUILD_CHUNK_SIZE]
+            rows = self._question_rows(db).filter(models.Question.id.in_(chunk)).all()
+            documents = self._documents(db, rows)
+            found = {row.id for row in rows}
+            missing = [question_id for question_id in chunk if question_id not in found]
+            with self._lock:
+                for document in documents:
+                    self._add(document)
+                for question_id in missing:
+                    self._remove(question_id)
+                self._advance_watermark(rows)
+            for listener in self._listeners:
+                listener.add_documents(documents)
+                listener.remove_documents(missing)
+
+    def sync_dirty(self, db: Session):
+        """
+        Переиндексировать вопросы, измененные через сессии этого процесса
+
+        Вызывается перед поиском, чтобы свои изменения были видны сразу.
+
+        Args:
+            db: Сессия базы данных
+        """
+        if not self._dirty:
+            return
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        self._reindex(db, sorted(dirty))
+
+    def refresh(self, db: Session):
+        """
+        Инкрементально обновить индекс
+
+        Переиндексируются вопросы с updated_at не раньше отметки
+        (кроме уже проиндексированных с тем же updated_at) и измененные
+        через сессии этого процесса. Раз в SEARCH_RECONCILE_SECONDS
+        удаляются вопросы, которых больше нет в БД.
+
+        Args:
+            db: Сессия базы данных
+        """
+        if not self.ready:
+            self.build(db)
+            return
+
+        self.sync_dirty(db)
+
+        changed: List[int] = []
+        if self._watermark is not None:
+            for question_id, updated_at in db.query(
+                models.Question.id,
+                models.Question.updated_at
+            ).filter(models.Question.updated_at >= self._watermark):
+                doc = self._docs.get(question_id)
+                if doc is None or doc[1] != updated_at:
+                    changed.append(question_id)
+        else:
+            changed = [question_id for (question_id,) in db.query(models.Question.id)]
+        self._reindex(db, changed)
+
+        now = time.monotonic()
+        if now - (self.reconciled_at or 0) >= SEARCH_RECONCILE_SECONDS:
+            existing = {question_id for (question_id,) in db.query(models.Question.id)}
+            with self._lock:
+                missing = [question_id for question_id in self._docs if question_id not in existing]
+                for question_id in missing:
+                    self._remove(question_id)
+            for listener in self._listeners:
+                listener.remove_documents(missing)
+            self.reconciled_at = now
+
+        self.merge()
+        for listener in self._listeners:
+            listener.merge()
+        self.refreshed_at = now
+
+    def mark_dirty(self, question_ids: Iterable[int]):
+        """Отметить вопросы для переиндексации"""
+        with self._lock:
+            self._dirty.update(question_ids)
+
+    # -------------------------------------------------
+    # Поиск
+    # -------------------------------------------------
+
+    def _expand(self, term: str, prefix: bool) -> List[str]:
+        """Термины индекса для термина запроса (под блокировкой)"""
+        if not prefix:
+            return [term]
+
+        matches = []
+        start = bisect.bisect_left(self._vocab, term)
+        for candidate in self._vocab[start:]:
+            if not candidate.startswith(term):
+                break
+            matches.append(candidate)
+        matches.extend(
+            candidate for candidate in self._delta
+            if candidate.startswith(term) and candidate not in self._postings
+        )
+
+        if len(matches) > SEARCH_PREFIX_MAX_TERMS:
+            # Самые частые термины дают основной вклад в выдачу
+            matches = heapq.nlargest(SEARCH_PREFIX_MAX_TERMS, matches, key=self._document_frequency)
+        return matches
+
+    def _document_frequency(self, term: str) -> int:
+        main = self._postings.get(term)
+        delta = self._delta.get(term)
+        return (len(main[0]) if main else 0) + (len(delta[0]) if delta else 0)
+
+    def _group(self, term: str, prefix: bool, average_length: float) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Вхождения термина запроса (под блокировкой)
+
+        Returns:
+            Список пар (отсортированные номера документов, вклад в BM25)
+            по каждому раскрытию термина
+        """
+        documents = len(self._docs)
+        group = []
+        for expanded in self._expand(term, prefix):
+            main = self._postings.get(expanded)
+            delta = self._delta.get(expanded)
+            if main is None and delta is None:
+                continue
+
+            if delta is not None:
+                delta_ordinals = np.asarray(delta[0], dtype=np.int32)
+                delta_saturation = bm25_saturation(
+                    np.asarray(delta[1]), self._lengths.data[delta_ordinals], average_length
+                )
+            if main is None:
+                ordinals, saturation = delta_ordinals, delta_saturation
+            elif delta is None:
+                ordinals, saturation = main[0], main[2]
+            else:
+                ordinals = np.concatenate((main[0], delta_ordinals))
+                saturation = np.concatenate((main[2], delta_saturation))
+
+            # Вхождения измененных и удаленных документов остаются до уплотнения
+            # и не должны учитываться в частоте термина
+            frequency = int(np.count_nonzero(self._alive.data[ordinals])) if self._dead else len(ordinals)
+            idf = math.log(1 + (documents - frequency + 0.5) / (frequency + 0.5))
+            group.append((ordinals, saturation * np.float32(idf)))
+        return group
+
+    def _dense(self, group: List[Tuple[np.ndarray, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+        """Вклады группы в плотных массивах по всем документам (под блокировкой)"""
+        scores = np.zeros(self._qids.size, dtype=np.float32)
+        present = np.zeros(self._qids.size, dtype=np.bool_)
+        for ordinals, contributions in group:
+            # Внутри одного термина номера не повторяются
+            scores[ordinals] += contributions
+            present[ordinals] = True
+        return scores, present
+
+    def _union(self, group: List[Tuple[np.ndarray, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+        """Объединение вхождений с суммой вкладов (под блокировкой)"""
+        if len(group) == 1:
+            return group[0]
+        postings = sum(len(ordinals) for ordinals, _ in group)
+        if postings * 8 < self._qids.size:
+            ordinals = np.concatenate([ordinals for ordinals, _ in group])
+            scores = np.concatenate([scores for _, scores in group])
+            unique, inverse = np.unique(ordinals, return_inverse=True)
+            return unique, np.bincount(inverse, weights=scores).astype(np.float32)
+        scores, present = self._dense(group)
+        candidates = np.flatnonzero(present)
+        return candidates, scores[candidates]
+
+    def _filter(
+        self,
+        candidates: np.ndarray,
+        scores: np.ndarray,
+        approved: Optional[bool],
+        source_document_id: Optional[int]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Оставить живые документы, подходящие под фильтры (под блокировкой)"""
+        mask = self._alive.data[candidates]
+        if approved is not None:
+            mask &= self._approved.data[candidates] == approved
+        if source_document_id is not None:
+            mask &= self._sources.data[candidates] == source_document_id
+        return candidates[mask], scores[mask]
+
+    def search(
+        self,
+        query: str,
+        approved: Optional[bool] = None,
+        source_document_id: Optional[int] = None,
+        limit: int = 20,
+        offset: int = 0,
+        match: str = MATCH_ALL,
+        prefix_last: bool = False
+    ) -> Tuple[int, List[Tuple[int, float]]]:
+        """
+        Найти вопросы по запросу
+
+        Args:
+            query: Строка запроса ("интегр*" - поиск по префиксу)
+            approved: Фильтр по is_approved
+            source_document_id: Фильтр по документу-источнику
+            limit: Размер страницы
+            offset: Смещение
+            match: all - все термины запроса, any - хотя бы один
+            prefix_last: Искать последний термин по префиксу
+
+        Returns:
+            Кортеж (количество найденных, список (question_id, score))
+        """
+        terms = parse_query(query, prefix_last)
+        if not terms:
+            return 0, []
+
+        with self._lock:
+            if not self._docs:
+                return 0, []
+
+            average_length = self._average_length()
+            groups = [self._group(term, prefix, average_length) for term, prefix in terms]
+
+            if match == MATCH_ANY:
+                groups = [group for group in groups if group]
+                if not groups:
+                    return 0, []
+                candidates, scores = self._union([pair for group in groups for pair in group])
+                candidates, scores = self._filter(candidates, scores, approved, source_document_id)
+            else:
+                if not all(groups):
+                    return 0, []
+                # Самый редкий термин задает кандидатов, остальные их отсеивают
+                groups.sort(key=lambda group: sum(len(ordinals) for ordinals, _ in group))
+                candidates, scores = self._union(groups[0])
+                candidates, scores = self._filter(candidates, scores, approved, source_document_id)
+
+                for group in groups[1:]:
+                    if not len(candidates):
+                        break
+                    postings = sum(len(ordinals) for ordinals, _ in group)
+                    if len(candidates) * 16 < postings:
+                        # Мало кандидатов - двоичный поиск по вхождениям
+                        hit = np.zeros(len(candidates), dtype=np.bool_)
+                        group_scores = np.zeros(len(candidates), dtype=np.float32)
+                        for ordinals, contributions in group:
+                            positions = np.minimum(np.searchsorted(ordinals, candidates), len(ordinals) - 1)
+                            found = ordinals[positions] == candidates
+                            group_scores[found] += contributions[positions[found]]
+                            hit |= found
+                    else:
+                        dense_scores, present = self._dense(group)
+                        hit = present[candidates]
+                        group_scores = dense_scores[candidates]
+                    candidates, scores = candidates[hit], scores[hit] + group_scores[hit]
+
+            total = len(candidates)
+            wanted = offset + limit
+            if total == 0 or wanted <= 0:
+                return total, []
+
+            if total > wanted:
+                top = np.argpartition(-scores, wanted - 1)[:wanted]
+                candidates, scores = candidates[top], scores[top]
+
+            qids = self._qids.data[candidates]
+            # По убыванию релевантности, при равенстве - новые вопросы первыми
+            order = np.lexsort((-qids, -scores))[offset:wanted]
+
+            return total, [
+                (int(qids[i]), round(float(scores[i]), 4)) for i in order
+            ]
+
+    def info(self) -> Dict[str, Any]:
+        """Состояние индекса"""
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "documents": len(self._docs),
+                "terms": len(self._postings) + sum(1 for term in self._delta if term not in self._postings),
+                "delta_postings": self._delta_postings,
+                "deleted": self._dead,
+                "pending": len(self._dirty),
+                "watermark": self._watermark.isoformat() if self._watermark else None,
+                "refreshed_seconds_ago": round(time.monotonic() - self.refreshed_at, 1) if self.refreshed_at else None
+            }
+
+    # -------------------------------------------------
+    # Фоновое обновление
+    # -------------------------------------------------
+
+    def start_background_refresh(
+        self,
+        session_factory: Callable[[], Session],
+        interval_seconds: float = SEARCH_REFRESH_SECONDS
+    ):
+        """
+        Запустить фоновый поток: построение индекса и инкрементальные обновления
+
+        Args:
+            session_factory: Фабрика сессий (SessionLocal)
+            interval_seconds: Интервал обновления
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+
+        def worker():
+            while not self._stop.is_set():
+                db = session_factory()
+                try:
+                    self.refresh(db)
+                except Exception as e:
+                    print(f"Search index refresh failed: {e}")
+                finally:
+                    db.close()
+                self._stop.wait(interval_seconds)
+
+        self._thread = threading.Thread(target=worker, name="search-index", daemon=True)
+        self._thread.start()
+
+    def stop_background_refresh(self):
+        """Остановить фоновое обновление"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+# Общий поисковый индекс приложения
+search_index = SearchIndex()
+
+
+# =====================================================
+# ОТСЛЕЖИВАНИЕ ИЗМЕНЕНИЙ ВОПРОСОВ
+# =====================================================
+
+def note_question_changes(session: Session, question_ids: Iterable[int]):
+    """
+    Учесть вопросы, измененные в обход ORM (массовые UPDATE/DELETE)
+
+    Вопросы будут отмечены для переиндексации при фиксации транзакции.
+    """
+    session.info.setdefault("search_index_questions", set()).update(question_ids)
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_search_changes(session: Session, flush_context):
+    """Запомнить вопросы, измененные в этой транзакции"""
+    changed: Set[int] = session.info.setdefault("search_index_questions", set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, models.Question) and obj.id is not None:
+            changed.add(obj.id)
+        elif isinstance(obj, models.AnswerOption) and obj.question_id is not None:
+            changed.add(obj.question_id)
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _apply_search_changes(session: Session):
+    """Отметить измененные вопросы для переиндексации после фиксации"""
+    changed = session.info.pop("search_index_questions", None)
+    if changed:
+        search_index.mark_dirty(changed)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_search_changes(session: Session):
+    """Забыть изменения отмененной транзакции"""
+    session.info.pop("search_index_questions", None)
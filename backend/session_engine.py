@@ -0,0 +1,703 @@
+"""
+Серверное прохождение тестов: старт сессии, ответы и завершение.
+
+Ответы студента не пишутся в БД по одному: они накапливаются в буфере
+сессии в памяти процесса и записываются в user_answers одним
+многострочным INSERT при завершении теста или на контрольных точках
+(каждые SESSION_CHECKPOINT_SIZE новых ответов). Проверка ответов идет
+по ключу правильных вариантов из скомпилированного теста (payload_cache),
+без запросов к answer_options.
+
+Буфер брошенной сессии (начата, но не завершена) вытесняется после
+истечения ограничения времени теста (time_limit_minutes) плюс
+SESSION_BUFFER_GRACE_SECONDS, а у тестов без ограничения - после
+SESSION_BUFFER_IDLE_SECONDS без новых ответов. Незаписанные ответы
+вытесняемых буферов перед этим записываются в БД.
+"""
+
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import func, insert
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.orm import Session
+
+import audit
+import models
+import payload_cache
+import user_stats
+
+# Сколько новых ответов накапливать до промежуточной записи в БД
+SESSION_CHECKPOINT_SIZE = int(os.getenv("SESSION_CHECKPOINT_SIZE", "20"))
+
+# Запас сверх ограничения времени теста до вытеснения буфера (секунды)
+SESSION_BUFFER_GRACE_SECONDS = float(os.getenv("SESSION_BUFFER_GRACE_SECONDS", "900"))
+
+# Время без новых ответов до вытеснения буфера теста без ограничения времени (секунды)
+SESSION_BUFFER_IDLE_SECONDS = float(os.getenv("SESSION_BUFFER_IDLE_SECONDS", "7200"))
+
+# Как часто проверять буферы на вытеснение (секунды)
+SESSION_BUFFER_SWEEP_SECONDS = 60.0
+
+
+@dataclass
+class BufferedSession:
+    """
+    Состояние сессии прохождения теста в памяти процесса
+
+    answers и pending меняются только под lock: одну сессию могут
+    одновременно обрабатывать несколько потоков run_db.
+    """
+    session_id: int
+    test_id: int
+    user_id: int
+    # question_id -> выбранный вариант ответа
+    answers: Dict[int, int] = field(default_factory=dict)
+    # Вопросы, ответы на которые еще не записаны в БД
+    pending: Set[int] = field(default_factory=set)
+    # True, если все ответы сессии прошли через этот буфер
+    complete: bool = False
+    # Ограничение времени теста (секунды); None - без ограничения
+    time_limit_seconds: Optional[float] = None
+    # time.monotonic() создания буфера и последнего ответа
+    created_at: float = field(default_factory=time.monotonic)
+    touched_at: float = field(default_factory=time.monotonic)
+    # True, если буфер вытеснен из AnswerBuffer
+    evicted: bool = False
+    # True, если попытка принята в очередь завершения (submission_queue)
+    submitted: bool = False
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def add_answers(self, answers: Iterable[Tuple[int, int]], submitting: bool = False):
+        """
+        Принять ответы (под lock)
+
+        Args:
+            answers: Пары (question_id, option_id)
+            submitting: Ответы самой попытки завершения
+
+        Raises:
+            HTTPException: Если попытка уже в очереди завершения
+        """
+        with self.lock:
+            if self.submitted and not submitting:
+                raise session_submitted()
+            for question_id, option_id in answers:
+                self.answers[question_id] = option_id
+                self.pending.add(question_id)
+            self.touched_at = time.monotonic()
+
+    def pending_answers(self) -> Dict[int, int]:
+        """Копия незаписанных ответов: question_id -> вариант"""
+        with self.lock:
+            return {question_id: self.answers[question_id] for question_id in self.pending}
+
+    def all_answers(self) -> Dict[int, int]:
+        """Копия всех ответов буфера"""
+        with self.lock:
+            return dict(self.answers)
+
+    def mark_written(self, written: Dict[int, int]):
+        """
+        Снять отметку с записанных ответов
+
+        Ответ, измененный после снятия копии, остается незаписанным.
+        """
+        with self.lock:
+            for question_id, option_id in written.items():
+                if self.answers.get(question_id) == option_id:
+                    self.pending.discard(question_id)
+
+    def expires_at(self) -> float:
+        """Момент (time.monotonic()), после которого буфер можно вытеснить"""
+        if self.time_limit_seconds is not None:
+            return self.created_at + self.time_limit_seconds + SESSION_BUFFER_GRACE_SECONDS
+        return self.touched_at + SESSION_BUFFER_IDLE_SECONDS
+
+
+class AnswerBuffer:
+    """
+    Буферы ответов активных сессий
+    """
+
+    def __init__(self, sweep_seconds: float = SESSION_BUFFER_SWEEP_SECONDS):
+        self._lock = threading.Lock()
+        self._sessions: Dict[int, BufferedSession] = {}
+        # Сессии, попытки которых ждут в очереди завершения
+        self._submitted: Set[int] = set()
+        self.sweep_seconds = sweep_seconds
+        self._next_sweep = time.monotonic() + sweep_seconds
+        self.evicted = 0
+
+    def get(self, session_id: int) -> Optional[BufferedSession]:
+        """Буфер сессии или None"""
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def add(self, buffered: BufferedSession) -> BufferedSession:
+        """Зарегистрировать буфер сессии (существующий не перезаписывается)"""
+        with self._lock:
+            buffered = self._sessions.setdefault(buffered.session_id, buffered)
+            if buffered.session_id in self._submitted:
+                with buffered.lock:
+                    buffered.submitted = True
+            return buffered
+
+    def pop(self, session_id: int) -> Optional[BufferedSession]:
+        """Удалить буфер завершенной сессии"""
+        with self._lock:
+            self._submitted.discard(session_id)
+            return self._sessions.pop(session_id, None)
+
+    def mark_submitted(self, session_id: int):
+        """Запретить новые ответы: попытка принята в очередь завершения"""
+        with self._lock:
+            self._submitted.add(session_id)
+            buffered = self._sessions.get(session_id)
+            if buffered is not None:
+                with buffered.lock:
+                    buffered.submitted = True
+
+    def unmark_submitted(self, session_id: int):
+        """Снова принимать ответы: попытка из очереди не прошла"""
+        with self._lock:
+            self._submitted.discard(session_id)
+            buffered = self._sessions.get(session_id)
+            if buffered is not None:
+                with buffered.lock:
+                    buffered.submitted = False
+
+    def is_submitted(self, session_id: int) -> bool:
+        """Ждет ли попытка сессии в очереди завершения"""
+        with self._lock:
+            return session_id in self._submitted
+
+    def expired(self) -> List[BufferedSession]:
+        """
+        Буферы с истекшим сроком, если пора проверять (не чаще sweep_seconds)
+
+        Буферы остаются в AnswerBuffer до evict().
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_sweep:
+                return []
+            self._next_sweep = now + self.sweep_seconds
+            return [buffered for buffered in self._sessions.values() if buffered.expires_at() <= now]
+
+    def evict(self, buffered: BufferedSession) -> bool:
+        """
+        Вытеснить буфер, если в нем нет незаписанных ответов
+
+        Returns:
+            True, если буфер удален
+        """
+        with self._lock, buffered.lock:
+            if buffered.pending or self._sessions.get(buffered.session_id) is not buffered:
+                return False
+            del self._sessions[buffered.session_id]
+            buffered.evicted = True
+            self.evicted += 1
+            return True
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+# Общий буфер ответов приложения
+answer_buffer = AnswerBuffer()
+
+
+def session_forbidden() -> HTTPException:
+    """Ошибка доступа к чужой сессии"""
+    return HTTPException(
+        status_code=status.HTTP_403_FORBIDDEN,
+        detail="Сессия принадлежит другому пользователю"
+    )
+
+
+def session_submitted() -> HTTPException:
+    """Ошибка записи в сессию, попытка которой уже в очереди завершения"""
+    return HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="Попытка уже отправлена на проверку"
+    )
+
+
+def compiled_test(db: Session, test_id: int) -> payload_cache.CompiledTestPayload:
+    """Скомпилированный тест или 404"""
+    compiled = payload_cache.get_compiled_test(db, test_id)
+    if compiled is None:
+        raise HTTPException(status_code=404, detail="Test not found")
+    return compiled
+
+
+def _load_session(db: Session, session_id: int, user_id: int) -> BufferedSession:
+    """
+    Буфер сессии; если его нет в памяти процесса, он восстанавливается по БД
+
+    Raises:
+        HTTPException: Если сессии нет, она чужая, уже завершена
+            или ее попытка ждет в очереди завершения
+    """
+    if answer_buffer.is_submitted(session_id):
+        raise session_submitted()
+
+    buffered = answer_buffer.get(session_id)
+    if buffered is not None:
+        if buffered.user_id != user_id:
+            raise session_forbidden()
+        return buffered
+
+    session_row = db.query(models.TestSession).filter(models.TestSession.id == session_id).first()
+    if session_row is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    if session_row.user_id != user_id:
+        raise session_forbidden()
+    if session_row.status != models.SessionStatus.in_progress:
+        raise HTTPException(status_code=409, detail="Session is already finished")
+
+    return answer_buffer.add(BufferedSession(
+        session_id=session_row.id,
+        test_id=session_row.test_id,
+        user_id=session_row.user_id
+    ))
+
+
+def _validate_answers(
+    compiled: payload_cache.CompiledTestPayload,
+    answers: Iterable[Tuple[int, int]]
+) -> List[Tuple[int, int]]:
+    """
+    Проверить, что выбранные варианты относятся к вопросам теста
+
+    Raises:
+        HTTPException: Если вопрос не из теста или вариант от другого вопроса
+    """
+    validated = []
+    for question_id, option_id in answers:
+        if compiled.option_questions.get(option_id) != question_id:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Вариант {option_id} не относится к вопросу {question_id} этого теста"
+            )
+        validated.append((question_id, option_id))
+    return validated
+
+
+def answer_rows(
+    session_id: int,
+    answers: Dict[int, int],
+    answer_key: Dict[int, Set[int]]
+) -> List[dict]:
+    """
+    Строки user_answers для ответов сессии
+
+    Args:
+        session_id: ID сессии тестирования
+        answers: question_id -> выбранный вариант
+        answer_key: question_id -> правильные варианты
+
+    Returns:
+        Список словарей для многострочного INSERT
+    """
+    return [
+        {
+            "test_session_id": session_id,
+            "question_id": question_id,
+            "selected_option_id": option_id,
+            "is_correct": option_id in answer_key.get(question_id, ())
+        }
+        for question_id, option_id in answers.items()
+    ]
+
+
+def write_answer_rows(db: Session, rows: List[dict]):
+    """
+    Записать строки user_answers одним многострочным INSERT
+
+    Повторный ответ на вопрос заменяет ранее записанный
+    (ON DUPLICATE KEY UPDATE по unique_session_question).
+    Строки могут относиться к разным сессиям.
+
+    Args:
+        db: Сессия базы данных
+        rows: Строки из answer_rows()
+    """
+    if not rows:
+        return
+
+    if db.get_bind().dialect.name in ("mysql", "mariadb"):
+        stmt = mysql_insert(models.UserAnswer)
+        stmt = stmt.on_duplicate_key_update(
+            selected_option_id=stmt.inserted.selected_option_id,
+            is_correct=stmt.inserted.is_correct,
+            answered_at=func.current_timestamp()
+        )
+        db.execute(stmt, rows)
+    else:
+        questions_by_session: Dict[int, List[int]] = {}
+        for row in rows:
+            questions_by_session.setdefault(row["test_session_id"], []).append(row["question_id"])
+        for session_id, question_ids in questions_by_session.items():
+            db.query(models.UserAnswer).filter(
+                models.UserAnswer.test_session_id == session_id,
+                models.UserAnswer.question_id.in_(question_ids)
+            ).delete(synchronize_session=False)
+        db.execute(insert(models.UserAnswer), rows)
+
+
+def write_answers(
+    db: Session,
+    session_id: int,
+    answers: Dict[int, int],
+    answer_key: Dict[int, Set[int]]
+):
+    """
+    Записать ответы сессии одним многострочным INSERT
+
+    Args:
+        db: Сессия базы данных
+        session_id: ID сессии тестирования
+        answers: question_id -> выбранный вариант
+        answer_key: question_id -> правильные варианты
+    """
+    write_answer_rows(db, answer_rows(session_id, answers, answer_key))
+
+
+def start_session(db: Session, test_id: int, user_id: int) -> dict:
+    """
+    Начать прохождение теста
+
+    Args:
+        db: Сессия базы данных
+        test_id: ID теста
+        user_id: ID студента
+
+    Returns:
+        Данные созданной сессии
+
+    Raises:
+        HTTPException: Если тест не найден, неактивен или попытки исчерпаны
+    """
+    test = db.query(models.Test).filter(models.Test.id == test_id).first()
+    if test is None:
+        raise HTTPException(status_code=404, detail="Test not found")
+    if not test.is_active:
+        raise HTTPException(status_code=409, detail="Test is not active")
+
+    if test.max_attempts is not None:
+        attempts = db.query(func.count(models.TestSession.id)).filter(
+            models.TestSession.test_id == test_id,
+            models.TestSession.user_id == user_id
+        ).scalar()
+        if attempts >= test.max_attempts:
+            raise HTTPException(status_code=409, detail="No attempts left for this test")
+
+    compiled = compiled_test(db, test_id)
+
+    session_row = models.TestSession(
+        test_id=test_id,
+        user_id=user_id,
+        status=models.SessionStatus.in_progress,
+        total_questions=len(compiled.answer_key),
+        correct_answers=0
+    )
+    db.add(session_row)
+    db.flush()
+    user_stats.record_started(db, user_id, test_id)
+
+    result = {
+        "session_id": session_row.id,
+        "test_id": test_id,
+        "status": models.SessionStatus.in_progress.value,
+        "total_questions": session_row.total_questions,
+        "time_limit": test.time_limit_minutes
+    }
+    db.commit()
+
+    answer_buffer.add(BufferedSession(
+        session_id=result["session_id"],
+        test_id=test_id,
+        user_id=user_id,
+        complete=True,
+        time_limit_seconds=test.time_limit_minutes * 60 if test.time_limit_minutes else None
+    ))
+    sweep_expired_buffers(db)
+
+    return result
+
+
+def record_answers(
+    db: Session,
+    session_id: int,
+    user_id: int,
+    answers: List[Tuple[int, int]]
+) -> dict:
+    """
+    Принять ответы студента в буфер сессии
+
+    В БД ответы попадают только на контрольной точке, когда накопилось
+    SESSION_CHECKPOINT_SIZE незаписанных ответов.
+
+    Args:
+        db: Сессия базы данных
+        session_id: ID сессии тестирования
+        user_id: ID студента
+        answers: Пары (question_id, option_id)
+
+    Returns:
+        Состояние буфера сессии
+    """
+    buffered = _load_session(db, session_id, user_id)
+    compiled = compiled_test(db, buffered.test_id)
+
+    buffered.add_answers(_validate_answers(compiled, answers))
+
+    pending = buffered.pending_answers()
+    # Вытесненный буфер больше не найдут другие запросы - ответы пишутся сразу
+    checkpoint = len(pending) >= SESSION_CHECKPOINT_SIZE or (buffered.evicted and bool(pending))
+    if checkpoint:
+        write_answers(db, session_id, pending, compiled.answer_key)
+        db.commit()
+        buffered.mark_written(pending)
+
+    sweep_expired_buffers(db)
+
+    with buffered.lock:
+        return {
+            "session_id": session_id,
+            "answered": len(buffered.answers),
+            "pending": len(buffered.pending),
+            "checkpoint": checkpoint
+        }
+
+
+def sweep_expired_buffers(db: Session) -> int:
+    """
+    Вытеснить буферы брошенных сессий (не чаще SESSION_BUFFER_SWEEP_SECONDS)
+
+    Незаписанные ответы вытесняемых буферов записываются одним INSERT
+    в отдельной транзакции; буфер, получивший за это время новые ответы,
+    остается до следующей проверки.
+
+    Args:
+        db: Сессия базы данных (текущая транзакция должна быть завершена)
+
+    Returns:
+        Количество вытесненных буферов
+    """
+    expired = answer_buffer.expired()
+    if not expired:
+        return 0
+
+    written = []
+    rows = []
+    for buffered in expired:
+        pending = buffered.pending_answers()
+        if pending:
+            compiled = payload_cache.get_compiled_test(db, buffered.test_id)
+            if compiled is None:
+                continue
+            rows.extend(answer_rows(buffered.session_id, pending, compiled.answer_key))
+        written.append((buffered, pending))
+
+    if rows:
+        try:
+            write_answer_rows(db, rows)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Could not write answers of expired session buffers: {e}")
+            return 0
+
+    evicted = 0
+    for buffered, pending in written:
+        buffered.mark_written(pending)
+        evicted += answer_buffer.evict(buffered)
+    return evicted
+
+
+@dataclass
+class GradedSubmission:
+    """Проверенная попытка, готовая к записи в БД"""
+    buffered: BufferedSession
+    # Строки user_answers, которые еще не записаны
+    rows: List[dict]
+    # Значения для UPDATE test_sessions
+    values: dict
+    # Ответ клиенту
+    result: dict
+
+
+def session_result(session_id: int, values: dict, answered: Optional[int], show_results: bool) -> dict:
+    """
+    Результат завершенной сессии для клиента
+
+    Балл и признак прохождения скрываются, если в тесте отключен
+    показ результатов.
+    """
+    result = {
+        "session_id": session_id,
+        "status": models.SessionStatus.completed.value,
+        "total_questions": values["total_questions"],
+        "answered": answered,
+        "correct_answers": None,
+        "score": None,
+        "is_passed": None
+    }
+    if show_results:
+        result.update({
+            "correct_answers": values["correct_answers"],
+            "score": values["score"],
+            "is_passed": values["is_passed"]
+        })
+    return result
+
+
+def grade_submission(
+    db: Session,
+    session_row: models.TestSession,
+    user_id: int,
+    answers: List[Tuple[int, int]],
+    completed_at: Optional[datetime] = None,
+    compiled: Optional[payload_cache.CompiledTestPayload] = None
+) -> GradedSubmission:
+    """
+    Проверить попытку и подсчитать результат без записи в БД
+
+    Args:
+        db: Сессия базы данных
+        session_row: Строка сессии тестирования
+        user_id: ID студента
+        answers: Последние ответы, не отправленные ранее
+        completed_at: Время завершения (по умолчанию - текущее)
+        compiled: Скомпилированный тест, если уже загружен
+
+    Returns:
+        Проверенная попытка
+
+    Raises:
+        HTTPException: Если сессия чужая, уже завершена или ответы некорректны
+    """
+    session_id = session_row.id
+    if session_row.user_id != user_id:
+        raise session_forbidden()
+    if session_row.status != models.SessionStatus.in_progress:
+        raise HTTPException(status_code=409, detail="Session is already finished")
+
+    buffered = answer_buffer.get(session_id) or BufferedSession(
+        session_id=session_id,
+        test_id=session_row.test_id,
+        user_id=user_id
+    )
+    compiled = compiled or compiled_test(db, session_row.test_id)
+
+    buffered.add_answers(_validate_answers(compiled, answers), submitting=True)
+
+    # Ответы, записанные другим процессом, берем из БД
+    all_answers = {}
+    if not buffered.complete:
+        all_answers = {
+            question_id: option_id
+            for question_id, option_id in db.query(
+                models.UserAnswer.question_id,
+                models.UserAnswer.selected_option_id
+            ).filter(models.UserAnswer.test_session_id == session_id)
+        }
+    all_answers.update(buffered.all_answers())
+
+    pending = buffered.pending_answers()
+
+    total_questions = len(compiled.answer_key)
+    correct_questions = [
+        question_id for question_id, option_id in all_answers.items()
+        if option_id in compiled.answer_key.get(question_id, ())
+    ]
+    correct_answers = len(correct_questions)
+    # Балл взвешен по TestQuestion.points (так же считает regrade)
+    total_points = sum(compiled.question_points.values())
+    correct_points = sum(compiled.question_points[question_id] for question_id in correct_questions)
+    score = round(correct_points / total_points * 100, 2) if total_points else 0.0
+    completed_at = completed_at or datetime.now()
+    values = {
+        "status": models.SessionStatus.completed,
+        "total_questions": total_questions,
+        "correct_answers": correct_answers,
+        "score": score,
+        "is_passed": score >= compiled.passing_score,
+        "completed_at": completed_at,
+        "time_spent_seconds": int((completed_at - session_row.started_at).total_seconds()) if session_row.started_at else None
+    }
+
+    result = session_result(session_id, values, len(all_answers), compiled.show_results)
+    result["passing_score"] = compiled.passing_score
+
+    return GradedSubmission(
+        buffered=buffered,
+        rows=answer_rows(session_id, pending, compiled.answer_key),
+        values=values,
+        result=result
+    )
+
+
+def completed_stats(session_row: models.TestSession, graded: GradedSubmission) -> Tuple:
+    """Строка для user_stats.record_completed: (user_id, test_id, score, is_passed)"""
+    return session_row.user_id, session_row.test_id, graded.values["score"], graded.values["is_passed"]
+
+
+def submit_session(
+    db: Session,
+    session_id: int,
+    user_id: int,
+    answers: List[Tuple[int, int]]
+) -> dict:
+    """
+    Завершить прохождение теста и подсчитать результат
+
+    Все незаписанные ответы записываются одним INSERT, сессия
+    обновляется одним UPDATE (его дополнительно обрабатывает
+    триггер trg_test_sessions_complete).
+
+    Args:
+        db: Сессия базы данных
+        session_id: ID сессии тестирования
+        user_id: ID студента
+        answers: Последние ответы, не отправленные ранее
+
+    Returns:
+        Результат прохождения теста
+
+    Raises:
+        HTTPException: Если попытка сессии уже ждет в очереди завершения
+    """
+    if answer_buffer.is_submitted(session_id):
+        raise session_submitted()
+
+    session_row = db.query(models.TestSession).filter(models.TestSession.id == session_id).first()
+    if session_row is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    graded = grade_submission(db, session_row, user_id, answers)
+    write_answer_rows(db, graded.rows)
+
+    updated = db.query(models.TestSession).filter(
+        models.TestSession.id == session_id,
+        models.TestSession.status == models.SessionStatus.in_progress
+    ).update(graded.values, synchronize_session=False)
+
+    if not updated:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Session is already finished")
+
+    user_stats.record_completed(db, [completed_stats(session_row, graded)])
+    audit.note_session_completed(db, session_row, graded.values)
+    db.commit()
+    answer_buffer.pop(session_id)
+
+    return graded.result
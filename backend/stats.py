@@ -0,0 +1,210 @@
+"""
+Статистика системы для /api/stats/overview и /health.
+
+Счетчики собираются одним запросом с условной агрегацией
+(SUM(CASE ...)) на каждую таблицу и хранятся в памяти процесса
+в виде снимка. Снимок обновляется фоновым потоком, поэтому дашборды
+и health-проверки читают готовые данные без обращения к БД.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+
+from sqlalchemy import case, func
+from sqlalchemy.orm import Session
+
+import models
+
+# Время жизни снимка статистики (секунды)
+STATS_TTL_SECONDS = float(os.getenv("STATS_TTL_SECONDS", "30"))
+
+# Интервал фонового обновления снимка (секунды)
+STATS_REFRESH_SECONDS = float(os.getenv("STATS_REFRESH_SECONDS", "15"))
+
+
+def _count_if(condition):
+    """SUM(CASE WHEN condition THEN 1 ELSE 0 END)"""
+    return func.sum(case((condition, 1), else_=0))
+
+
+def _as_int(value: Any) -> int:
+    """Привести результат агрегата к int (SUM по пустой таблице дает NULL)"""
+    return int(value or 0)
+
+
+def collect_stats(db: Session) -> Dict[str, Any]:
+    """
+    Собрать статистику системы
+
+    Выполняет по одному агрегирующему запросу на таблицу.
+
+    Args:
+        db: Сессия базы данных
+
+    Returns:
+        Словарь в формате ответа /api/stats/overview
+    """
+    users_total, users_active = db.query(
+        func.count(models.User.id),
+        _count_if(models.User.is_active == True)
+    ).one()
+
+    questions_total, questions_approved = db.query(
+        func.count(models.Question.id),
+        _count_if(models.Question.is_approved == True)
+    ).one()
+
+    tests_total, tests_active = db.query(
+        func.count(models.Test.id),
+        _count_if(models.Test.is_active == True)
+    ).one()
+
+    sessions_total, sessions_completed, sessions_in_progress = db.query(
+        func.count(models.TestSession.id),
+        _count_if(models.TestSession.status == models.SessionStatus.completed),
+        _count_if(models.TestSession.status == models.SessionStatus.in_progress)
+    ).one()
+
+    documents_total, documents_processed = db.query(
+        func.count(models.SourceDocument.id),
+        _count_if(models.SourceDocument.status == models.DocumentStatus.completed)
+    ).one()
+
+    return {
+        "users": {
+            "total": _as_int(users_total),
+            "active": _as_int(users_active)
+        },
+        "questions": {
+            "total": _as_int(questions_total),
+            "approved": _as_int(questions_approved)
+        },
+        "tests": {
+            "total": _as_int(tests_total),
+            "active": _as_int(tests_active)
+        },
+        "sessions": {
+            "total": _as_int(sessions_total),
+            "completed": _as_int(sessions_completed),
+            "in_progress": _as_int(sessions_in_progress)
+        },
+        "documents": {
+            "total": _as_int(documents_total),
+            "processed": _as_int(documents_processed)
+        }
+    }
+
+
+class StatsCache:
+    """
+    Снимок статистики в памяти процесса с TTL и фоновым обновлением
+    """
+
+    def __init__(self, ttl_seconds: float = STATS_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._data: Optional[Dict[str, Any]] = None
+        self._taken_at: Optional[float] = None
+        self._taken_at_wall: Optional[datetime] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def age_seconds(self) -> Optional[float]:
+        """Возраст снимка в секундах (None, если снимка еще нет)"""
+        if self._taken_at is None:
+            return None
+        return time.monotonic() - self._taken_at
+
+    def is_fresh(self) -> bool:
+        """Актуален ли снимок"""
+        age = self.age_seconds()
+        return age is not None and age < self.ttl_seconds
+
+    def peek(self) -> Optional[Dict[str, Any]]:
+        """Текущий снимок без обращения к БД (может быть устаревшим или None)"""
+        return self._data
+
+    def refresh(self, db: Session) -> Dict[str, Any]:
+        """
+        Пересобрать снимок
+
+        Args:
+            db: Сессия базы данных
+
+        Returns:
+            Новый снимок статистики
+        """
+        data = collect_stats(db)
+        with self._lock:
+            self._data = data
+            self._taken_at = time.monotonic()
+            self._taken_at_wall = datetime.now()
+        return data
+
+    def get(self, db: Session) -> Dict[str, Any]:
+        """
+        Получить статистику: из снимка, если он актуален, иначе из БД
+
+        Args:
+            db: Сессия базы данных
+
+        Returns:
+            Снимок статистики
+        """
+        data = self._data
+        if data is not None and self.is_fresh():
+            return data
+        return self.refresh(db)
+
+    def info(self) -> Dict[str, Any]:
+        """Метаданные снимка для ответа API"""
+        age = self.age_seconds()
+        return {
+            "generated_at": self._taken_at_wall.strftime("%Y-%m-%d %H:%M:%S") if self._taken_at_wall else None,
+            "age_seconds": round(age, 3) if age is not None else None
+        }
+
+    def start_background_refresh(
+        self,
+        session_factory: Callable[[], Session],
+        interval_seconds: float = STATS_REFRESH_SECONDS
+    ):
+        """
+        Запустить фоновый поток, периодически обновляющий снимок
+
+        Args:
+            session_factory: Фабрика сессий (SessionLocal)
+            interval_seconds: Интервал обновления
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+
+        def worker():
+            while not self._stop.is_set():
+                db = session_factory()
+                try:
+                    self.refresh(db)
+                except Exception as e:
+                    print(f"Stats refresh failed: {e}")
+                finally:
+                    db.close()
+                self._stop.wait(interval_seconds)
+
+        self._thread = threading.Thread(target=worker, name="stats-refresh", daemon=True)
+        self._thread.start()
+
+    def stop_background_refresh(self):
+        """Остановить фоновое обновление"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+# Общий снимок статистики приложения
+stats_cache = StatsCache()
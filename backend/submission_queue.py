@@ -0,0 +1,474 @@
+"""
+Очередь завершения тестов для пиковой нагрузки в момент дедлайна.
+
+Когда время теста истекает, все клиенты отправляют результат в одну
+секунду. Вместо того чтобы выполнять каждое завершение отдельной
+транзакцией (UPDATE test_sessions с триггером trg_test_sessions_complete
+и аудитом), попытки принимаются сразу (202 + ID квитанции) и
+записываются фоновым потоком пачками: до SUBMISSION_BATCH_SIZE сессий
+за одну транзакцию, не чаще одной пачки в SUBMISSION_DRAIN_INTERVAL_SECONDS.
+
+Время завершения фиксируется в момент приема попытки, поэтому ожидание
+в очереди не увеличивает time_spent_seconds. После выдачи квитанции
+новые ответы и повторное завершение сессии отклоняются с 409.
+
+Очередь, квитанции и запрет записи хранятся в памяти процесса, принявшего
+попытку: backend не подключен к Redis из docker-compose.yml (его
+используют сервисы generation и testing, а клиента Redis нет
+в requirements.txt). При нескольких воркерах запросы одной сессии должны
+приходить в один процесс; статус чужой квитанции воркер восстанавливает
+по test_sessions (receipt_from_db).
+"""
+
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import bindparam, update
+from sqlalchemy.orm import Session
+
+import audit
+import models
+import session_engine
+import user_stats
+
+# Максимальное количество сессий, завершаемых одной транзакцией
+SUBMISSION_BATCH_SIZE = int(os.getenv("SUBMISSION_BATCH_SIZE", "50"))
+
+# Минимальный интервал между пачками (секунды)
+SUBMISSION_DRAIN_INTERVAL_SECONDS = float(os.getenv("SUBMISSION_DRAIN_INTERVAL_SECONDS", "0.2"))
+
+# Максимальная длина очереди; сверх нее попытки отклоняются с 503
+SUBMISSION_QUEUE_MAX = int(os.getenv("SUBMISSION_QUEUE_MAX", "10000"))
+
+# Сколько хранить квитанции обработанных попыток (секунды)
+SUBMISSION_RECEIPT_TTL_SECONDS = float(os.getenv("SUBMISSION_RECEIPT_TTL_SECONDS", "3600"))
+
+# Статусы квитанции
+RECEIPT_QUEUED = "queued"
+RECEIPT_COMPLETED = "completed"
+RECEIPT_FAILED = "failed"
+
+
+@dataclass
+class Submission:
+    """Принятая попытка завершения теста"""
+    receipt_id: str
+    session_id: int
+    user_id: int
+    answers: List[Tuple[int, int]]
+    submitted_at: datetime
+    status: str = RECEIPT_QUEUED
+    result: Optional[dict] = None
+    error: Optional[Dict[str, Any]] = None
+    finished_at: Optional[float] = None
+
+    def info(self) -> Dict[str, Any]:
+        """Состояние квитанции для клиента"""
+        return {
+            "receipt_id": self.receipt_id,
+            "session_id": self.session_id,
+            "status": self.status,
+            "submitted_at": self.submitted_at.isoformat(),
+            "result": self.result,
+            "error": self.error
+        }
+
+
+class SubmissionQueue:
+    """
+    Очередь попыток с пакетной записью в БД
+    """
+
+    def __init__(
+        self,
+        batch_size: int = SUBMISSION_BATCH_SIZE,
+        interval_seconds: float = SUBMISSION_DRAIN_INTERVAL_SECONDS,
+        max_queued: int = SUBMISSION_QUEUE_MAX
+    ):
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self.max_queued = max_queued
+        self._lock = threading.Lock()
+        self._queue: Deque[Submission] = deque()
+        self._receipts: "OrderedDict[str, Submission]" = OrderedDict()
+        # session_id -> квитанция попытки, ожидающей в очереди
+        self._queued_sessions: Dict[int, Submission] = {}
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.batches = 0
+        self.completed = 0
+        self.failed = 0
+
+    def submit(self, session_id: int, user_id: int, answers: List[Tuple[int, int]]) -> Submission:
+        """
+        Поставить попытку в очередь
+
+        Повторная отправка той же сессии, пока она ждет в очереди,
+        возвращает существующую квитанцию, если не добавляет новых ответов.
+        Сессия отмечается отправленной (session_engine.answer_buffer):
+        до обработки попытки новые ответы к ней не принимаются.
+
+        Args:
+            session_id: ID сессии тестирования
+            user_id: ID студента
+            answers: Последние ответы, не отправленные ранее
+
+        Returns:
+            Квитанция попытки
+
+        Raises:
+            HTTPException: Если очередь переполнена, сессия чужая
+                или повторная отправка меняет ответы принятой попытки
+        """
+        with self._lock:
+            queued = self._queued_sessions.get(session_id)
+            if queued is not None:
+                if queued.user_id != user_id:
+                    raise session_engine.session_forbidden()
+                if not set(answers) <= set(queued.answers):
+                    raise session_engine.session_submitted()
+                return queued
+
+            if len(self._queue) >= self.max_queued:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Submission queue is full, retry later",
+                    headers={"Retry-After": "1"}
+                )
+
+            submission = Submission(
+                receipt_id=f"{session_id}.{uuid.uuid4().hex}",
+                session_id=session_id,
+                user_id=user_id,
+                answers=list(answers),
+                submitted_at=datetime.now()
+            )
+            session_engine.answer_buffer.mark_submitted(session_id)
+            self._queue.append(submission)
+            self._queued_sessions[session_id] = submission
+            self._receipts[submission.receipt_id] = submission
+
+        self._wakeup.set()
+        return submission
+
+    def get(self, receipt_id: str) -> Optional[Submission]:
+        """Квитанция по ID или None"""
+        with self._lock:
+            return self._receipts.get(receipt_id)
+
+    def position(self, submission: Submission) -> int:
+        """Количество попыток в очереди перед этой (0 - следующая в пачке)"""
+        with self._lock:
+            for index, queued in enumerate(self._queue):
+                if queued is submission:
+                    return index
+        return 0
+
+    def _take_batch(self) -> List[Submission]:
+        """Извлечь следующую пачку попыток"""
+        with self._lock:
+            batch = []
+            while self._queue and len(batch) < self.batch_size:
+                submission = self._queue.popleft()
+                self._queued_sessions.pop(submission.session_id, None)
+                batch.append(submission)
+            return batch
+
+    def _finish(self, submission: Submission, result: Optional[dict] = None, error: Optional[HTTPException] = None):
+        """Отметить попытку обработанной"""
+        if error is None:
+            submission.status = RECEIPT_COMPLETED
+            submission.result = result
+            self.completed += 1
+        else:
+            submission.status = RECEIPT_FAILED
+            submission.error = {"status_code": error.status_code, "detail": error.detail}
+            self.failed += 1
+            # Непринятую попытку можно продолжить и отправить снова
+            session_engine.answer_buffer.unmark_submitted(submission.session_id)
+        submission.finished_at = time.monotonic()
+
+    def _expire_receipts(self):
+        """Удалить устаревшие квитанции обработанных попыток"""
+        deadline = time.monotonic() - SUBMISSION_RECEIPT_TTL_SECONDS
+        with self._lock:
+            while self._receipts:
+                oldest = next(iter(self._receipts.values()))
+                if oldest.finished_at is None or oldest.finished_at > deadline:
+                    break
+                self._receipts.popitem(last=False)
+
+    def process_batch(self, db: Session, batch: List[Submission]):
+        """
+        Завершить пачку сессий одной транзакцией
+
+        Строки сессий блокируются SELECT ... FOR UPDATE, ответы всех
+        сессий пачки записываются одним INSERT, сессии обновляются
+        одним UPDATE с executemany. Если транзакция не прошла, попытки
+        пачки завершаются по одной.
+
+        Args:
+            db: Сессия базы данных
+            batch: Попытки пачки
+        """
+        session_ids = list({submission.session_id for submission in batch})
+        rows = {
+            row.id: row for row in db.query(models.TestSession)
+            .filter(models.TestSession.id.in_(session_ids))
+            .with_for_update()
+        }
+
+        graded: List[Tuple[Submission, session_engine.GradedSubmission]] = []
+        answer_rows: List[dict] = []
+        finished_in_batch = set()
+        # Тест загружается один раз на пачку
+        compiled_tests: Dict[int, Any] = {}
+
+        for submission in batch:
+            try:
+                session_row = rows.get(submission.session_id)
+                if session_row is None:
+                    raise HTTPException(status_code=404, detail="Session not found")
+                if submission.session_id in finished_in_batch:
+                    raise HTTPException(status_code=409, detail="Session is already finished")
+
+                compiled = compiled_tests.get(session_row.test_id)
+                if compiled is None:
+                    compiled = session_engine.compiled_test(db, session_row.test_id)
+                    compiled_tests[session_row.test_id] = compiled
+
+                result = session_engine.grade_submission(
+                    db, session_row, submission.user_id, submission.answers,
+                    completed_at=submission.submitted_at,
+                    compiled=compiled
+                )
+            except HTTPException as e:
+                self._finish(submission, error=e)
+                continue
+
+            finished_in_batch.add(submission.session_id)
+            graded.append((submission, result))
+            answer_rows.extend(result.rows)
+
+        if not graded:
+            db.rollback()
+            return
+
+        try:
+            session_engine.write_answer_rows(db, answer_rows)
+            table = models.TestSession.__table__
+            columns = list(graded[0][1].values)
+            db.execute(
+                update(table)
+                .where(table.c.id == bindparam("b_id"))
+                .values({column: bindparam(f"b_{column}") for column in columns}),
+                [
+                    {
+                        "b_id": submission.session_id,
+                        **{f"b_{column}": result.values[column] for column in columns}
+                    }
+                    for submission, result in graded
+                ]
+            )
+            user_stats.record_completed(db, [
+                session_engine.completed_stats(rows[submission.session_id], result)
+                for submission, result in graded
+            ])
+            for submission, result in graded:
+                audit.note_session_completed(db, rows[submission.session_id], result.values)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Submission batch failed, retrying one by one: {e}")
+            for submission, _ in graded:
+                self._process_one(db, submission)
+            return
+
+        for submission, result in graded:
+            session_engine.answer_buffer.pop(submission.session_id)
+            self._finish(submission, result=result.result)
+
+    def _process_one(self, db: Session, submission: Submission):
+        """Завершить одну сессию отдельной транзакцией"""
+        try:
+            session_row = db.query(models.TestSession).filter(
+                models.TestSession.id == submission.session_id
+            ).with_for_update().first()
+            if session_row is None:
+                raise HTTPException(status_code=404, detail="Session not found")
+
+            graded = session_engine.grade_submission(
+                db, session_row, submission.user_id, submission.answers,
+                completed_at=submission.submitted_at
+            )
+            session_engine.write_answer_rows(db, graded.rows)
+            db.query(models.TestSession).filter(
+                models.TestSession.id == submission.session_id
+            ).update(graded.values, synchronize_session=False)
+            user_stats.record_completed(db, [session_engine.completed_stats(session_row, graded)])
+            audit.note_session_completed(db, session_row, graded.values)
+            db.commit()
+        except HTTPException as e:
+            db.rollback()
+            self._finish(submission, error=e)
+            return
+        except Exception as e:
+            db.rollback()
+            print(f"Submission {submission.receipt_id} failed: {e}")
+            self._finish(submission, error=HTTPException(status_code=500, detail="Submission failed"))
+            return
+
+        session_engine.answer_buffer.pop(submission.session_id)
+        self._finish(submission, result=graded.result)
+
+    def drain(self, session_factory: Callable[[], Session]) -> int:
+        """
+        Обработать одну пачку из очереди
+
+        Args:
+            session_factory: Фабрика сессий (SessionLocal)
+
+        Returns:
+            Количество обработанных попыток
+        """
+        batch = self._take_batch()
+        if not batch:
+            return 0
+
+        db = session_factory()
+        try:
+            self.process_batch(db, batch)
+        except Exception as e:
+            print(f"Submission batch failed: {e}")
+            for submission in batch:
+                if submission.status == RECEIPT_QUEUED:
+                    self._finish(submission, error=HTTPException(status_code=500, detail="Submission failed"))
+        finally:
+            db.close()
+
+        self.batches += 1
+        self._expire_receipts()
+        return len(batch)
+
+    def start_worker(self, session_factory: Callable[[], Session]):
+        """
+        Запустить фоновый поток, записывающий очередь пачками
+
+        Args:
+            session_factory: Фабрика сессий (SessionLocal)
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+
+        def worker():
+            while not self._stop.is_set():
+                self._wakeup.wait(timeout=1)
+                self._wakeup.clear()
+                while self.drain(session_factory):
+                    # Ограничение скорости: не больше одной пачки за интервал
+                    if self._stop.wait(self.interval_seconds):
+                        break
+
+            # Принятые попытки дописываются при остановке
+            while self.drain(session_factory):
+                pass
+
+        self._thread = threading.Thread(target=worker, name="submission-queue", daemon=True)
+        self._thread.start()
+
+    def stop_worker(self):
+        """Остановить фоновый поток, дописав оставшиеся попытки"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+            self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Состояние очереди"""
+        with self._lock:
+            queued = len(self._queue)
+            receipts = len(self._receipts)
+        return {
+            "queued": queued,
+            "receipts": receipts,
+            "batches": self.batches,
+            "completed": self.completed,
+            "failed": self.failed,
+            "batch_size": self.batch_size,
+            "interval_seconds": self.interval_seconds
+        }
+
+
+# Общая очередь попыток приложения
+submission_queue = SubmissionQueue()
+
+
+def receipt_session_id(receipt_id: str) -> Optional[int]:
+    """ID сессии из ID квитанции ("<session_id>.<uuid>") или None"""
+    session_id, _, _ = receipt_id.partition(".")
+    return int(session_id) if session_id.isdigit() else None
+
+
+def receipt_from_db(db: Session, receipt_id: str, user_id: int) -> Optional[dict]:
+    """
+    Состояние попытки по строке сессии
+
+    Используется, если квитанции нет в памяти процесса (другой воркер
+    или перезапуск): завершенная сессия возвращается как выполненная.
+
+    Args:
+        db: Сессия базы данных
+        receipt_id: ID квитанции
+        user_id: ID студента
+
+    Returns:
+        Состояние попытки или None, если сессия не завершена
+    """
+    session_id = receipt_session_id(receipt_id)
+    if session_id is None:
+        return None
+
+    row = db.query(
+        models.TestSession.id,
+        models.TestSession.user_id,
+        models.TestSession.status,
+        models.TestSession.total_questions,
+        models.TestSession.correct_answers,
+        models.TestSession.score,
+        models.TestSession.is_passed,
+        models.TestSession.completed_at,
+        models.Test.show_results
+    ).join(models.Test, models.Test.id == models.TestSession.test_id).filter(
+        models.TestSession.id == session_id
+    ).first()
+
+    if row is None or row.status != models.SessionStatus.completed:
+        return None
+    if row.user_id != user_id:
+        raise session_engine.session_forbidden()
+
+    values = {
+        "total_questions": row.total_questions,
+        "correct_answers": row.correct_answers,
+        "score": float(row.score) if row.score is not None else None,
+        "is_passed": row.is_passed
+    }
+    return {
+        "receipt_id": receipt_id,
+        "session_id": session_id,
+        "status": RECEIPT_COMPLETED,
+        "submitted_at": row.completed_at.isoformat() if row.completed_at else None,
+        "result": session_engine.session_result(session_id, values, None, bool(row.show_results)),
+        "error": None
+    }
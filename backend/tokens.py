@@ -0,0 +1,313 @@
+"""
+Подписанные токены доступа для TestGen.
+
+Токен самодостаточен: содержит ID, email, имя и роли пользователя
+и срок действия, подписанные HMAC-SHA256 (формат JWT HS256).
+Проверка токена - локальная проверка подписи без запроса к БД.
+
+Отозванные токены (выход) хранятся в таблице revoked_tokens, поэтому
+выход учитывается всеми процессами приложения. Каждый процесс держит
+в памяти копию отозванных токенов и список деактивированных
+пользователей и перечитывает их из БД раз в
+AUTH_REVOCATION_REFRESH_SECONDS; новые отзывы догружаются по id.
+
+Подпись с ключом по умолчанию позволяет подделать любой токен, поэтому
+без SECRET_KEY приложение запускается только с APP_ENV=development.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set
+
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+import models
+
+# Ключ из примера конфигурации; с ним токены может подписать кто угодно
+DEFAULT_SECRET_KEY = "your-secret-key-here-change-in-production"
+
+# Секретный ключ подписи токенов
+SECRET_KEY = os.getenv("SECRET_KEY", DEFAULT_SECRET_KEY)
+
+# Режим работы приложения (development, production)
+APP_ENV = os.getenv("APP_ENV", "production")
+
+# Время жизни токена в минутах
+JWT_EXPIRATION_MINUTES = int(os.getenv("JWT_EXPIRATION_MINUTES", "60"))
+
+# Интервал перечитывания неактивных пользователей и отозванных токенов (секунды)
+AUTH_REVOCATION_REFRESH_SECONDS = float(os.getenv("AUTH_REVOCATION_REFRESH_SECONDS", "10"))
+
+_HEADER = {"alg": "HS256", "typ": "JWT"}
+
+
+class InvalidTokenError(Exception):
+    """Токен поврежден, подделан или просрочен"""
+
+
+def check_secret_key():
+    """
+    Проверить ключ подписи токенов при старте приложения
+
+    Raises:
+        RuntimeError: Если ключ не задан или совпадает с примером,
+            а приложение запущено не в режиме development
+    """
+    if SECRET_KEY and SECRET_KEY != DEFAULT_SECRET_KEY:
+        return
+    if APP_ENV != "development":
+        raise RuntimeError(
+            "SECRET_KEY не задан или совпадает с ключом из .env.example: "
+            "токены доступа можно подделать. Задайте SECRET_KEY "
+            "(или APP_ENV=development для локального запуска)."
+        )
+    print("WARNING: SECRET_KEY is not set, tokens are signed with the public default key (APP_ENV=development)")
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(signing_input: bytes) -> bytes:
+    return hmac.new(SECRET_KEY.encode("utf-8"), signing_input, hashlib.sha256).digest()
+
+
+def create_access_token(user: models.User, roles: List[str]) -> str:
+    """
+    Выпустить подписанный токен доступа
+
+    Args:
+        user: Пользователь
+        roles: Роли пользователя
+
+    Returns:
+        Токен в формате header.payload.signature
+    """
+    now = int(time.time())
+    claims = {
+        "sub": str(user.id),
+        "email": user.email,
+        "name": user.full_name,
+        "roles": roles,
+        "iat": now,
+        "exp": now + JWT_EXPIRATION_MINUTES * 60,
+        "jti": uuid.uuid4().hex
+    }
+
+    header = _b64encode(json.dumps(_HEADER, separators=(",", ":")).encode("utf-8"))
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+    signing_input = f"{header}.{payload}".encode("ascii")
+
+    return f"{header}.{payload}.{_b64encode(_sign(signing_input))}"
+
+
+def decode_access_token(token: str) -> Dict[str, Any]:
+    """
+    Проверить подпись и срок действия токена
+
+    Args:
+        token: Токен доступа
+
+    Returns:
+        Словарь claims
+
+    Raises:
+        InvalidTokenError: Если токен невалиден или просрочен
+    """
+    try:
+        header, payload, signature = token.split(".")
+        expected = _sign(f"{header}.{payload}".encode("ascii"))
+        if not hmac.compare_digest(expected, _b64decode(signature)):
+            raise InvalidTokenError("bad signature")
+
+        if json.loads(_b64decode(header)).get("alg") != _HEADER["alg"]:
+            raise InvalidTokenError("unsupported algorithm")
+
+        claims = json.loads(_b64decode(payload))
+        int(claims["sub"])
+    except InvalidTokenError:
+        raise
+    except (ValueError, KeyError, TypeError, UnicodeError):
+        raise InvalidTokenError("malformed token")
+
+    if claims.get("exp", 0) < time.time():
+        raise InvalidTokenError("token expired")
+
+    return claims
+
+
+def user_from_claims(claims: Dict[str, Any]) -> models.User:
+    """
+    Собрать объект пользователя из claims токена
+
+    Объект не привязан к сессии и не загружается из БД.
+
+    Args:
+        claims: Claims проверенного токена
+
+    Returns:
+        User с заполненными id, email, full_name и is_active
+    """
+    return models.User(
+        id=int(claims["sub"]),
+        email=claims.get("email"),
+        full_name=claims.get("name"),
+        is_active=True
+    )
+
+
+class RevocationCache:
+    """
+    Копия отозванных токенов и деактивированных пользователей в памяти процесса
+    """
+
+    def __init__(self, refresh_seconds: float = AUTH_REVOCATION_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        # Одно обновление за раз; остальные запросы читают текущую копию
+        self._refresh_lock = threading.Lock()
+        self._inactive_users: Set[int] = set()
+        self._revoked_tokens: Dict[str, float] = {}
+        self._last_revocation_id = 0
+        self._loaded_at: Optional[float] = None
+
+    def refresh(self, db: Session):
+        """
+        Перечитать неактивных пользователей и догрузить новые отзывы токенов
+
+        Args:
+            db: Сессия базы данных
+        """
+        inactive = {
+            user_id for (user_id,) in db.query(models.User.id).filter(models.User.is_active == False)
+        }
+        revoked = db.query(
+            models.RevokedToken.id,
+            models.RevokedToken.jti,
+            models.RevokedToken.expires_at
+        ).filter(
+            models.RevokedToken.id > self._last_revocation_id,
+            models.RevokedToken.expires_at > datetime.now()
+        ).order_by(models.RevokedToken.id).all()
+
+        now = time.time()
+        with self._lock:
+            self._inactive_users = inactive
+            self._loaded_at = time.monotonic()
+            for revocation_id, jti, expires_at in revoked:
+                self._revoked_tokens[jti] = expires_at.timestamp()
+                self._last_revocation_id = max(self._last_revocation_id, revocation_id)
+            self._revoked_tokens = {
+                jti: exp for jti, exp in self._revoked_tokens.items() if exp > now
+            }
+
+    def _refresh_if_stale(self):
+        """Обновить копию, если она устарела"""
+        loaded_at = self._loaded_at
+        if loaded_at is not None and time.monotonic() - loaded_at < self.refresh_seconds:
+            return
+
+        # Первую загрузку ждут все запросы, дальше обновляет один поток
+        if not self._refresh_lock.acquire(blocking=loaded_at is None):
+            return
+        try:
+            loaded_at = self._loaded_at
+            if loaded_at is not None and time.monotonic() - loaded_at < self.refresh_seconds:
+                return
+
+            db = SessionLocal()
+            try:
+                self.refresh(db)
+            except Exception as e:
+                print(f"Revocation cache refresh failed: {e}")
+                # Повторим попытку не раньше следующего интервала
+                self._loaded_at = time.monotonic()
+            finally:
+                db.close()
+        finally:
+            self._refresh_lock.release()
+
+    def revoke_token(self, db: Session, claims: Dict[str, Any]):
+        """
+        Отозвать токен до истечения его срока действия (без commit)
+
+        Запись в revoked_tokens видят остальные процессы; заодно
+        удаляются записи токенов, срок действия которых уже истек.
+
+        Args:
+            db: Сессия базы данных
+            claims: Claims проверенного токена
+        """
+        exp = claims.get("exp", time.time())
+        db.query(models.RevokedToken).filter(
+            models.RevokedToken.expires_at <= datetime.now()
+        ).delete(synchronize_session=False)
+        if not db.query(models.RevokedToken.id).filter(models.RevokedToken.jti == claims["jti"]).first():
+            db.execute(insert(models.RevokedToken), [{
+                "jti": claims["jti"],
+                "user_id": int(claims["sub"]),
+                "expires_at": datetime.fromtimestamp(exp)
+            }])
+
+        with self._lock:
+            self._revoked_tokens[claims["jti"]] = exp
+
+    def set_user_active(self, user_id: int, is_active: bool):
+        """Отметить изменение активности пользователя"""
+        with self._lock:
+            if is_active:
+                self._inactive_users.discard(user_id)
+            else:
+                self._inactive_users.add(user_id)
+
+    def is_revoked(self, claims: Dict[str, Any]) -> bool:
+        """Отозван ли токен"""
+        self._refresh_if_stale()
+        return claims.get("jti") in self._revoked_tokens
+
+    def is_user_inactive(self, user_id: int) -> bool:
+        """Деактивирован ли пользователь"""
+        self._refresh_if_stale()
+        return user_id in self._inactive_users
+
+
+# Общий кэш отзыва токенов приложения
+revocation_cache = RevocationCache()
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_activity_changes(session: Session, flush_context):
+    """Запомнить изменения is_active пользователей в этой транзакции"""
+    changes: Dict[int, bool] = session.info.setdefault("auth_active_changes", {})
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, models.User) and obj.id is not None:
+            changes[obj.id] = bool(obj.is_active)
+    for obj in session.deleted:
+        if isinstance(obj, models.User) and obj.id is not None:
+            changes[obj.id] = False
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _apply_activity_changes(session: Session):
+    """Применить изменения активности после фиксации транзакции"""
+    for user_id, is_active in session.info.pop("auth_active_changes", {}).items():
+        revocation_cache.set_user_active(user_id, is_active)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_activity_changes(session: Session):
+    """Забыть изменения отмененной транзакции"""
+    session.info.pop("auth_active_changes", None)
@@ -0,0 +1,492 @@
+"""
+Сводная статистика пользователей (замена sp_get_user_statistics).
+
+Процедура sp_get_user_statistics при каждом вызове сканирует все сессии
+пользователя (COUNT DISTINCT и AVG по test_sessions). Вместо этого
+счетчики хранятся в двух таблицах:
+
+- user_test_stats - по паре (пользователь, тест);
+- user_stats - по пользователю (сумма строк user_test_stats).
+
+Счетчики: всего сессий, завершенных сессий, сумма баллов завершенных
+сессий, пройденных и непройденных попыток. Они увеличиваются в той же
+транзакции, что и изменение сессии: при старте (session_engine) и при
+завершении (session_engine, submission_queue). Пересчет результатов
+(regrade) пересобирает счетчики затронутых тестов из test_sessions.
+Чтение статистики - поиск по первичному ключу.
+
+Удаление тестов и сессий через ORM пересобирает счетчики их
+пользователей в той же транзакции (каскадное удаление сессий иначе
+оставило бы суммы user_stats прежними), удаление вопросов - счетчики
+тестов, в которые они входили. Расхождения из-за изменений в обход
+приложения исправляет полная пересборка: POST /api/stats/rebuild
+(роль admin) или фоновая пересборка раз в USER_STATS_REBUILD_SECONDS.
+
+Пересборка всех счетчиков по существующим данным:
+    python user_stats.py
+    python user_stats.py --test-id 12
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import case, delete, event, func, insert, select, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+import models
+
+# Счетчики в порядке колонок таблиц
+COUNTERS = ("total_sessions", "completed_sessions", "score_sum", "passed_tests", "failed_tests")
+
+# Интервал фоновой полной пересборки счетчиков (секунды, 0 - отключена)
+USER_STATS_REBUILD_SECONDS = float(os.getenv("USER_STATS_REBUILD_SECONDS", "0"))
+
+
+@dataclass
+class StatsDelta:
+    """Приращение счетчиков одной пары (пользователь, тест)"""
+    total_sessions: int = 0
+    completed_sessions: int = 0
+    score_sum: float = 0.0
+    passed_tests: int = 0
+    failed_tests: int = 0
+
+    def add(self, other: "StatsDelta"):
+        for name in COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def values(self) -> Dict[str, Any]:
+        values = {name: getattr(self, name) for name in COUNTERS}
+        values["score_sum"] = round(self.score_sum, 2)
+        return values
+
+
+def started_delta() -> StatsDelta:
+    """Приращение для новой сессии"""
+    return StatsDelta(total_sessions=1)
+
+
+def completed_delta(score: Optional[float], is_passed: Optional[bool]) -> StatsDelta:
+    """Приращение для завершенной сессии"""
+    return StatsDelta(
+        completed_sessions=1,
+        score_sum=float(score or 0),
+        passed_tests=int(is_passed is True),
+        failed_tests=int(is_passed is False)
+    )
+
+
+# =====================================================
+# ИНКРЕМЕНТАЛЬНОЕ ОБНОВЛЕНИЕ
+# =====================================================
+
+def _upsert(db: Session, model, rows: List[Dict[str, Any]], keys: Tuple[str, ...]):
+    """
+    Прибавить приращения к счетчикам (строка создается, если ее нет)
+
+    Args:
+        db: Сессия базы данных
+        model: UserStats или UserTestStats
+        rows: Строки с ключом и приращениями счетчиков
+        keys: Колонки первичного ключа
+    """
+    if not rows:
+        return
+
+    if db.get_bind().dialect.name in ("mysql", "mariadb"):
+        stmt = mysql_insert(model)
+        stmt = stmt.on_duplicate_key_update({
+            name: getattr(model, name) + stmt.inserted[name]
+            for name in COUNTERS
+        })
+        db.execute(stmt, rows)
+        return
+
+    for row in rows:
+        updated = db.execute(
+            update(model)
+            .where(*[getattr(model, key) == row[key] for key in keys])
+            .values({name: getattr(model, name) + row[name] for name in COUNTERS})
+        ).rowcount
+        if not updated:
+            db.execute(insert(model), [row])
+
+
+def apply(db: Session, deltas: Iterable[Tuple[int, int, StatsDelta]]):
+    """
+    Применить приращения счетчиков в текущей транзакции
+
+    Приращения одной пары (пользователь, тест) суммируются,
+    затем user_test_stats и user_stats обновляются по одному
+    многострочному INSERT ... ON DUPLICATE KEY UPDATE.
+
+    Args:
+        db: Сессия базы данных
+        deltas: Тройки (user_id, test_id, приращение)
+    """
+    by_test: Dict[Tuple[int, int], StatsDelta] = {}
+    by_user: Dict[int, StatsDelta] = {}
+    for user_id, test_id, delta in deltas:
+        by_test.setdefault((user_id, test_id), StatsDelta()).add(delta)
+        by_user.setdefault(user_id, StatsDelta()).add(delta)
+
+    _upsert(
+        db, models.UserTestStats,
+        [
+            {"user_id": user_id, "test_id": test_id, **delta.values()}
+            for (user_id, test_id), delta in sorted(by_test.items())
+        ],
+        ("user_id", "test_id")
+    )
+    _upsert(
+        db, models.UserStats,
+        [{"user_id": user_id, **delta.values()} for user_id, delta in sorted(by_user.items())],
+        ("user_id",)
+    )
+
+
+def record_started(db: Session, user_id: int, test_id: int):
+    """Учесть новую сессию (в транзакции, создающей сессию)"""
+    apply(db, [(user_id, test_id, started_delta())])
+
+
+def record_completed(db: Session, completed: Iterable[Tuple[int, int, Optional[float], Optional[bool]]]):
+    """
+    Учесть завершенные сессии (в транзакции, завершающей сессии)
+
+    Args:
+        db: Сессия базы данных
+        completed: Четверки (user_id, test_id, score, is_passed)
+    """
+    apply(db, [
+        (user_id, test_id, completed_delta(score, is_passed))
+        for user_id, test_id, score, is_passed in completed
+    ])
+
+
+# =====================================================
+# ПЕРЕСБОРКА ПО test_sessions
+# =====================================================
+
+def _session_counters() -> List[Any]:
+    """Агрегаты test_sessions в порядке COUNTERS"""
+    session = models.TestSession
+    completed = session.status == models.SessionStatus.completed
+    return [
+        func.count(session.id),
+        func.coalesce(func.sum(case((completed, 1), else_=0)), 0),
+        func.coalesce(func.sum(case((completed, func.coalesce(session.score, 0)), else_=0)), 0),
+        func.coalesce(func.sum(case((session.is_passed == True, 1), else_=0)), 0),
+        func.coalesce(func.sum(case((session.is_passed == False, 1), else_=0)), 0),
+    ]
+
+
+def rebuild(
+    db: Session,
+    test_ids: Optional[List[int]] = None,
+    user_ids: Optional[List[int]] = None
+) -> Dict[str, int]:
+    """
+    Пересобрать счетчики по test_sessions (без commit)
+
+    Строки user_test_stats тестов (или пользователей) пересобираются
+    одним INSERT ... SELECT ... GROUP BY; строки user_stats затронутых
+    пользователей - суммированием их строк user_test_stats.
+
+    Args:
+        db: Сессия базы данных
+        test_ids: Тесты для пересборки (None - все данные)
+        user_ids: Пользователи для пересборки (вместо test_ids)
+
+    Returns:
+        Количество пересобранных строк обеих таблиц
+    """
+    per_test = models.UserTestStats
+    per_user = models.UserStats
+    session = models.TestSession
+
+    if user_ids is not None:
+        return _rebuild_users(db, user_ids)
+
+    sessions_query = select(session.user_id, session.test_id, *_session_counters())
+    if test_ids is not None:
+        if not test_ids:
+            return {"user_test_stats": 0, "user_stats": 0}
+        sessions_query = sessions_query.where(session.test_id.in_(test_ids))
+    sessions_query = sessions_query.group_by(session.user_id, session.test_id)
+
+    if test_ids is None:
+        db.execute(delete(per_user))
+        db.execute(delete(per_test))
+        users_filter = None
+    else:
+        # Пользователи до и после пересборки (строки тестов могли исчезнуть)
+        user_ids = {
+            user_id for (user_id,) in db.execute(
+                select(per_test.user_id).where(per_test.test_id.in_(test_ids))
+                .union(select(session.user_id).where(session.test_id.in_(test_ids)))
+            )
+        }
+        db.execute(delete(per_test).where(per_test.test_id.in_(test_ids)))
+        if user_ids:
+            db.execute(delete(per_user).where(per_user.user_id.in_(user_ids)))
+        users_filter = user_ids
+
+    per_test_rows = db.execute(
+        insert(per_test).from_select(["user_id", "test_id", *COUNTERS], sessions_query)
+    ).rowcount
+
+    users_query = select(per_test.user_id, *[func.sum(getattr(per_test, name)) for name in COUNTERS])
+    if users_filter is not None:
+        if not users_filter:
+            return {"user_test_stats": per_test_rows, "user_stats": 0}
+        users_query = users_query.where(per_test.user_id.in_(users_filter))
+    users_query = users_query.group_by(per_test.user_id)
+
+    per_user_rows = db.execute(
+        insert(per_user).from_select(["user_id", *COUNTERS], users_query)
+    ).rowcount
+
+    return {"user_test_stats": per_test_rows, "user_stats": per_user_rows}
+
+
+def _rebuild_users(db: Session, user_ids: Iterable[int]) -> Dict[str, int]:
+    """Пересобрать все строки user_test_stats и user_stats пользователей"""
+    per_test = models.UserTestStats
+    per_user = models.UserStats
+    session = models.TestSession
+
+    user_ids = sorted(set(user_ids))
+    if not user_ids:
+        return {"user_test_stats": 0, "user_stats": 0}
+
+    db.execute(delete(per_test).where(per_test.user_id.in_(user_ids)))
+    db.execute(delete(per_user).where(per_user.user_id.in_(user_ids)))
+
+    per_test_rows = db.execute(
+        insert(per_test).from_select(
+            ["user_id", "test_id", *COUNTERS],
+            select(session.user_id, session.test_id, *_session_counters())
+            .where(session.user_id.in_(user_ids))
+            .group_by(session.user_id, session.test_id)
+        )
+    ).rowcount
+    per_user_rows = db.execute(
+        insert(per_user).from_select(
+            ["user_id", *COUNTERS],
+            select(per_test.user_id, *[func.sum(getattr(per_test, name)) for name in COUNTERS])
+            .where(per_test.user_id.in_(user_ids))
+            .group_by(per_test.user_id)
+        )
+    ).rowcount
+
+    return {"user_test_stats": per_test_rows, "user_stats": per_user_rows}
+
+
+def rebuild_question_tests(db: Session, question_ids: Iterable[int]) -> Dict[str, int]:
+    """
+    Пересобрать счетчики тестов, в которые входят вопросы (без commit)
+
+    Вызывается до удаления вопросов: после него связи test_questions
+    удаляются каскадно.
+
+    Args:
+        db: Сессия базы данных
+        question_ids: ID вопросов
+
+    Returns:
+        Количество пересобранных строк обеих таблиц
+    """
+    question_ids = list(question_ids)
+    if not question_ids:
+        return {"user_test_stats": 0, "user_stats": 0}
+    test_ids = [
+        test_id for (test_id,) in db.execute(
+            select(models.TestQuestion.test_id)
+            .where(models.TestQuestion.question_id.in_(question_ids))
+            .distinct()
+        )
+    ]
+    return rebuild(db, test_ids)
+
+
+def rebuild_and_commit(db: Session, test_ids: Optional[List[int]] = None) -> Dict[str, Any]:
+    """
+    Пересобрать счетчики отдельной транзакцией
+
+    Args:
+        db: Сессия базы данных
+        test_ids: Тесты для пересборки (None - все данные)
+
+    Returns:
+        Количество пересобранных строк и время пересборки
+    """
+    start = time.time()
+    try:
+        result: Dict[str, Any] = rebuild(db, test_ids)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    result["seconds"] = round(time.time() - start, 2)
+    return result
+
+
+class StatsRebuilder:
+    """
+    Фоновая полная пересборка счетчиков по test_sessions
+    """
+
+    def __init__(self, interval_seconds: float = USER_STATS_REBUILD_SECONDS):
+        self.interval_seconds = interval_seconds
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start_worker(self, session_factory: Callable[[], Session]):
+        """
+        Запустить фоновый поток пересборки (если интервал задан)
+
+        Args:
+            session_factory: Фабрика сессий (SessionLocal)
+        """
+        if self.interval_seconds <= 0:
+            return
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+
+        def worker():
+            while not self._stop.wait(self.interval_seconds):
+                db = session_factory()
+                try:
+                    result = rebuild_and_commit(db)
+                    print(
+                        f"User stats rebuilt: {result['user_stats']} users, "
+                        f"{result['user_test_stats']} user tests in {result['seconds']}s"
+                    )
+                except Exception as e:
+                    print(f"User stats rebuild failed: {e}")
+                finally:
+                    db.close()
+
+        self._thread = threading.Thread(target=worker, name="user-stats-rebuild", daemon=True)
+        self._thread.start()
+
+    def stop_worker(self):
+        """Остановить фоновую пересборку"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+# Фоновая пересборка приложения
+stats_rebuilder = StatsRebuilder()
+
+
+# =====================================================
+# ЧТЕНИЕ
+# =====================================================
+
+def _statistics(row: Any) -> Dict[str, Any]:
+    """Счетчики в формате sp_get_user_statistics"""
+    completed = int(row.completed_sessions) if row is not None else 0
+    return {
+        "total_sessions": int(row.total_sessions) if row is not None else 0,
+        "completed_sessions": completed,
+        "average_score": round(float(row.score_sum) / completed, 2) if completed else None,
+        "passed_tests": int(row.passed_tests) if row is not None else 0,
+        "failed_tests": int(row.failed_tests) if row is not None else 0
+    }
+
+
+def get_user_statistics(db: Session, user_id: int, include_tests: bool = False) -> Dict[str, Any]:
+    """
+    Статистика пользователя из сводных таблиц
+
+    Args:
+        db: Сессия базы данных
+        user_id: ID пользователя
+        include_tests: Добавить разбивку по тестам
+
+    Returns:
+        Счетчики пользователя (нули, если сессий нет)
+    """
+    row = db.execute(
+        select(models.UserStats).where(models.UserStats.user_id == user_id)
+    ).scalar_one_or_none()
+
+    result = {"user_id": user_id, **_statistics(row)}
+    if include_tests:
+        result["tests"] = [
+            {"test_id": test_row.test_id, **_statistics(test_row)}
+            for test_row in db.execute(
+                select(models.UserTestStats)
+                .where(models.UserTestStats.user_id == user_id)
+                .order_by(models.UserTestStats.test_id)
+            ).scalars()
+        ]
+    return result
+
+
+# =====================================================
+# ПЕРЕСБОРКА ПРИ УДАЛЕНИИ ТЕСТОВ И СЕССИЙ
+# =====================================================
+
+@event.listens_for(SessionLocal, "before_flush")
+def _collect_deleted_sessions(session: Session, flush_context, instances):
+    """Запомнить пользователей удаляемых тестов и сессий (до каскадного удаления)"""
+    users: Set[int] = set()
+    test_ids = [obj.id for obj in session.deleted if isinstance(obj, models.Test) and obj.id is not None]
+    for obj in session.deleted:
+        if isinstance(obj, models.TestSession) and obj.user_id is not None:
+            users.add(obj.user_id)
+    if test_ids:
+        users.update(
+            user_id for (user_id,) in session.execute(
+                select(models.TestSession.user_id)
+                .where(models.TestSession.test_id.in_(test_ids))
+                .union(select(models.UserTestStats.user_id).where(models.UserTestStats.test_id.in_(test_ids)))
+            )
+        )
+    if users:
+        session.info.setdefault("user_stats_users", set()).update(users)
+
+
+@event.listens_for(SessionLocal, "after_flush")
+def _rebuild_deleted_sessions(session: Session, flush_context):
+    """Пересобрать счетчики пользователей после удаления в той же транзакции"""
+    users = session.info.pop("user_stats_users", None)
+    if users:
+        _rebuild_users(session, users)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_deleted_sessions(session: Session):
+    """Забыть пользователей отмененной транзакции"""
+    session.info.pop("user_stats_users", None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пересборка сводной статистики пользователей")
+    parser.add_argument("--test-id", type=int, action="append", help="Пересобрать только указанные тесты")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        result = rebuild_and_commit(db, args.test_id)
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
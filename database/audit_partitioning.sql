@@ -0,0 +1,47 @@
+-- =====================================================
+-- АУДИТ НА СТОРОНЕ ПРИЛОЖЕНИЯ (AUDIT_MODE=app)
+-- =====================================================
+-- Переводит audit_log с триггеров на запись из приложения
+-- (backend/audit.py) и разбивает таблицу на дневные секции
+-- по changed_at. Применяется один раз к базе, созданной из init.sql:
+--
+--   mysql testgen_db < database/audit_partitioning.sql
+--
+-- после чего в окружении backend задается AUDIT_MODE=app.
+-- Новые секции создает, а старые архивирует и удаляет команда
+--   python audit.py partitions
+--   python audit.py retention --days 180
+--
+-- Ограничения секционирования InnoDB:
+-- - внешние ключи не поддерживаются, поэтому fk_audit_user удаляется
+--   (user_id удаленного пользователя остается в записи как есть);
+-- - первичный ключ должен включать колонку секционирования,
+--   поэтому он становится (id, changed_at).
+
+-- Аудит пишет приложение: триггеры аудита удаляются
+DROP TRIGGER IF EXISTS `audit_users_insert`;
+DROP TRIGGER IF EXISTS `audit_users_update`;
+DROP TRIGGER IF EXISTS `audit_users_delete`;
+DROP TRIGGER IF EXISTS `audit_tests_insert`;
+DROP TRIGGER IF EXISTS `audit_tests_update`;
+DROP TRIGGER IF EXISTS `audit_tests_delete`;
+DROP TRIGGER IF EXISTS `audit_test_sessions_insert`;
+DROP TRIGGER IF EXISTS `audit_test_sessions_update`;
+
+ALTER TABLE `audit_log` DROP FOREIGN KEY `fk_audit_user`;
+
+ALTER TABLE `audit_log`
+    DROP PRIMARY KEY,
+    ADD PRIMARY KEY (`id`, `changed_at`);
+
+-- Все существующие записи попадают в первую секцию (до завтрашнего дня);
+-- следующие дни добавляет python audit.py partitions, разделяя pmax
+SET @audit_split = DATE_ADD(CURDATE(), INTERVAL 1 DAY);
+SET @audit_sql = CONCAT(
+    'ALTER TABLE `audit_log` PARTITION BY RANGE (UNIX_TIMESTAMP(`changed_at`)) (',
+    'PARTITION `p', DATE_FORMAT(CURDATE(), '%Y%m%d'), '` VALUES LESS THAN (UNIX_TIMESTAMP(''', @audit_split, ''')), ',
+    'PARTITION `pmax` VALUES LESS THAN MAXVALUE)'
+);
+PREPARE audit_stmt FROM @audit_sql;
+EXECUTE audit_stmt;
+DEALLOCATE PREPARE audit_stmt;
@@ -134,6 +134,8 @@ CREATE TABLE IF NOT EXISTS `questions` (
     INDEX `idx_source_document_id` (`source_document_id`),
     INDEX `idx_creator_id` (`creator_id`),
     INDEX `idx_is_approved` (`is_approved`),
+    INDEX `idx_created_at` (`created_at`),
+    INDEX `idx_updated_at` (`updated_at`),
     CONSTRAINT `fk_question_document` FOREIGN KEY (`source_document_id`) REFERENCES `source_documents` (`id`) ON DELETE SET NULL,
     CONSTRAINT `fk_question_creator` FOREIGN KEY (`creator_id`) REFERENCES `users` (`id`) ON DELETE CASCADE,
     CONSTRAINT `fk_question_approver` FOREIGN KEY (`approved_by`) REFERENCES `users` (`id`) ON DELETE SET NULL
@@ -283,6 +285,70 @@ DEFAULT CHARSET=utf8mb4
 COLLATE=utf8mb4_unicode_ci
 COMMENT='Ответы пользователей на вопросы в рамках сессий';
 
+-- =====================================================
+-- СВОДНАЯ СТАТИСТИКА ПОЛЬЗОВАТЕЛЕЙ
+-- =====================================================
+
+-- Счетчики сессий пользователя (обновляются приложением при начале
+-- и завершении сессии; пересобираются командой python user_stats.py)
+CREATE TABLE IF NOT EXISTS `user_stats` (
+    `user_id` BIGINT UNSIGNED NOT NULL,
+    `total_sessions` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'Всего сессий',
+    `completed_sessions` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'Завершенных сессий',
+    `score_sum` DECIMAL(14,2) NOT NULL DEFAULT 0 COMMENT 'Сумма баллов завершенных сессий',
+    `passed_tests` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'Пройденных попыток',
+    `failed_tests` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'Непройденных попыток',
+    `updated_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (`user_id`),
+    CONSTRAINT `fk_user_stats_user` FOREIGN KEY (`user_id`) REFERENCES `users` (`id`) ON DELETE CASCADE
+)
+ENGINE=InnoDB
+DEFAULT CHARSET=utf8mb4
+COLLATE=utf8mb4_unicode_ci
+COMMENT='Сводные счетчики сессий пользователей';
+
+-- Счетчики сессий пользователя по тестам
+CREATE TABLE IF NOT EXISTS `user_test_stats` (
+    `user_id` BIGINT UNSIGNED NOT NULL,
+    `test_id` BIGINT UNSIGNED NOT NULL,
+    `total_sessions` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'Всего сессий',
+    `completed_sessions` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'Завершенных сессий',
+    `score_sum` DECIMAL(14,2) NOT NULL DEFAULT 0 COMMENT 'Сумма баллов завершенных сессий',
+    `passed_tests` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'Пройденных попыток',
+    `failed_tests` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'Непройденных попыток',
+    `updated_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (`user_id`, `test_id`),
+    INDEX `idx_test_id` (`test_id`),
+    CONSTRAINT `fk_user_test_stats_user` FOREIGN KEY (`user_id`) REFERENCES `users` (`id`) ON DELETE CASCADE,
+    CONSTRAINT `fk_user_test_stats_test` FOREIGN KEY (`test_id`) REFERENCES `tests` (`id`) ON DELETE CASCADE
+)
+ENGINE=InnoDB
+DEFAULT CHARSET=utf8mb4
+COLLATE=utf8mb4_unicode_ci
+COMMENT='Сводные счетчики сессий пользователей по тестам';
+
+-- =====================================================
+-- ОТОЗВАННЫЕ ТОКЕНЫ
+-- =====================================================
+
+-- Токены доступа, отозванные при выходе (читаются всеми процессами
+-- backend; записи с истекшим сроком удаляются при следующем выходе)
+CREATE TABLE IF NOT EXISTS `revoked_tokens` (
+    `id` BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+    `jti` CHAR(32) NOT NULL COMMENT 'Идентификатор токена',
+    `user_id` BIGINT UNSIGNED NOT NULL,
+    `expires_at` TIMESTAMP NOT NULL COMMENT 'Срок действия токена',
+    `revoked_at` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (`id`),
+    UNIQUE INDEX `unique_jti` (`jti`),
+    INDEX `idx_expires_at` (`expires_at`),
+    CONSTRAINT `fk_revoked_tokens_user` FOREIGN KEY (`user_id`) REFERENCES `users` (`id`) ON DELETE CASCADE
+)
+ENGINE=InnoDB
+DEFAULT CHARSET=utf8mb4
+COLLATE=utf8mb4_unicode_ci
+COMMENT='Отозванные токены доступа';
+
 -- =====================================================
 -- СИСТЕМА АУДИТА
 -- =====================================================
@@ -330,16 +396,20 @@ BEFORE UPDATE ON `test_sessions`
 FOR EACH ROW
 BEGIN
     IF NEW.status = 'completed' AND OLD.status = 'in_progress' THEN
-        SET NEW.completed_at = NOW();
-        SET NEW.time_spent_seconds = TIMESTAMPDIFF(SECOND, NEW.started_at, NOW());
+        -- Время завершения, переданное приложением (очередь попыток), сохраняется
+        SET NEW.completed_at = COALESCE(NEW.completed_at, NOW());
+        SET NEW.time_spent_seconds = TIMESTAMPDIFF(SECOND, NEW.started_at, NEW.completed_at);
 
-        -- Расчет балла
-        IF NEW.total_questions > 0 THEN
+        -- Расчет балла, если приложение его не передало
+        -- (приложение считает балл с учетом test_questions.points)
+        IF NEW.score IS NULL AND NEW.total_questions > 0 THEN
             SET NEW.score = (NEW.correct_answers / NEW.total_questions) * 100;
         END IF;
 
         -- Определение, пройден ли тест
-        SET NEW.is_passed = (NEW.score >= (SELECT passing_score FROM tests WHERE id = NEW.test_id));
+        IF NEW.is_passed IS NULL THEN
+            SET NEW.is_passed = (NEW.score >= (SELECT passing_score FROM tests WHERE id = NEW.test_id));
+        END IF;
     END IF;
 END//
 
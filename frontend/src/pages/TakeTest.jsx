@@ -13,6 +13,7 @@ function TakeTest() {
   const [timeLeft, setTimeLeft] = useState(0)
   const [showResult, setShowResult] = useState(false)
   const [score, setScore] = useState(0)
+  const [sessionId, setSessionId] = useState(null)
 
   useEffect(() => {
     fetchTest()
@@ -39,6 +40,14 @@ function TakeTest() {
       setTimeLeft(testRes.data.time_limit * 60) // Конвертируем минуты в секунды
     } catch (error) {
       console.error('Ошибка загрузки теста:', error)
+      return
+    }
+
+    try {
+      const sessionRes = await axios.post(`/api/tests/${id}/sessions`)
+      setSessionId(sessionRes.data.session_id)
+    } catch (error) {
+      console.error('Ошибка начала сессии:', error)
     }
   }
 
@@ -58,7 +67,31 @@ function TakeTest() {
     }
   }
 
-  const handleSubmit = () => {
+  const handleSubmit = async () => {
+    if (sessionId) {
+      // Результат подсчитывается на сервере
+      try {
+        const submitted = Object.entries(answers).map(([questionId, answerIndex]) => ({
+          question_id: Number(questionId),
+          option_id: questions.find(q => q.id === Number(questionId)).answers[answerIndex].id
+        }))
+        // Попытка ставится в очередь, результат получаем по квитанции
+        let receipt = (await axios.post(`/api/sessions/${sessionId}/submissions`, { answers: submitted })).data
+        while (receipt.status === 'queued') {
+          await new Promise(resolve => setTimeout(resolve, 1000))
+          receipt = (await axios.get(`/api/submissions/${receipt.receipt_id}`)).data
+        }
+
+        if (receipt.status === 'completed' && receipt.result.score !== null) {
+          setScore(Math.round(receipt.result.score))
+          setShowResult(true)
+          return
+        }
+      } catch (error) {
+        console.error('Ошибка завершения теста:', error)
+      }
+    }
+
     // Подсчитываем результат
     let correctAnswers = 0
     questions.forEach((question) => {